@@ -0,0 +1,575 @@
+"""
+Нагрузочный тест бота целиком, без внешних сервисов.
+Через настоящие хендлеры, очередь генерации, кеши и роутер гоняется
+смесь сообщений от виртуальных пользователей; снаружи всё подменено:
+
+- Telegram Bot API — FakeTelegram (telegram.request.BaseRequest);
+- YandexGPT и DeepSeek — FakeLLM за httpx.MockTransport общего клиента
+  llm_client, с настраиваемой латентностью и долей ошибок;
+- Postgres — MemoryDB вместо функций db.py (или настоящая БД с --postgres).
+
+Каждый пользователь шлёт сообщения по очереди и ждёт итогового ответа
+(не «⏳»-подтверждения, а при потоковой выдаче — последней правки
+отчёта). Латентность шага — от апдейта до этого ответа.
+Результат — одна строка JSON на stdout (и в --out), чтобы сравнивать
+коммиты между собой.
+
+    python bench_bot.py [--users 50] [--messages 20] [--yandex-latency 0.3]
+                        [--yandex-error-rate 0.02] [--stream] [--out result.json]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+for _name in ("TELEGRAM_TOKEN", "YANDEX_API_KEY", "YANDEX_FOLDER_ID", "DB_PASSWORD"):
+    os.environ.setdefault(_name, "bench")
+
+import httpx  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+
+import bot  # noqa: E402
+import fragments  # noqa: E402
+import generation_queue  # noqa: E402
+import llm_client  # noqa: E402
+import llm_scheduler  # noqa: E402
+import persistence  # noqa: E402
+import reports  # noqa: E402
+import token_usage  # noqa: E402
+from config import settings  # noqa: E402
+from persistence import PostgresPersistence  # noqa: E402
+from router import is_failed  # noqa: E402
+from update_processor import ChatOrderedUpdateProcessor  # noqa: E402
+
+DEEPSEEK_URL = "http://deepseek.bench/v1/chat/completions"
+# модули, импортирующие функции db.py по имени, — в них подменяется БД
+DB_CONSUMERS = (bot, reports, fragments, token_usage, persistence, generation_queue)
+ACK_PREFIX = "⏳"
+# ответы FakeLLM обрамлены маркерами: по ним видно, что поток отчёта дописан
+ANSWER_START, ANSWER_END = "✨", "🔚"
+ANSWER_LIMIT = 3500  # короче лимита сообщения — отчёт не режется на части
+
+CHATTER = [
+    "привет",
+    "а что ты умеешь?",
+    "расскажи про мою судьбу",
+    "спасибо большое 🙏",
+    "хочу такого же бота",
+]
+DATE_TEMPLATES = ["{d:02d}.{m:02d}.{y}", "я родилась {d}.{m}.{y}", "моя дата {y}-{m:02d}-{d:02d}"]
+# доли типов шагов, примерно как в логах
+MIX = {
+    "date": 0.50,
+    "repeat": 0.10,
+    "chatter": 0.15,
+    "mode": 0.10,
+    "ai": 0.05,
+    "multi_date": 0.10,
+}
+
+
+# ---------- Telegram ----------
+class FakeTelegram(BaseRequest):
+    """Bot API в памяти: ответы на sendMessage/edit попадают в inbox чата."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.inbox: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.calls: Counter = Counter()
+        self._ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> Tuple[int, bytes]:
+        api = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            result = {
+                "message_id": params.get("message_id") or next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params["text"],
+            }
+            self.inbox[chat_id].put_nowait((api, params["text"], time.perf_counter()))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# ---------- LLM ----------
+class FakeLLM:
+    """YandexGPT и OpenAI-совместимый DeepSeek с латентностью и ошибками."""
+
+    def __init__(self, args: argparse.Namespace, rng: random.Random) -> None:
+        self.args = args
+        self.rng = rng
+        self.requests: Counter = Counter()
+
+    @staticmethod
+    def _answer(prompt: str) -> str:
+        # «обогащённые» строки раздела данных — текст реалистичной длины
+        data = prompt.split("Данные:\n", 1)[-1]
+        lines = [line for line in data.splitlines() if line.strip()] or [prompt[:80]]
+        filler = " Это число раскрывает твою внутреннюю силу и подсказывает путь."
+        text = "\n\n".join(line + filler * 3 for line in lines)[:ANSWER_LIMIT]
+        return ANSWER_START + text + ANSWER_END
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        provider = "deepseek" if request.url.host == "deepseek.bench" else "yandex"
+        self.requests[provider] += 1
+        latency = getattr(self.args, f"{provider}_latency")
+        error_rate = getattr(self.args, f"{provider}_error_rate")
+        await asyncio.sleep(latency * self.rng.uniform(0.5, 1.5))
+        if self.rng.random() < error_rate:
+            return httpx.Response(503, text="injected error")
+        if provider == "yandex":
+            return self._yandex(body)
+        return self._deepseek(body)
+
+    def _yandex(self, body: dict) -> httpx.Response:
+        text = self._answer(body["messages"][0]["text"])
+        usage = {"inputTextTokens": "500", "completionTokens": str(len(text) // 4)}
+
+        def result(part: str) -> dict:
+            return {"result": {
+                "alternatives": [{"message": {"role": "assistant", "text": part}}],
+                "usage": usage,
+            }}
+
+        if not body["completionOptions"].get("stream"):
+            return httpx.Response(200, json=result(text))
+        # поток: строки JSON с накопленным текстом
+        step = max(1, len(text) // 8)
+        lines = [json.dumps(result(text[:i])) for i in range(step, len(text), step)]
+        lines.append(json.dumps(result(text)))
+        return httpx.Response(200, text="\n".join(lines) + "\n")
+
+    def _deepseek(self, body: dict) -> httpx.Response:
+        text = self._answer(body["messages"][0]["content"])
+        usage = {"prompt_tokens": 500, "completion_tokens": len(text) // 4}
+        if not body.get("stream"):
+            return httpx.Response(200, json={
+                "choices": [{"message": {"role": "assistant", "content": text}}],
+                "usage": usage,
+            })
+        step = max(1, len(text) // 8)
+        events = [
+            "data: " + json.dumps({"choices": [{"delta": {"content": text[i : i + step]}}]})
+            for i in range(0, len(text), step)
+        ]
+        if body.get("stream_options", {}).get("include_usage"):
+            events.append("data: " + json.dumps({"choices": [], "usage": usage}))
+        events.append("data: [DONE]")
+        return httpx.Response(200, text="\n\n".join(events) + "\n\n")
+
+
+# ---------- Postgres ----------
+class MemoryDB:
+    """Функции db.py на словарях: та же семантика ключей и очереди."""
+
+    def __init__(self) -> None:
+        self.reports: Dict[tuple, str] = {}
+        self.fragments: Dict[tuple, str] = {}
+        self.usage: List[tuple] = []
+        self.history: Dict[Tuple[int, tuple], float] = {}
+        self.user_data: Dict[int, dict] = {}
+        self.jobs: Dict[int, dict] = {}
+        self._job_ids = itertools.count(1)
+        self.lookups = Counter()
+
+    async def init_db(self) -> None:
+        pass
+
+    async def close_db(self) -> None:
+        pass
+
+    async def get_cached_report(
+        self, user_id, date_str, mode, ai, prompt_version, oldest_version=None
+    ):
+        oldest = prompt_version if oldest_version is None else oldest_version
+        for version in range(prompt_version, oldest - 1, -1):
+            key = (date_str, mode, ai, version)
+            text = self.reports.get(key)
+            if text:
+                self.lookups["hit"] += 1
+                self.history[(user_id, key)] = time.time()
+                return text, version
+        self.lookups["miss"] += 1
+        return None
+
+    async def save_report(self, user_id, date_str, mode, ai, prompt_version, report_text):
+        key = (date_str, mode, ai, prompt_version)
+        self.reports.setdefault(key, report_text)
+        if user_id is not None:
+            self.history[(user_id, key)] = time.time()
+
+    async def get_fragments(self, mode, ai, prompt_version, keys):
+        found = {key: self.fragments.get((key, mode, ai, prompt_version)) for key in keys}
+        return {key: text for key, text in found.items() if text is not None}
+
+    async def save_fragments(self, mode, ai, prompt_version, fragments):
+        for key, text in fragments.items():
+            self.fragments.setdefault((key, mode, ai, prompt_version), text)
+
+    async def record_report_request(self, user_id, date_str, mode, ai, prompt_version):
+        key = (date_str, mode, ai, prompt_version)
+        if key in self.reports:
+            self.history[(user_id, key)] = time.time()
+
+    async def save_usage(self, rows):
+        self.usage.extend(rows)
+
+    async def recent_usage(self, purpose, per_key, days):
+        return []
+
+    async def purge_usage(self, older_than_days):
+        return 0
+
+    async def load_user_data(self, user_id):
+        data = self.user_data.get(user_id)
+        return None if data is None else dict(data)
+
+    async def save_user_data(self, batch):
+        self.user_data.update({k: dict(v) for k, v in batch.items()})
+
+    async def delete_user_data(self, user_ids):
+        for user_id in user_ids:
+            self.user_data.pop(user_id, None)
+
+    async def enqueue_job(self, user_id, chat_id, date_str, mode, ai, priority, max_attempts):
+        for job in self.jobs.values():
+            if job["status"] in ("queued", "running") and (
+                job["user_id"], job["date_str"], job["mode"], job["ai"]
+            ) == (user_id, date_str, mode, ai):
+                return None
+        job_id = next(self._job_ids)
+        self.jobs[job_id] = dict(
+            id=job_id, user_id=user_id, chat_id=chat_id, date_str=date_str, mode=mode,
+            ai=ai, priority=priority, max_attempts=max_attempts, attempts=0,
+            status="queued", run_after=0.0, locked_until=0.0,
+        )
+        return job_id
+
+    async def claim_job(self, visibility_timeout):
+        now = time.monotonic()
+        ready = [
+            j for j in self.jobs.values()
+            if (j["status"] == "queued" and j["run_after"] <= now)
+            or (j["status"] == "running" and j["locked_until"] < now)
+        ]
+        if not ready:
+            return None
+        job = min(ready, key=lambda j: (-j["priority"], j["run_after"], j["id"]))
+        job.update(status="running", attempts=job["attempts"] + 1,
+                   locked_until=now + visibility_timeout)
+        return dict(job)
+
+    def _owned(self, job_id, attempts):
+        job = self.jobs.get(job_id)
+        if job and job["attempts"] == attempts and job["status"] == "running":
+            return job
+        return None
+
+    async def extend_job(self, job_id, attempts, visibility_timeout):
+        job = self._owned(job_id, attempts)
+        if job:
+            job["locked_until"] = time.monotonic() + visibility_timeout
+
+    async def finish_job(self, job_id, attempts, status, error=None):
+        job = self._owned(job_id, attempts)
+        if job:
+            # завершённые задания не нужны — не копим их за прогон
+            del self.jobs[job_id]
+
+    async def retry_job(self, job_id, attempts, delay, error):
+        job = self._owned(job_id, attempts)
+        if job:
+            job.update(status="queued", run_after=time.monotonic() + delay)
+
+    async def release_job(self, job_id, attempts):
+        job = self._owned(job_id, attempts)
+        if job:
+            job.update(status="queued", attempts=attempts - 1)
+
+    async def purge_jobs(self, older_than_days):
+        pass
+
+    def install(self) -> None:
+        for module in DB_CONSUMERS:
+            for name in dir(self):
+                if not name.startswith("_") and hasattr(module, name) and callable(getattr(self, name)):
+                    setattr(module, name, getattr(self, name))
+
+
+# ---------- Нагрузка ----------
+def _zipf_dates(count: int, rng: random.Random) -> Tuple[List[Tuple[int, int, int]], List[float]]:
+    """Пул дат с популярностью по Ципфу: немногие даты спрашивают часто."""
+    dates = [(rng.randint(1, 28), rng.randint(1, 12), rng.randint(1950, 2010)) for _ in range(count)]
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(count)]
+    return dates, weights
+
+
+class VirtualUser:
+    def __init__(self, user_id: int, app: Application, tg: FakeTelegram, rng: random.Random,
+                 dates, weights, timeout: float) -> None:
+        self.user_id = user_id
+        self.app = app
+        self.tg = tg
+        self.rng = rng
+        self.dates, self.weights = dates, weights
+        self.timeout = timeout
+        self._update_ids = itertools.count(user_id * 1_000_000)
+
+    def _date_text(self) -> str:
+        d, m, y = self.rng.choices(self.dates, self.weights)[0]
+        return self.rng.choice(DATE_TEMPLATES).format(d=d, m=m, y=y)
+
+    def _base(self) -> dict:
+        return {
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": {"id": self.user_id, "is_bot": False, "first_name": "U"},
+            "date": int(time.time()),
+        }
+
+    def _message(self, text: str) -> Update:
+        msg = {"message_id": next(self._update_ids), "text": text, **self._base()}
+        return Update.de_json({"update_id": next(self._update_ids), "message": msg}, self.app.bot)
+
+    def _callback(self, data: str) -> Update:
+        msg = {"message_id": next(self._update_ids), "text": "кнопки", **self._base()}
+        query = {
+            "id": str(next(self._update_ids)), "from": self._base()["from"],
+            "chat_instance": str(self.user_id), "data": data, "message": msg,
+        }
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": query}, self.app.bot)
+
+    @staticmethod
+    def _is_final(text: str) -> bool:
+        if text.startswith(ACK_PREFIX):
+            return False
+        if settings.stream_reports and not settings.report_fragments and text.startswith(ANSWER_START):
+            # отчёт ещё растёт правками, пока не дописан или не оборвался
+            return text.endswith(ANSWER_END) or is_failed(text)
+        return True
+
+    async def _step(self, update: Update) -> Tuple[float, str]:
+        """Время до итогового ответа и его текст."""
+        inbox = self.tg.inbox[self.user_id]
+        started = time.perf_counter()
+        await self.app.update_queue.put(update)
+        while True:
+            _api, text, at = await asyncio.wait_for(inbox.get(), self.timeout)
+            if self._is_final(text):
+                return at - started, text
+
+    async def run(self, messages: int, results: List[dict]) -> None:
+        kinds, weights = zip(*MIX.items())
+        for _ in range(messages):
+            kind = self.rng.choices(kinds, weights)[0]
+            if kind == "date":
+                update = self._message(self._date_text())
+            elif kind == "repeat":
+                update = self._message("сделай расчёт по дате")
+            elif kind == "chatter":
+                update = self._message(self.rng.choice(CHATTER))
+            elif kind == "mode":
+                update = self._callback(self.rng.choice(["default", "deep", "master"]))
+            elif kind == "ai":
+                update = self._callback(self.rng.choice(["ai_yandex", "ai_deepseek"]))
+            else:
+                update = self._message(f"даты: {self._date_text()} и {self._date_text()}")
+            try:
+                seconds, text = await self._step(update)
+                if kind == "multi_date" and text.startswith("Нашёл несколько дат"):
+                    # выбор первой даты кнопкой — отдельный шаг
+                    results.append({"kind": kind, "seconds": seconds, "error": False})
+                    first = "{:02d}.{:02d}.{}".format(*self.rng.choices(self.dates, self.weights)[0])
+                    seconds, text = await self._step(self._callback(f"date_choice|{first}"))
+                    kind = "date_choice"
+                results.append({
+                    "kind": kind, "seconds": seconds, "error": text.startswith("Произошла ошибка"),
+                })
+            except asyncio.TimeoutError:
+                results.append({"kind": kind, "seconds": self.timeout, "error": True, "timeout": True})
+
+
+# ---------- Отчёт ----------
+def _pct(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _latency(samples: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(samples),
+        "p50_ms": round(_pct(samples, 0.50) * 1000, 1),
+        "p95_ms": round(_pct(samples, 0.95) * 1000, 1),
+        "p99_ms": round(_pct(samples, 0.99) * 1000, 1),
+        "max_ms": round(max(samples, default=0.0) * 1000, 1),
+    }
+
+
+def _lookups(layer: str, result: str) -> float:
+    value = REGISTRY.get_sample_value(
+        "bot_report_cache_lookups_total", {"layer": layer, "result": result}
+    )
+    return value or 0.0
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    settings.stream_reports = args.stream
+    settings.report_fragments = args.fragments
+    settings.metrics_port = 0
+    # фоновое обслуживание хранилища работает с настоящей БД
+    settings.reports_maintenance_interval = 0
+    settings.deepseek_url = DEEPSEEK_URL
+    if not args.telegram_limits:
+        # виртуальные пользователи пишут чаще, чем пропустит Telegram;
+        # без флага меряем пропускную способность самого бота
+        settings.telegram_global_rate = settings.telegram_chat_rate = settings.telegram_group_rate = 1e6
+
+    if not args.postgres:
+        MemoryDB().install()
+    fake_llm = FakeLLM(args, rng)
+    llm_client._client = httpx.AsyncClient(transport=httpx.MockTransport(fake_llm))
+    tg = FakeTelegram(args.telegram_latency)
+
+    app = (
+        Application.builder()
+        .token("1:bench")
+        .request(tg)
+        .updater(None)
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(settings.update_concurrency, settings.update_backlog)
+        )
+        .persistence(
+            PostgresPersistence(
+                settings.persistence_update_interval,
+                settings.persistence_cache_ttl,
+                settings.persistence_cache_size,
+            )
+        )
+        .build()
+    )
+    bot.add_handlers(app)
+
+    dates, weights = _zipf_dates(args.dates, rng)
+    users = [
+        VirtualUser(100 + i, app, tg, random.Random(rng.random()), dates, weights, args.step_timeout)
+        for i in range(args.users)
+    ]
+    results: List[dict] = []
+    async with app:
+        await bot.on_startup(app)
+        await app.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(u.run(args.messages, results) for u in users))
+        wall = time.perf_counter() - started
+        await app.stop()
+        await generation_queue.stop_workers(5)
+    await bot.on_shutdown(app)
+
+    by_kind: Dict[str, List[float]] = defaultdict(list)
+    for r in results:
+        by_kind[r["kind"]].append(r["seconds"])
+    report_lookups = sum(
+        _lookups(layer, result)
+        for layer, result in (("memory", "hit"), ("memory", "miss"))
+    )
+    report_hits = _lookups("memory", "hit") + _lookups("db", "hit") + _lookups("singleflight", "hit")
+    return {
+        "commit": _commit(),
+        "config": {
+            k: v for k, v in vars(args).items() if k not in ("out",)
+        },
+        "steps": len(results),
+        "duration_sec": round(wall, 3),
+        "throughput_steps_per_sec": round(len(results) / wall, 2) if wall else 0.0,
+        "latency": _latency([r["seconds"] for r in results]),
+        "by_kind": {kind: _latency(samples) for kind, samples in sorted(by_kind.items())},
+        "errors": sum(r["error"] for r in results),
+        "timeouts": sum(r.get("timeout", False) for r in results),
+        "cache": {
+            "report_requests": int(report_lookups),
+            "report_hit_rate": round(report_hits / report_lookups, 4) if report_lookups else 0.0,
+            "memory_hit_rate": round(_lookups("memory", "hit") / report_lookups, 4) if report_lookups else 0.0,
+        },
+        "llm_requests": dict(fake_llm.requests),
+        "llm_scheduler": dict(llm_scheduler.SCHEDULER_STATS),
+        "fragments": dict(fragments.FRAGMENT_STATS),
+        "token_usage": token_usage.usage_stats(),
+        "telegram_calls": dict(tg.calls),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20, help="шагов на пользователя")
+    parser.add_argument("--dates", type=int, default=300, help="размер пула дат")
+    parser.add_argument("--yandex-latency", type=float, default=0.3)
+    parser.add_argument("--yandex-error-rate", type=float, default=0.0)
+    parser.add_argument("--deepseek-latency", type=float, default=0.5)
+    parser.add_argument("--deepseek-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--stream", action="store_true", help="потоковая выдача отчётов")
+    parser.add_argument("--fragments", action="store_true", help="сборка отчётов из фрагментов")
+    parser.add_argument("--telegram-limits", action="store_true", help="лимиты отправки Bot API")
+    parser.add_argument("--postgres", action="store_true", help="настоящая БД из настроек")
+    parser.add_argument("--step-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="дописать результат в файл (JSON lines)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    line = json.dumps(result, ensure_ascii=False)
+    print(line)
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Микро-бенчмарк date_parser.find_dates на корпусе типичных сообщений.
+Сравнивает путь с предфильтром и прогон всех извлекателей подряд,
+заодно проверяет, что результаты совпадают.
+
+    python bench_date_parser.py [--rounds N]
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+t0 = time.perf_counter()
+import date_parser  # noqa: E402
+
+IMPORT_SEC = time.perf_counter() - t0
+
+# Распределение примерно как в логах: большинство — без даты вовсе.
+CORPUS = [
+    "привет",
+    "Привет! Как дела?",
+    "а что ты умеешь?",
+    "ну и что дальше",
+    "спасибо большое 🙏",
+    "ок",
+    "круто, а можно ещё раз",
+    "хочу такого же бота",
+    "расскажи про мою судьбу",
+    "🔥🔥🔥",
+    "сделай расчёт по дате",
+    "не понял",
+    "мне 25 лет",
+    "позвони в 10",
+    "код 1234",
+    "15.06.1985",
+    "я родился 3.4.1990",
+    "моя дата 1992-11-07",
+    "01/02/03",
+    "1 мая 2000",
+    "родилась 12 декабря 1987 года",
+    "первое января 1999",
+    "двадцать третье февраля 1975",
+    "у мамы день рождения 8 марта, а у меня 01.05.2000г",
+    "даты: 01.01.2001 и 02.02.2002",
+    "31.02.2000",
+    "в мае было тепло",
+    "встреча 12.10 в 19:30",
+]
+
+
+def _bench(fn, rounds: int) -> float:
+    """Медиана микросекунд на одно сообщение корпуса."""
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for text in CORPUS:
+            fn(text)
+        samples.append((time.perf_counter() - start) / len(CORPUS) * 1e6)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    date_parser._extractor()
+    natasha_sec = time.perf_counter() - t0
+
+    for text in CORPUS:
+        fast = date_parser.find_dates(text)
+        full = date_parser._find_dates_unfiltered(text)
+        assert fast == full, f"{text!r}: {fast} != {full}"
+
+    fast_us = _bench(date_parser.find_dates, args.rounds)
+    full_us = _bench(date_parser._find_dates_unfiltered, args.rounds)
+
+    print(f"import date_parser:       {IMPORT_SEC * 1e3:8.1f} ms")
+    print(f"Natasha init (lazy):      {natasha_sec * 1e3:8.1f} ms")
+    print(f"find_dates (prefilter):   {fast_us:8.1f} us/msg")
+    print(f"all extractors:           {full_us:8.1f} us/msg")
+    print(f"speedup:                  {full_us / fast_us:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
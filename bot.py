@@ -1,5 +1,7 @@
 # bot.py  (добавлен выбор ИИ + вызов двух моделей)
+import asyncio
 import logging
+import signal
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -11,14 +13,18 @@ from telegram.ext import (
 )
 from telegram.error import BadRequest, TimedOut, Forbidden, TelegramError
 from config import settings
-from db import init_db, get_cached_report, save_report
-from numerology import calculate
-from utils import detect_mode_and_date
-from yandex_gpt import generate_via_yandex, generate_fallback_via_yandex
-from deepseek_client import generate_via_deepseek
-from build_report import build_report_structure
+from db import init_db, close_db
+from fallback_replies import fallback_reply, start_pool_refresh, stop_pool_refresh
+from llm_client import close_client
+from generation_queue import enqueue_report, start_workers, stop_workers
+from prewarm import start_prewarm, stop_prewarm
+from report_storage import start_maintenance, stop_maintenance
+from telegram_sender import send_text
+from token_usage import start_usage_accounting, stop_usage_accounting
+from update_processor import ChatOrderedUpdateProcessor
+from persistence import PostgresPersistence
+from metrics import register_stats, start_metrics_server, stop_metrics_server, track
 from date_parser import find_dates
-from typing import List
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,26 +40,10 @@ async def _safe_answer(query) -> bool:
         return False
 
 
-async def _reply(update: Update, text: str) -> None:
-    if update.message:
-        await update.message.reply_text(text)
-    else:
-        await update.callback_query.message.reply_text(text)
-
-
-async def send_long_message(update: Update, text: str) -> None:
-    for chunk in (text[i : i + 4000] for i in range(0, len(text), 4000)):
-        await _reply(update, chunk)
-
-
-# ---------- генерация текста ----------
-async def generate_text(
-    structure: List[str], mode: str, ai: str
-) -> str:
-    if ai == "deepseek":
-        return generate_via_deepseek(structure, mode)
-    # по умолчанию – YandexGPT
-    return generate_via_yandex(structure, mode)
+async def _reply(update: Update, text: str, **kwargs) -> None:
+    # все ответы идут через общий конвейер: нарезка и лимиты Bot API
+    with track("telegram_send"):
+        await send_text(update.get_bot(), update.effective_chat.id, text, **kwargs)
 
 
 # ---------- логика расчёта ----------
@@ -62,25 +52,20 @@ async def _proceed_with_date(
 ) -> None:
     user_id = update.effective_user.id
     context.user_data["last_valid_date"] = date_str
-    context.user_data["hint_given"] = False
 
     ai = context.user_data.get("ai", "yandex")
-    cache_key = f"{user_id}|{date_str}|{mode}|{ai}"
-
-    cached = get_cached_report(user_id, date_str, mode)
-    if cached:
-        await _reply(update, cached)
-        return
 
     try:
-        data = calculate(date_str)
-        structure = build_report_structure(data, mode)
-        final_text = await generate_text(structure, mode, ai)
-        save_report(user_id, date_str, mode, final_text)
-        await send_long_message(update, final_text)
+        # генерирует и доставляет отчёт воркер очереди
+        job_id = await enqueue_report(user_id, update.effective_chat.id, date_str, mode, ai)
     except Exception:
-        logger.exception("Ошибка генерации")
+        logger.exception("Ошибка постановки в очередь")
         await _reply(update, "Произошла ошибка. Попробуй позже.")
+        return
+    if job_id is None:
+        await _reply(update, "⏳ Этот расчёт уже готовится — пришлю, как только будет готов.")
+    else:
+        await _reply(update, "⏳ Составляю расклад, это займёт немного времени.")
 
 
 # ---------- команды ----------
@@ -97,9 +82,7 @@ async def mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         [InlineKeyboardButton("🌙 Глубокий (deep)", callback_data="deep")],
         [InlineKeyboardButton("🌈 Мастер (master)", callback_data="master")],
     ]
-    await update.message.reply_text(
-        "Выбери режим расчёта:", reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    await _reply(update, "Выбери режим расчёта:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 async def ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -107,9 +90,7 @@ async def ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         [InlineKeyboardButton("☁️ YandexGPT", callback_data="ai_yandex")],
         [InlineKeyboardButton("🦔 DeepSeek (локально)", callback_data="ai_deepseek")],
     ]
-    await update.message.reply_text(
-        "Выбери модель ИИ:", reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    await _reply(update, "Выбери модель ИИ:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 async def set_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -117,7 +98,14 @@ async def set_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await _safe_answer(query)
     chosen = query.data.split("_")[1]  # ai_yandex / ai_deepseek
     context.user_data["ai"] = chosen
-    await query.message.reply_text(f"✅ Модель ИИ установлена: {chosen}")
+    await _reply(update, f"✅ Модель ИИ установлена: {chosen}")
+
+
+async def set_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await _safe_answer(query)
+    context.user_data["mode"] = query.data  # default / deep / master
+    await _reply(update, f"✅ Режим расчёта установлен: {query.data}")
 
 
 async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -125,7 +113,7 @@ async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await _safe_answer(query)
     _, date_str = query.data.split("|", 1)
     mode = context.user_data.get("mode", "master")
-    await query.message.reply_text(f"Берём дату: {date_str}")
+    await _reply(update, f"Берём дату: {date_str}")
     await _proceed_with_date(update, context, date_str, mode)
 
 
@@ -143,14 +131,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await _proceed_with_date(update, context, last_date, mode)
         return
 
-    candidates = find_dates(text)
+    with track("find_dates"):
+        candidates = find_dates(text)
     if not candidates:
-        if context.user_data.get("hint_given"):
-            resp = generate_fallback_via_yandex(text)
-            await _reply(update, resp)
-            return
-        context.user_data["hint_given"] = True
-        resp = generate_fallback_via_yandex(text)
+        with track("fallback_reply"):
+            resp = await fallback_reply(text, user_id)
         await _reply(update, resp)
         return
 
@@ -163,15 +148,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         [InlineKeyboardButton(dt, callback_data=f"date_choice|{dt}")]
         for dt in candidates
     ]
-    await update.message.reply_text(
+    await _reply(
+        update,
         "Нашёл несколько дат – выбери нужную:",
         reply_markup=InlineKeyboardMarkup(keyboard),
     )
 
 
 async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_text = update.message.text.strip() if update.message else ""
-    response = generate_fallback_via_yandex(user_text)
+    # стикеры, фото, голосовые: текста нет
+    user_text = update.message.text if update.message else None
+    user_id = update.effective_user.id if update.effective_user else None
+    with track("fallback_reply"):
+        response = await fallback_reply(user_text, user_id)
     await _reply(update, response)
 
 
@@ -189,10 +178,79 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 # ---------- запуск ----------
-def main() -> None:
-    init_db()
-    app = Application.builder().token(settings.telegram_token).build()
+async def on_startup(app: Application) -> None:
+    await init_db()
+    await start_usage_accounting()
+    start_workers(app.bot)
+    start_pool_refresh()
+    start_prewarm()
+    start_maintenance()
+    if settings.metrics_port:
+        await start_metrics_server(settings.metrics_host, settings.metrics_port)
+    if app.persistence is not None:
+        register_stats("persistence", app.persistence.stats)
+
+
+async def on_shutdown(app: Application) -> None:
+    await stop_metrics_server()
+    await stop_pool_refresh()
+    await stop_prewarm()
+    await stop_maintenance()
+    await stop_usage_accounting()
+    await close_client()
+    await close_db()
+
+
+async def _start_updater(app: Application) -> None:
+    if settings.bot_mode == "polling":
+        await app.updater.start_polling()
+        return
+    if not settings.webhook_url:
+        raise ValueError("BOT_MODE=webhook требует WEBHOOK_URL")
+    await app.updater.start_webhook(
+        listen=settings.webhook_listen,
+        port=settings.webhook_port,
+        url_path=settings.webhook_path,
+        webhook_url=f"{settings.webhook_url.rstrip('/')}/{settings.webhook_path}",
+        secret_token=settings.webhook_secret or None,
+        max_connections=settings.webhook_max_connections,
+    )
+
 
+async def serve(app: Application) -> None:
+    """
+    Жизненный цикл бота. В отличие от run_polling/run_webhook, между
+    остановкой приёма апдейтов и app.stop() идёт ограниченный по времени
+    дренаж, а затем воркеры очереди дорабатывают начатые генерации.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        async with app:  # initialize() / shutdown()
+            await on_startup(app)
+            try:
+                await _start_updater(app)
+                await app.start()
+                logger.info("Бот запущен (%s).", settings.bot_mode)
+                await stop.wait()
+            finally:
+                logger.info("Останавливаем бота.")
+                if app.updater.running:
+                    await app.updater.stop()
+                if app.running:
+                    await app.update_processor.drain(
+                        app.update_queue, settings.shutdown_drain_timeout
+                    )
+                    await app.stop()
+                await stop_workers(settings.shutdown_drain_timeout)
+    finally:
+        await on_shutdown(app)
+
+
+def add_handlers(app: Application) -> None:
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("mode", mode))
     app.add_handler(CommandHandler("ai", ai))
@@ -203,9 +261,26 @@ def main() -> None:
     app.add_handler(MessageHandler(filters.ALL, fallback))
     app.add_error_handler(error_handler)
 
-    logger.info("Бот запущен.")
-    app.run_polling()
+
+def main() -> None:
+    app = (
+        Application.builder()
+        .token(settings.telegram_token)
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(settings.update_concurrency, settings.update_backlog)
+        )
+        .persistence(
+            PostgresPersistence(
+                settings.persistence_update_interval,
+                settings.persistence_cache_ttl,
+                settings.persistence_cache_size,
+            )
+        )
+        .build()
+    )
+    add_handlers(app)
+    asyncio.run(serve(app))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,83 @@
+"""
+Сжатие текстов отчётов zstd со словарём.
+Отчёт — несколько КБ, и все отчёты очень похожи: одни и те же заголовки,
+эмодзи, обороты и концовка. Внутри одного текста zstd почти не находит
+повторов, а словарь, обученный на корпусе отчётов, приносит их с собой.
+
+Словари лежат в report_dicts и не меняются; каждое тело хранит id своего
+словаря (None — сжато без словаря, пока корпус для обучения не набрался).
+Новые тела сжимаются последним словарём.
+"""
+from __future__ import annotations
+
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import zstandard
+
+from config import settings
+
+_dicts: Dict[int, zstandard.ZstdCompressionDict] = {}
+_compressors: Dict[Optional[int], zstandard.ZstdCompressor] = {}
+_decompressors: Dict[Optional[int], zstandard.ZstdDecompressor] = {}
+_current: Optional[int] = None
+
+
+def body_hash(text: str) -> bytes:
+    """Ключ дедупликации: одинаковые тексты хранятся один раз."""
+    return hashlib.sha256(text.encode()).digest()
+
+
+# ---------- словари ----------
+def register_dictionary(dict_id: int, data: bytes, current: bool = False) -> None:
+    global _current
+    if dict_id not in _dicts:
+        _dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+    if current and (_current is None or dict_id > _current):
+        _current = dict_id
+
+
+def has_dictionary(dict_id: Optional[int]) -> bool:
+    return dict_id is None or dict_id in _dicts
+
+
+def current_dictionary() -> Optional[int]:
+    return _current
+
+
+def train(samples: List[str], size: int) -> bytes:
+    """Словарь zstd по образцам отчётов."""
+    return zstandard.train_dictionary(size, [s.encode() for s in samples]).as_bytes()
+
+
+# ---------- сжатие ----------
+def _compressor(dict_id: Optional[int]) -> zstandard.ZstdCompressor:
+    compressor = _compressors.get(dict_id)
+    if compressor is None:
+        compressor = zstandard.ZstdCompressor(
+            level=settings.reports_zstd_level,
+            dict_data=_dicts[dict_id] if dict_id is not None else None,
+        )
+        _compressors[dict_id] = compressor
+    return compressor
+
+
+def _decompressor(dict_id: Optional[int]) -> zstandard.ZstdDecompressor:
+    decompressor = _decompressors.get(dict_id)
+    if decompressor is None:
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=_dicts[dict_id] if dict_id is not None else None
+        )
+        _decompressors[dict_id] = decompressor
+    return decompressor
+
+
+def compress(text: str) -> Tuple[Optional[int], bytes]:
+    """(id словаря, сжатое тело) — последним известным словарём."""
+    dict_id = _current
+    return dict_id, _compressor(dict_id).compress(text.encode())
+
+
+def decompress(body: bytes, dict_id: Optional[int]) -> str:
+    """Словарь dict_id должен быть уже загружен (has_dictionary)."""
+    return _decompressor(dict_id).decompress(body).decode()
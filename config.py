@@ -1,4 +1,6 @@
 # config.py
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -10,9 +12,126 @@ class Settings(BaseSettings):
     db_name: str = "num_bot"
     db_user: str = "postgres"
     db_password: str
+    # приём апдейтов: polling — для локальной разработки, webhook — прод
+    bot_mode: Literal["polling", "webhook"] = "polling"
+    webhook_url: str = ""  # публичный https-адрес, например https://bot.example.com
+    webhook_path: str = "telegram"
+    webhook_listen: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_secret: str = ""  # X-Telegram-Bot-Api-Secret-Token
+    webhook_max_connections: int = 40
+    # параллельная обработка апдейтов (порядок внутри чата сохраняется)
+    update_concurrency: int = 32
+    update_backlog: int = 256  # принятых в работу, включая ждущих очереди в чате
+    shutdown_drain_timeout: float = 60.0  # дать доработать генерациям при остановке, сек
+    # пул соединений Postgres
+    db_pool_min_size: int = 2
+    db_pool_max_size: int = 10
+    db_pool_max_idle: float = 300.0  # закрывать простаивающие соединения, сек
+    db_command_timeout: float = 10.0
+    db_statement_cache_size: int = 100
+    db_close_timeout: float = 10.0
+    # user_data в Postgres
+    persistence_update_interval: float = 1.0  # как часто сбрасывать изменения, сек
+    persistence_cache_ttl: float = 5.0  # не перечитывать user_data из БД, сек
+    persistence_cache_size: int = 100_000
+    # очередь генерации отчётов
+    jobs_workers: int = 8  # воркеров в процессе
+    jobs_max_attempts: int = 3
+    jobs_visibility_timeout: float = 120.0  # аренда задания, продлевается, пока воркер жив
+    jobs_retry_backoff: float = 5.0  # пауза перед повтором, удваивается, сек
+    jobs_poll_interval: float = 1.0
+    jobs_retention_days: int = 7  # хранить выполненные задания
     # новые
     deepseek_url: str = "http://5.188.9.214:8000/v1/chat/completions"
     deepseek_timeout: int = 30
+    # пул HTTP-соединений к LLM
+    llm_pool_max_connections: int = 50
+    llm_pool_max_keepalive: int = 20
+    llm_pool_keepalive_expiry: float = 30.0
+    llm_deadline: float = 90.0  # общий бюджет на одну генерацию, сек
+    # планировщик запросов к LLM; лимиты на процесс, rps 0 — без квоты
+    llm_yandex_rps: float = 10.0
+    llm_yandex_burst: int = 20
+    llm_yandex_concurrency: int = 20
+    llm_deepseek_rps: float = 0.0
+    llm_deepseek_burst: int = 1
+    llm_deepseek_concurrency: int = 8  # по размеру батча сервера
+    llm_user_rate: float = 0.2  # запросов к LLM в секунду на пользователя
+    llm_user_burst: int = 20
+    llm_max_queue_wait: float = 30.0  # если у вызова нет своего дедлайна, сек
+    # учёт токенов и адаптивный max_tokens отчётов
+    llm_max_tokens: int = 2000  # потолок ответа, пока замеров мало
+    token_usage_window: int = 200  # последних ответов на (провайдер, режим)
+    token_usage_min_samples: int = 30
+    token_usage_percentile: float = 0.99
+    token_usage_headroom: float = 1.25  # запас над перцентилем длины ответа
+    token_usage_flush_interval: float = 10.0  # сброс в llm_usage, сек; 0 — не писать в БД
+    token_usage_retention_days: int = 90
+    # маршрутизация между YandexGPT и DeepSeek
+    router_window: int = 50  # последних запросов в статистике бэкенда
+    router_min_samples: int = 5
+    router_max_error_rate: float = 0.5
+    router_probe_interval: float = 30.0  # пробный запрос в «больной» бэкенд, сек
+
+    # ответы на сообщения без даты: пул заготовок и бюджет живых запросов
+    fallback_llm_rate: float = 0.2  # живых запросов к LLM в секунду на процесс, 0 — только пул
+    fallback_llm_burst: int = 5
+    fallback_pool_size: int = 8  # вариантов на намерение за одно обновление
+    fallback_pool_refresh: float = 21600.0  # обновлять пул раз в N сек, 0 — только ручные варианты
+
+    # хранилище отчётов: тела сжаты zstd со словарём и разбиты по месяцам
+    reports_zstd_level: int = 9
+    reports_dict_size: int = 32_768  # байт
+    reports_dict_samples: int = 2000  # последних отчётов для обучения словаря
+    reports_dict_min_samples: int = 100  # пока меньше — сжатие без словаря
+    reports_dict_retrain_days: int = 30
+    reports_retention_days: int = 365  # с последнего запроса, 0 — хранить вечно
+    reports_partitions_ahead: int = 2  # месячных секций тел заводить заранее
+    reports_compaction_batch: int = 500
+    reports_maintenance_interval: float = 21600.0  # 0 — не обслуживать из бота
+
+    # прогрев кеша отчётов в часы низкой нагрузки (локальное время сервера)
+    prewarm_budget: int = 300  # отчётов за одно окно на процесс, 0 — не прогревать
+    prewarm_window_start: int = 2  # час начала окна
+    prewarm_window_end: int = 7  # час конца окна (может быть меньше начала — через полночь)
+    prewarm_batch: int = 50  # отчётов за один проход
+    prewarm_concurrency: int = 2
+    prewarm_history_days: int = 30
+    prewarm_around_today: int = 3  # даты с днём рождения в пределах ±N дней от сегодня
+    prewarm_check_interval: float = 300.0
+
+    # перегенерация отчётов после смены версии промпта (regenerate.py)
+    regenerate_concurrency: int = 4
+    regenerate_batch: int = 100  # ключей за одно чтение очереди
+    regenerate_history_days: int = 30  # окно популярности дат
+
+    # потоковая выдача отчёта правками сообщения
+    stream_reports: bool = True
+    stream_edit_interval: float = 1.0  # не чаще одной правки в N сек
+
+    # исходящие сообщения: лимиты Bot API, сообщений в секунду
+    telegram_global_rate: float = 30.0
+    telegram_global_burst: int = 30
+    telegram_chat_rate: float = 1.0
+    telegram_group_rate: float = 0.33  # 20 в минуту
+    telegram_chat_burst: int = 3
+    telegram_send_retries: int = 3  # повторов после RetryAfter
+    telegram_max_retry_after: float = 60.0  # дольше не ждём, отдаём ошибку
+
+    # Prometheus: http://<host>:<port>/metrics, 0 — не поднимать
+    metrics_host: str = "0.0.0.0"
+    metrics_port: int = 9100
+
+    # кеш отчётов в памяти процесса
+    report_cache_size: int = 5000
+    report_cache_ttl: float = 3600.0
+
+    # сборка отчётов из фрагментов: пояснение к строке пишется один раз на значение
+    report_fragments: bool = False
+    report_fragments_intro: bool = False  # личные вступление и заключение — ещё один короткий запрос
+    fragment_cache_size: int = 20000
+    fragment_cache_ttl: float = 86400.0
 
     class Config:
         env_file = ".env"
@@ -1,19 +1,26 @@
-# date_parser.py  (natasha + цифровые regex + dateparser/dateutil)
+# date_parser.py  (natasha + цифровые regex, с дешёвым предфильтром)
 from __future__ import annotations
 import re
 from datetime import datetime
-from dateutil.parser import parse as du_parse, ParserError
-from dateparser import parse as dparse
-from natasha import DatesExtractor, MorphVocab
+from functools import lru_cache
 from typing import List, Set
 
-morph = MorphVocab()
-extractor = DatesExtractor(morph)
-
 # ---------- цифровые паттерны ----------
 NUM_RX = re.compile(
-    r'\b(?:0?[1-9]|[12]\d|3[01])[./\-](?:0?[1-9]|1[0-2])[./\-](?:\d{2}|\d{4})\b|\b(?:\d{4})[./\-](?:0?[1-9]|1[0-2])[./\-](?:0?[1-9]|[12]\d|3[01])\b'
+    r'\b(?P<d>0?[1-9]|[12]\d|3[01])[./\-](?P<m>0?[1-9]|1[0-2])[./\-](?P<y>\d{2}|\d{4})\b'
+    r'|\b(?P<y2>\d{4})[./\-](?P<m2>0?[1-9]|1[0-2])[./\-](?P<d2>0?[1-9]|[12]\d|3[01])\b'
+)
+
+# ---------- предфильтр ----------
+# Полная дата в любом из извлекателей содержит цифры (год всегда числом),
+# а словесная — ещё и название месяца. Без этого дорогие этапы не нужны.
+HAS_DIGIT_RX = re.compile(r'\d')
+MONTH_HINT_RX = re.compile(
+    r'янв|фев|мар|апр|ма[йяе]|июн|июл|авг|сен|окт|ноя|дек', flags=re.I
 )
+# Числовые даты в «рыхлом» виде (например, «01.05.2000г»), которые NUM_RX
+# не берёт, а Natasha может распознать.
+LOOSE_NUM_RX = re.compile(r'\d{1,4}[./\-]\d{1,2}[./\-]\d{1,4}')
 
 # ---------- словесные дни/месяцы ----------
 WORD_DAY = {
@@ -54,10 +61,18 @@ def _strict_word(text: str) -> Set[str]:
     return dates
 
 
+@lru_cache(maxsize=1)
+def _extractor():
+    """Natasha грузит словари долго — создаём при первом обращении."""
+    from natasha import DatesExtractor, MorphVocab
+
+    return DatesExtractor(MorphVocab())
+
+
 def _from_natasha(text: str) -> Set[str]:
     """Natasha: первое мая двухтысячного и т.д."""
     dates = set()
-    for match in extractor(text):
+    for match in _extractor()(text):
         d = match.fact
         if d.day and d.month and d.year:          # строго полная дата
             try:
@@ -68,20 +83,47 @@ def _from_natasha(text: str) -> Set[str]:
     return dates
 
 
+def _full_year(raw: str) -> int:
+    """Двузначный год по правилу strptime %y: 69–99 → 19xx, 00–68 → 20xx."""
+    year = int(raw)
+    if len(raw) == 2:
+        year += 1900 if year >= 69 else 2000
+    return year
+
+
 def _numeric(text: str) -> Set[str]:
-    """Цифровые паттерны через dateparser (без фантазий)."""
+    """Цифровые паттерны: группы регэкспа + проверка календарём (без фантазий)."""
     dates = set()
     for m in NUM_RX.finditer(text):
-        dt = dparse(m.group(0), settings={'DATE_ORDER': 'DMY', 'STRICT_PARSING': True})
-        if dt:
-            dates.add(f"{dt.day:02d}.{dt.month:02d}.{dt.year}")
+        if m.group('y') is not None:
+            day, month, year = m.group('d'), m.group('m'), _full_year(m.group('y'))
+        else:
+            day, month, year = m.group('d2'), m.group('m2'), int(m.group('y2'))
+        try:
+            dt = datetime(year=year, month=int(month), day=int(day))
+        except ValueError:
+            continue
+        dates.add(f"{dt.day:02d}.{dt.month:02d}.{dt.year}")
     return dates
 
 
-def find_dates(text: str) -> List[str]:
-    """Итог: только полные даты (день+месяц+год)."""
+def _find_dates_unfiltered(text: str) -> List[str]:
+    """Все извлекатели без предфильтра — эталон для bench_date_parser."""
     dates = set()
     dates.update(_strict_word(text))
     dates.update(_from_natasha(text))
     dates.update(_numeric(text))
+    return sorted(dates)
+
+
+def find_dates(text: str) -> List[str]:
+    """Итог: только полные даты (день+месяц+год)."""
+    if not HAS_DIGIT_RX.search(text):
+        return []
+    dates = _numeric(text)
+    if MONTH_HINT_RX.search(text):
+        dates.update(_strict_word(text))
+        dates.update(_from_natasha(text))
+    elif len(LOOSE_NUM_RX.findall(text)) > len(NUM_RX.findall(text)):
+        dates.update(_from_natasha(text))
     return sorted(dates)
\ No newline at end of file
@@ -1,53 +1,948 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from contextlib import contextmanager
+"""
+Асинхронный слой доступа к Postgres.
+Все обращения идут через общий пул asyncpg: соединения переиспользуются,
+а запросы выполняются как подготовленные выражения — asyncpg готовит
+их при первом вызове и держит в кеше выражений каждого соединения.
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import json
+import logging
+import re
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+from compression import (
+    body_hash,
+    compress,
+    current_dictionary,
+    decompress,
+    has_dictionary,
+    register_dictionary,
+)
 from config import settings
 
-@contextmanager
-def get_db_connection():
-    conn = psycopg2.connect(
+logger = logging.getLogger(__name__)
+
+_pool: Optional[asyncpg.Pool] = None
+
+# версия промпта, которой помечаются отчёты, перенесённые из старой схемы
+LEGACY_PROMPT_VERSION = 1
+
+# месячные секции report_bodies: report_bodies_YYYYMM
+BODY_PARTITION_RE = re.compile(r"^report_bodies_(\d{4})(\d{2})$")
+
+# ---------- SQL ----------
+# reports — общее хранилище: один отчёт на (дата, режим, ИИ, версия промпта),
+# потому что расчёт и структура отчёта зависят только от даты и режима.
+# Сама таблица — только ключ и ссылка на тело: тексты, сжатые zstd со
+# словарём (см. compression), лежат в report_bodies, одинаковые — один раз.
+# report_bodies разбита по месяцам created_at: срок хранения истекает
+# удалением целой секции, без DELETE и распухания таблицы. reports не
+# секционируется, чтобы поиск по ключу оставался одним индексным запросом.
+# report_text заполнен только у отчётов, записанных до сжатия, — их
+# переносит в report_bodies обслуживание (report_storage).
+# user_reports — тонкая история запросов пользователей со ссылкой на отчёт.
+# report_fragments — пояснения к отдельным строкам отчёта, из которых
+# собираются отчёты в режиме report_fragments (см. fragments.py).
+# llm_usage — расход токенов по запросам к моделям (см. token_usage.py).
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS report_dicts (
+        id SERIAL PRIMARY KEY,
+        dict BYTEA NOT NULL,
+        samples INT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS report_bodies (
+        hash BYTEA NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        dict_id INT REFERENCES report_dicts (id),
+        body BYTEA NOT NULL,
+        raw_size INT NOT NULL,
+        PRIMARY KEY (hash, created_at)
+    ) PARTITION BY RANGE (created_at);
+    CREATE TABLE IF NOT EXISTS report_bodies_default PARTITION OF report_bodies DEFAULT;
+
+    CREATE TABLE IF NOT EXISTS reports (
+        id BIGSERIAL PRIMARY KEY,
+        date_str TEXT NOT NULL,
+        mode TEXT NOT NULL CHECK (mode IN ('default', 'deep', 'master')),
+        ai TEXT NOT NULL,
+        prompt_version INT NOT NULL,
+        report_text TEXT,
+        body_hash BYTEA,
+        body_created_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+    ALTER TABLE reports ALTER COLUMN report_text DROP NOT NULL;
+    ALTER TABLE reports ADD COLUMN IF NOT EXISTS body_hash BYTEA;
+    ALTER TABLE reports ADD COLUMN IF NOT EXISTS body_created_at TIMESTAMP;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_reports_key
+        ON reports (date_str, mode, ai, prompt_version);
+    CREATE INDEX IF NOT EXISTS idx_reports_body
+        ON reports (body_hash, body_created_at) WHERE body_hash IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_reports_legacy
+        ON reports (id) WHERE body_hash IS NULL;
+
+    CREATE TABLE IF NOT EXISTS user_reports (
+        user_id BIGINT NOT NULL,
+        report_id BIGINT NOT NULL REFERENCES reports (id) ON DELETE CASCADE,
+        requested_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (user_id, report_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_reports_report
+        ON user_reports (report_id, requested_at);
+
+    CREATE TABLE IF NOT EXISTS report_fragments (
+        section TEXT NOT NULL,
+        value TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        ai TEXT NOT NULL,
+        prompt_version INT NOT NULL,
+        fragment TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (section, value, mode, ai, prompt_version)
+    );
+
+    CREATE TABLE IF NOT EXISTS llm_usage (
+        id BIGSERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        provider TEXT NOT NULL,
+        model TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        purpose TEXT NOT NULL,
+        prompt_tokens INT NOT NULL,
+        completion_tokens INT NOT NULL,
+        estimated BOOLEAN NOT NULL,
+        truncated BOOLEAN NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_llm_usage_created ON llm_usage (created_at);
+
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id BIGINT PRIMARY KEY,
+        data JSONB NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS generation_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        chat_id BIGINT NOT NULL,
+        date_str TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        ai TEXT NOT NULL,
+        priority SMALLINT NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'queued'
+            CHECK (status IN ('queued', 'running', 'done', 'failed')),
+        attempts INT NOT NULL DEFAULT 0,
+        max_attempts INT NOT NULL,
+        run_after TIMESTAMP NOT NULL DEFAULT NOW(),
+        locked_until TIMESTAMP,
+        last_error TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        finished_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_ready
+        ON generation_jobs (priority DESC, run_after, id)
+        WHERE status IN ('queued', 'running');
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active
+        ON generation_jobs (user_id, date_str, mode, ai)
+        WHERE status IN ('queued', 'running');
+"""
+
+# Старая схема: reports (user_id, date_str, mode, report_text).
+# Таблица переименовывается в reports_legacy, тексты переносятся в общее
+# хранилище (ИИ в старой схеме не записывался — считаем, что это yandex),
+# а пары пользователь–отчёт — в историю.
+_IS_LEGACY = """
+    SELECT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'reports' AND column_name = 'user_id'
+    );
+"""
+_RENAME_LEGACY = """
+    ALTER TABLE reports RENAME TO reports_legacy;
+    ALTER SEQUENCE IF EXISTS reports_id_seq RENAME TO reports_legacy_id_seq;
+    ALTER INDEX IF EXISTS reports_pkey RENAME TO reports_legacy_pkey;
+    ALTER INDEX IF EXISTS idx_user_date_mode RENAME TO idx_legacy_user_date_mode;
+"""
+_MIGRATE_LEGACY = """
+    INSERT INTO reports (date_str, mode, ai, prompt_version, report_text, created_at)
+    SELECT DISTINCT ON (date_str, mode)
+           date_str, mode, 'yandex', $1::INT, report_text, created_at
+    FROM reports_legacy
+    ORDER BY date_str, mode, created_at DESC
+    ON CONFLICT DO NOTHING;
+"""
+_MIGRATE_LEGACY_HISTORY = """
+    INSERT INTO user_reports (user_id, report_id, requested_at)
+    SELECT l.user_id, r.id, COALESCE(l.created_at, NOW())
+    FROM reports_legacy l
+    JOIN reports r
+      ON r.date_str = l.date_str AND r.mode = l.mode
+     AND r.ai = 'yandex' AND r.prompt_version = $1
+    ON CONFLICT DO NOTHING;
+"""
+# произвольная константа для pg_advisory_xact_lock: миграцию выполняет один процесс
+_MIGRATION_LOCK = 7_301_001
+
+# Поиск по уникальному индексу + тело по первичному ключу (секция
+# выбирается по body_created_at) + отметка в истории за один запрос.
+# Берётся самая новая версия промпта от $6 до $5: пока отчёт текущей
+# версии не написан, выдаётся предыдущий.
+_SELECT_REPORT = """
+    WITH hit AS (
+        SELECT r.id, r.prompt_version, r.report_text, b.body, b.dict_id
+        FROM reports r
+        LEFT JOIN report_bodies b
+          ON b.hash = r.body_hash AND b.created_at = r.body_created_at
+        WHERE r.date_str = $2 AND r.mode = $3 AND r.ai = $4
+          AND r.prompt_version BETWEEN $6 AND $5
+        ORDER BY r.prompt_version DESC
+        LIMIT 1
+    ), seen AS (
+        INSERT INTO user_reports (user_id, report_id)
+        SELECT $1::BIGINT, id FROM hit WHERE $1::BIGINT IS NOT NULL
+        ON CONFLICT (user_id, report_id) DO UPDATE SET requested_at = NOW()
+    )
+    SELECT prompt_version, report_text, body, dict_id FROM hit;
+"""
+# самая свежая копия тела: она переживёт срок хранения дольше остальных
+_FIND_BODY = """
+    SELECT created_at FROM report_bodies WHERE hash = $1
+    ORDER BY created_at DESC LIMIT 1;
+"""
+_INSERT_BODY = """
+    INSERT INTO report_bodies (hash, dict_id, body, raw_size)
+    VALUES ($1, $2, $3, $4)
+    RETURNING created_at;
+"""
+_INSERT_REPORT = """
+    WITH ins AS (
+        INSERT INTO reports (date_str, mode, ai, prompt_version, body_hash, body_created_at)
+        VALUES ($2, $3, $4, $5, $6, $7)
+        ON CONFLICT (date_str, mode, ai, prompt_version) DO UPDATE
+            SET body_hash = EXCLUDED.body_hash, body_created_at = EXCLUDED.body_created_at
+            -- ссылка осталась на тело из удалённой секции: чиним
+            WHERE reports.report_text IS NULL AND NOT EXISTS (
+                SELECT 1 FROM report_bodies b
+                WHERE b.hash = reports.body_hash AND b.created_at = reports.body_created_at
+            )
+        RETURNING id
+    ), rid AS (
+        SELECT id FROM ins
+        UNION ALL
+        SELECT id FROM reports
+        WHERE date_str = $2 AND mode = $3 AND ai = $4 AND prompt_version = $5
+    )
+    INSERT INTO user_reports (user_id, report_id)
+    SELECT $1::BIGINT, id FROM rid WHERE $1::BIGINT IS NOT NULL LIMIT 1
+    ON CONFLICT (user_id, report_id) DO UPDATE SET requested_at = NOW();
+"""
+_RECORD_REQUEST = """
+    INSERT INTO user_reports (user_id, report_id)
+    SELECT $1, id FROM reports
+    WHERE date_str = $2 AND mode = $3 AND ai = $4 AND prompt_version = $5
+    ON CONFLICT (user_id, report_id) DO UPDATE SET requested_at = NOW();
+"""
+
+# Обслуживание хранилища (report_storage)
+_SELECT_DICT = "SELECT dict FROM report_dicts WHERE id = $1;"
+_SELECT_CURRENT_DICT = "SELECT id, dict, created_at FROM report_dicts ORDER BY id DESC LIMIT 1;"
+_INSERT_DICT = "INSERT INTO report_dicts (dict, samples) VALUES ($1, $2) RETURNING id;"
+_DICT_SAMPLES = """
+    SELECT r.report_text, b.body, b.dict_id
+    FROM reports r
+    LEFT JOIN report_bodies b
+      ON b.hash = r.body_hash AND b.created_at = r.body_created_at
+    ORDER BY r.id DESC
+    LIMIT $1;
+"""
+_LEGACY_REPORTS = """
+    SELECT id, report_text FROM reports WHERE body_hash IS NULL ORDER BY id LIMIT $1;
+"""
+_MOVE_TO_BODY = """
+    UPDATE reports SET body_hash = $2, body_created_at = $3, report_text = NULL
+    WHERE id = $1;
+"""
+# тела, сжатые до появления первого словаря
+_UNCOMPRESSED_BODIES = """
+    SELECT hash, created_at, body FROM report_bodies WHERE dict_id IS NULL LIMIT $1;
+"""
+_RECOMPRESS_BODY = """
+    UPDATE report_bodies SET dict_id = $3, body = $4
+    WHERE hash = $1 AND created_at = $2;
+"""
+# отчёт живёт retention дней с последнего запроса (или с создания, если не запрашивали)
+_EXPIRE_REPORTS = """
+    DELETE FROM reports r
+    WHERE r.created_at < NOW() - make_interval(days => $1)
+      AND NOT EXISTS (
+        SELECT 1 FROM user_reports u
+        WHERE u.report_id = r.id AND u.requested_at >= NOW() - make_interval(days => $1)
+      );
+"""
+_DELETE_ORPHAN_BODIES = """
+    DELETE FROM report_bodies b
+    WHERE b.created_at < NOW() - INTERVAL '1 hour'
+      AND NOT EXISTS (
+        SELECT 1 FROM reports r
+        WHERE r.body_hash = b.hash AND r.body_created_at = b.created_at
+      );
+"""
+_DELETE_UNUSED_DICTS = """
+    DELETE FROM report_dicts d
+    WHERE d.id <> (SELECT MAX(id) FROM report_dicts)
+      AND NOT EXISTS (SELECT 1 FROM report_bodies b WHERE b.dict_id = d.id);
+"""
+_BODY_PARTITIONS = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = 'report_bodies';
+"""
+_RETENTION_CUTOFF = "SELECT (NOW() - make_interval(days => $1))::TIMESTAMP;"
+# {partition} подставляется только из имён, прошедших BODY_PARTITION_RE.
+# Живые тела секции — по одному на hash (копий одного текста может быть
+# несколько), порциями по возрастанию hash.
+_LIVE_BODIES = """
+    SELECT DISTINCT ON (b.hash) b.hash, b.dict_id, b.body
+    FROM {partition} b
+    WHERE b.hash > $1 AND EXISTS (
+        SELECT 1 FROM reports r
+        WHERE r.body_hash = b.hash AND r.body_created_at = b.created_at
+    )
+    ORDER BY b.hash
+    LIMIT $2;
+"""
+# копия тела, которая переживёт удаляемую секцию
+_NEWER_BODY = """
+    SELECT created_at FROM report_bodies WHERE hash = $1 AND created_at >= $2
+    ORDER BY created_at DESC LIMIT 1;
+"""
+_REPOINT_REPORTS = """
+    UPDATE reports SET body_created_at = $4
+    WHERE body_hash = $1 AND body_created_at >= $2 AND body_created_at < $3;
+"""
+
+# Спрос для прогрева кеша: популярность дат и доли пар (режим, ИИ) по истории
+# запросов за $1 дней — считаются отдельно, чтобы прогреть и те сочетания,
+# которые для популярной даты ещё не запрашивали.
+_DATE_DEMAND = """
+    SELECT r.date_str, COUNT(DISTINCT u.user_id) AS users
+    FROM user_reports u JOIN reports r ON r.id = u.report_id
+    WHERE u.requested_at > NOW() - make_interval(days => $1)
+    GROUP BY r.date_str
+    ORDER BY users DESC
+    LIMIT $2;
+"""
+_COMBO_DEMAND = """
+    SELECT r.mode, r.ai, COUNT(*) AS requests
+    FROM user_reports u JOIN reports r ON r.id = u.report_id
+    WHERE u.requested_at > NOW() - make_interval(days => $1)
+    GROUP BY r.mode, r.ai;
+"""
+_EXISTING_REPORTS = """
+    SELECT r.date_str, r.mode, r.ai
+    FROM unnest($2::TEXT[], $3::TEXT[], $4::TEXT[]) AS k (date_str, mode, ai)
+    JOIN reports r
+      ON r.date_str = k.date_str AND r.mode = k.mode AND r.ai = k.ai
+     AND r.prompt_version = $1;
+"""
+# Ключи (date_str, mode, ai), у которых нет отчёта версии $1, — по числу
+# разных пользователей за $2 дней: очередь перегенерации (regenerate.py).
+_OUTDATED_REPORTS = """
+    SELECT r.date_str, r.mode, r.ai,
+           MAX(r.prompt_version) AS prompt_version,
+           COUNT(DISTINCT u.user_id) AS users
+    FROM reports r
+    LEFT JOIN user_reports u
+      ON u.report_id = r.id AND u.requested_at > NOW() - make_interval(days => $2)
+    WHERE r.prompt_version < $1
+      AND NOT EXISTS (
+        SELECT 1 FROM reports c
+        WHERE c.date_str = r.date_str AND c.mode = r.mode AND c.ai = r.ai
+          AND c.prompt_version = $1
+      )
+    GROUP BY r.date_str, r.mode, r.ai
+    ORDER BY users DESC, r.date_str, r.mode, r.ai
+    LIMIT $3;
+"""
+
+# фрагменты отчётов — пачкой по парам (раздел, значение)
+_SELECT_FRAGMENTS = """
+    SELECT f.section, f.value, f.fragment
+    FROM unnest($4::TEXT[], $5::TEXT[]) AS k (section, value)
+    JOIN report_fragments f
+      ON f.section = k.section AND f.value = k.value
+     AND f.mode = $1 AND f.ai = $2 AND f.prompt_version = $3;
+"""
+_INSERT_FRAGMENTS = """
+    INSERT INTO report_fragments (section, value, mode, ai, prompt_version, fragment)
+    SELECT k.section, k.value, $1, $2, $3, k.fragment
+    FROM unnest($4::TEXT[], $5::TEXT[], $6::TEXT[]) AS k (section, value, fragment)
+    ON CONFLICT DO NOTHING;
+"""
+
+# расход токенов
+_INSERT_USAGE = """
+    INSERT INTO llm_usage (
+        provider, model, mode, purpose, prompt_tokens, completion_tokens, estimated, truncated
+    )
+    SELECT * FROM unnest(
+        $1::TEXT[], $2::TEXT[], $3::TEXT[], $4::TEXT[], $5::INT[], $6::INT[], $7::BOOL[], $8::BOOL[]
+    );
+"""
+# последние ответы каждой пары (провайдер, режим) — окна адаптивного max_tokens
+_RECENT_USAGE = """
+    SELECT provider, mode, completion_tokens, truncated
+    FROM (
+        SELECT provider, mode, completion_tokens, truncated, created_at,
+               row_number() OVER (PARTITION BY provider, mode ORDER BY created_at DESC) AS n
+        FROM llm_usage
+        WHERE purpose = $1 AND created_at > NOW() - make_interval(days => $3)
+    ) recent
+    WHERE n <= $2
+    ORDER BY created_at;
+"""
+_USAGE_SUMMARY = """
+    SELECT provider, mode, purpose,
+           COUNT(*) AS requests,
+           SUM(prompt_tokens) AS prompt_tokens,
+           SUM(completion_tokens) AS completion_tokens,
+           percentile_disc(0.5) WITHIN GROUP (ORDER BY completion_tokens) AS completion_p50,
+           percentile_disc(0.99) WITHIN GROUP (ORDER BY completion_tokens) AS completion_p99,
+           AVG(estimated::INT) AS estimated_share,
+           AVG(truncated::INT) AS truncated_share
+    FROM llm_usage
+    WHERE created_at > NOW() - make_interval(days => $1)
+    GROUP BY provider, mode, purpose
+    ORDER BY provider, mode, purpose;
+"""
+_PURGE_USAGE = "DELETE FROM llm_usage WHERE created_at < NOW() - make_interval(days => $1);"
+
+# user_data из telegram.ext (режим, модель, последняя дата) — пачкой за один запрос
+_SELECT_USER_DATA = "SELECT data FROM user_data WHERE user_id = $1;"
+_UPSERT_USER_DATA = """
+    INSERT INTO user_data (user_id, data)
+    SELECT * FROM unnest($1::BIGINT[], $2::JSONB[])
+    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW();
+"""
+_DELETE_USER_DATA = "DELETE FROM user_data WHERE user_id = ANY($1::BIGINT[]);"
+
+# Очередь генерации. Пара (id, attempts) — аренда задания: после захвата
+# другим воркером (по истечении locked_until) attempts растёт, и запоздалые
+# продления и отметки прежнего владельца ничего не меняют.
+_ENQUEUE_JOB = """
+    INSERT INTO generation_jobs (user_id, chat_id, date_str, mode, ai, priority, max_attempts)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (user_id, date_str, mode, ai) WHERE status IN ('queued', 'running')
+    DO NOTHING
+    RETURNING id;
+"""
+_CLAIM_JOB = """
+    UPDATE generation_jobs
+    SET status = 'running', attempts = attempts + 1,
+        locked_until = NOW() + make_interval(secs => $1)
+    WHERE id = (
+        SELECT id FROM generation_jobs
+        WHERE (status = 'queued' AND run_after <= NOW())
+           OR (status = 'running' AND locked_until < NOW())
+        ORDER BY priority DESC, run_after, id
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING id, user_id, chat_id, date_str, mode, ai, priority, attempts, max_attempts;
+"""
+_EXTEND_JOB = """
+    UPDATE generation_jobs SET locked_until = NOW() + make_interval(secs => $3)
+    WHERE id = $1 AND attempts = $2 AND status = 'running';
+"""
+_FINISH_JOB = """
+    UPDATE generation_jobs
+    SET status = $3, last_error = $4, locked_until = NULL, finished_at = NOW()
+    WHERE id = $1 AND attempts = $2 AND status = 'running';
+"""
+_RETRY_JOB = """
+    UPDATE generation_jobs
+    SET status = 'queued', last_error = $4, locked_until = NULL,
+        run_after = NOW() + make_interval(secs => $3)
+    WHERE id = $1 AND attempts = $2 AND status = 'running';
+"""
+# остановка процесса: задание возвращается в очередь без траты попытки
+_RELEASE_JOB = """
+    UPDATE generation_jobs
+    SET status = 'queued', attempts = attempts - 1, locked_until = NULL
+    WHERE id = $1 AND attempts = $2 AND status = 'running';
+"""
+_PURGE_JOBS = """
+    DELETE FROM generation_jobs
+    WHERE status IN ('done', 'failed') AND finished_at < NOW() - make_interval(days => $1);
+"""
+
+
+# ---------- Пул ----------
+def get_pool() -> asyncpg.Pool:
+    if _pool is None:
+        raise RuntimeError("Пул БД не инициализирован: вызовите init_db()")
+    return _pool
+
+
+async def init_db() -> None:
+    """Создаёт пул и схему. Вызывается один раз из post_init приложения."""
+    global _pool
+    if _pool is not None:
+        return
+    _pool = await asyncpg.create_pool(
         host=settings.db_host,
         port=settings.db_port,
-        dbname=settings.db_name,
+        database=settings.db_name,
         user=settings.db_user,
-        password=settings.db_password
+        password=settings.db_password,
+        min_size=settings.db_pool_min_size,
+        max_size=settings.db_pool_max_size,
+        max_inactive_connection_lifetime=settings.db_pool_max_idle,
+        command_timeout=settings.db_command_timeout,
+        statement_cache_size=settings.db_statement_cache_size,
     )
+    async with _pool.acquire() as conn:
+        await _migrate(conn)
+    await load_current_dictionary()
+    logger.info(
+        "Пул БД готов (min=%s, max=%s)",
+        settings.db_pool_min_size,
+        settings.db_pool_max_size,
+    )
+
+
+async def _migrate(conn: asyncpg.Connection) -> None:
+    """Создаёт схему и однократно переносит данные из старой таблицы reports."""
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1);", _MIGRATION_LOCK)
+        legacy = await conn.fetchval(_IS_LEGACY)
+        if legacy:
+            await conn.execute(_RENAME_LEGACY)
+        await conn.execute(_SCHEMA)
+        await _create_body_partitions(conn, settings.reports_partitions_ahead)
+        if legacy:
+            await conn.execute(_MIGRATE_LEGACY, LEGACY_PROMPT_VERSION)
+            await conn.execute(_MIGRATE_LEGACY_HISTORY, LEGACY_PROMPT_VERSION)
+            logger.info("Старые отчёты перенесены в общее хранилище")
+
+
+async def close_db() -> None:
+    """Корректно закрывает пул: дожидается возврата активных соединений."""
+    global _pool
+    if _pool is None:
+        return
+    pool, _pool = _pool, None
+    try:
+        await asyncio.wait_for(pool.close(), settings.db_close_timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Пул БД не закрылся за %s сек, обрываем", settings.db_close_timeout)
+        pool.terminate()
+    logger.info("Пул БД закрыт")
+
+
+async def check_db() -> bool:
+    """Health-check: пул жив и Postgres отвечает."""
     try:
-        yield conn
-    finally:
-        conn.close()
-
-def init_db():
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS reports (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    date_str TEXT NOT NULL,
-                    mode TEXT NOT NULL CHECK (mode IN ('default', 'deep', 'master')),
-                    report_text TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
-                CREATE UNIQUE INDEX IF NOT EXISTS idx_user_date_mode ON reports (user_id, date_str, mode);
-            """)
-            conn.commit()
-
-def get_cached_report(user_id: int, date_str: str, mode: str) -> str | None:
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "SELECT report_text FROM reports WHERE user_id = %s AND date_str = %s AND mode = %s;",
-                (user_id, date_str, mode)
+        async with get_pool().acquire(timeout=settings.db_command_timeout) as conn:
+            return await conn.fetchval("SELECT 1;") == 1
+    except Exception as exc:
+        logger.warning("БД недоступна: %r", exc)
+        return False
+
+
+# ---------- Отчёты ----------
+async def get_cached_report(
+    user_id: int | None,
+    date_str: str,
+    mode: str,
+    ai: str,
+    prompt_version: int,
+    oldest_version: int | None = None,
+) -> Tuple[str, int] | None:
+    """
+    Общий для всех пользователей отчёт и его версия промпта: самой новой
+    из prompt_version..oldest_version (по умолчанию — только prompt_version).
+    Попадание пишется в историю user_id.
+    """
+    row = await get_pool().fetchrow(
+        _SELECT_REPORT,
+        user_id,
+        date_str,
+        mode,
+        ai,
+        prompt_version,
+        prompt_version if oldest_version is None else oldest_version,
+    )
+    if row is None:
+        return None
+    if row["body"] is None:
+        # записан до сжатия, или тело ушло вместе с секцией — тогда промах
+        text = row["report_text"]
+    else:
+        await _ensure_dictionary(row["dict_id"])
+        text = decompress(row["body"], row["dict_id"])
+    return None if text is None else (text, row["prompt_version"])
+
+
+async def save_report(
+    user_id: int | None,
+    date_str: str,
+    mode: str,
+    ai: str,
+    prompt_version: int,
+    report_text: str,
+):
+    """Сохраняет отчёт в общее хранилище (если его ещё нет) и в историю user_id."""
+    async with get_pool().acquire() as conn, conn.transaction():
+        digest, created_at = await _store_body(conn, report_text)
+        await conn.execute(
+            _INSERT_REPORT, user_id, date_str, mode, ai, prompt_version, digest, created_at
+        )
+
+
+async def _store_body(
+    conn: asyncpg.Connection, text: str, reuse: bool = True
+) -> Tuple[bytes, dt.datetime]:
+    """(hash, created_at) тела: существующего с тем же текстом или нового."""
+    digest = body_hash(text)
+    if reuse:
+        created_at = await conn.fetchval(_FIND_BODY, digest)
+        if created_at is not None:
+            return digest, created_at
+    dict_id, body = compress(text)
+    created_at = await conn.fetchval(_INSERT_BODY, digest, dict_id, body, len(text.encode()))
+    return digest, created_at
+
+
+async def record_report_request(
+    user_id: int, date_str: str, mode: str, ai: str, prompt_version: int
+) -> None:
+    """Отмечает в истории отчёт, выданный из кеша процесса без чтения из БД."""
+    await get_pool().execute(
+        _RECORD_REQUEST, user_id, date_str, mode, ai, prompt_version
+    )
+
+
+# ---------- Фрагменты отчётов ----------
+async def get_fragments(
+    mode: str, ai: str, prompt_version: int, keys: List[Tuple[str, str]]
+) -> Dict[Tuple[str, str], str]:
+    """Готовые пояснения для пар (раздел, значение)."""
+    if not keys:
+        return {}
+    sections, values = (list(col) for col in zip(*keys))
+    rows = await get_pool().fetch(_SELECT_FRAGMENTS, mode, ai, prompt_version, sections, values)
+    return {(r["section"], r["value"]): r["fragment"] for r in rows}
+
+
+async def save_fragments(
+    mode: str, ai: str, prompt_version: int, fragments: Dict[Tuple[str, str], str]
+) -> None:
+    """Первое записанное пояснение остаётся: отчёты, уже собранные из него, не расходятся."""
+    if not fragments:
+        return
+    sections, values = (list(col) for col in zip(*fragments))
+    await get_pool().execute(
+        _INSERT_FRAGMENTS, mode, ai, prompt_version, sections, values, list(fragments.values())
+    )
+
+
+# ---------- Расход токенов ----------
+async def save_usage(rows: List[tuple]) -> None:
+    """rows — (provider, model, mode, purpose, prompt, completion, estimated, truncated)."""
+    if not rows:
+        return
+    await get_pool().execute(_INSERT_USAGE, *(list(col) for col in zip(*rows)))
+
+
+async def recent_usage(purpose: str, per_key: int, days: int) -> List[asyncpg.Record]:
+    return await get_pool().fetch(_RECENT_USAGE, purpose, per_key, days)
+
+
+async def usage_summary(days: int) -> List[asyncpg.Record]:
+    return await get_pool().fetch(_USAGE_SUMMARY, days)
+
+
+async def purge_usage(older_than_days: int) -> int:
+    return _rowcount(await get_pool().execute(_PURGE_USAGE, older_than_days))
+
+
+# ---------- Хранилище отчётов ----------
+async def _ensure_dictionary(dict_id: Optional[int]) -> None:
+    if has_dictionary(dict_id):
+        return
+    data = await get_pool().fetchval(_SELECT_DICT, dict_id)
+    register_dictionary(dict_id, data)
+
+
+async def load_current_dictionary() -> Optional[dt.datetime]:
+    """Подхватывает последний словарь для записи; время его обучения или None."""
+    row = await get_pool().fetchrow(_SELECT_CURRENT_DICT)
+    if row is None:
+        return None
+    register_dictionary(row["id"], row["dict"], current=True)
+    return row["created_at"]
+
+
+async def add_dictionary(data: bytes, samples: int) -> int:
+    dict_id = await get_pool().fetchval(_INSERT_DICT, data, samples)
+    register_dictionary(dict_id, data, current=True)
+    return dict_id
+
+
+async def dictionary_samples(limit: int) -> List[str]:
+    """Тексты последних отчётов — корпус для обучения словаря."""
+    rows = await get_pool().fetch(_DICT_SAMPLES, limit)
+    samples = []
+    for row in rows:
+        if row["body"] is not None:
+            await _ensure_dictionary(row["dict_id"])
+            samples.append(decompress(row["body"], row["dict_id"]))
+        elif row["report_text"]:
+            samples.append(row["report_text"])
+    return samples
+
+
+async def compact_legacy_reports(limit: int) -> int:
+    """Переносит до limit текстов из reports.report_text в сжатые тела."""
+    async with get_pool().acquire() as conn, conn.transaction():
+        rows = await conn.fetch(_LEGACY_REPORTS, limit)
+        for row in rows:
+            digest, created_at = await _store_body(conn, row["report_text"])
+            await conn.execute(_MOVE_TO_BODY, row["id"], digest, created_at)
+    return len(rows)
+
+
+async def recompress_bodies(limit: int) -> int:
+    """Пережимает словарём тела, сжатые без него; 0 — словаря ещё нет."""
+    dict_id = current_dictionary()
+    if dict_id is None:
+        return 0
+    async with get_pool().acquire() as conn, conn.transaction():
+        rows = await conn.fetch(_UNCOMPRESSED_BODIES, limit)
+        for row in rows:
+            text = decompress(row["body"], None)
+            await conn.execute(
+                _RECOMPRESS_BODY, row["hash"], row["created_at"], *compress(text)
             )
-            row = cur.fetchone()
-            return row["report_text"] if row else None
-
-def save_report(user_id: int, date_str: str, mode: str, report_text: str):
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO reports (user_id, date_str, mode, report_text) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING;",
-                (user_id, date_str, mode, report_text)
+    return len(rows)
+
+
+def _rowcount(status: str) -> int:
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def expire_reports(days: int) -> int:
+    return _rowcount(await get_pool().execute(_EXPIRE_REPORTS, days))
+
+
+async def delete_orphan_bodies() -> int:
+    return _rowcount(await get_pool().execute(_DELETE_ORPHAN_BODIES))
+
+
+async def delete_unused_dictionaries() -> int:
+    return _rowcount(await get_pool().execute(_DELETE_UNUSED_DICTS))
+
+
+def _month(day: dt.date, shift: int = 0) -> dt.date:
+    index = day.year * 12 + day.month - 1 + shift
+    return dt.date(index // 12, index % 12 + 1, 1)
+
+
+async def _create_body_partitions(conn: asyncpg.Connection, months_ahead: int) -> None:
+    """Секции report_bodies с текущего месяца на months_ahead вперёд."""
+    this_month = _month(dt.date.today())
+    for shift in range(months_ahead + 1):
+        start, end = _month(this_month, shift), _month(this_month, shift + 1)
+        name = f"report_bodies_{start:%Y%m}"
+        try:
+            async with conn.transaction():
+                await conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF report_bodies "
+                    f"FOR VALUES FROM ('{start}') TO ('{end}');"
+                )
+        except asyncpg.CheckViolationError:
+            # тела этого месяца уже попали в секцию по умолчанию
+            logger.warning("Не удалось создать секцию %s: есть строки в report_bodies_default", name)
+
+
+async def ensure_body_partitions(months_ahead: int) -> None:
+    async with get_pool().acquire() as conn:
+        await _create_body_partitions(conn, months_ahead)
+
+
+async def _move_live_bodies(
+    conn: asyncpg.Connection, name: str, start: dt.datetime, end: dt.datetime
+) -> int:
+    """
+    Переводит отчёты с тел секции name ([start, end)) на копии вне её:
+    существующие или новые, пережатые последним словарём. Каждая порция —
+    своя короткая транзакция (внутри уже открытой — точка сохранения).
+    """
+    after = b""
+    moved = 0
+    while True:
+        async with conn.transaction():
+            rows = await conn.fetch(
+                _LIVE_BODIES.format(partition=name), after, settings.reports_compaction_batch
             )
-            conn.commit()
\ No newline at end of file
+            for body in rows:
+                created_at = await conn.fetchval(_NEWER_BODY, body["hash"], end)
+                if created_at is None:
+                    await _ensure_dictionary(body["dict_id"])
+                    text = decompress(body["body"], body["dict_id"])
+                    _, created_at = await _store_body(conn, text, reuse=False)
+                await conn.execute(_REPOINT_REPORTS, body["hash"], start, end, created_at)
+        moved += len(rows)
+        if len(rows) < settings.reports_compaction_batch:
+            return moved
+        after = rows[-1]["hash"]
+
+
+async def drop_expired_partitions(days: int) -> List[str]:
+    """
+    Удаляет месячные секции тел, целиком старше days дней. Тела, на которые
+    ещё ссылаются отчёты, сначала копируются в текущую секцию порциями, без
+    блокировки секции; ACCESS EXCLUSIVE берётся только на перенос ссылок,
+    появившихся за это время, и DROP.
+    """
+    pool = get_pool()
+    cutoff = await pool.fetchval(_RETENTION_CUTOFF, days)
+    dropped = []
+    for row in await pool.fetch(_BODY_PARTITIONS):
+        name = row["relname"]
+        match = BODY_PARTITION_RE.match(name)
+        if match is None:
+            continue
+        month = dt.date(int(match[1]), int(match[2]), 1)
+        start = dt.datetime.combine(month, dt.time())
+        end = dt.datetime.combine(_month(month, 1), dt.time())
+        if end > cutoff:
+            continue
+        async with pool.acquire() as conn:
+            moved = await _move_live_bodies(conn, name, start, end)
+            async with conn.transaction():
+                # новые ссылки на тела этой секции не появятся, пока она не удалена
+                await conn.execute(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE;")
+                moved += await _move_live_bodies(conn, name, start, end)
+                await conn.execute(f"DROP TABLE {name};")
+        logger.info("Секция %s удалена, перенесено тел: %s", name, moved)
+        dropped.append(name)
+    return dropped
+
+
+# ---------- Спрос на отчёты ----------
+async def date_demand(days: int, limit: int) -> List[asyncpg.Record]:
+    """Самые популярные даты: (date_str, users) по числу разных пользователей."""
+    return await get_pool().fetch(_DATE_DEMAND, days, limit)
+
+
+async def combo_demand(days: int) -> List[asyncpg.Record]:
+    """Сколько раз запрашивали каждую пару (mode, ai)."""
+    return await get_pool().fetch(_COMBO_DEMAND, days)
+
+
+async def existing_reports(
+    keys: List[Tuple[str, str, str]], prompt_version: int
+) -> Set[Tuple[str, str, str]]:
+    """Какие из ключей (date_str, mode, ai) уже есть для prompt_version."""
+    if not keys:
+        return set()
+    dates, modes, ais = (list(col) for col in zip(*keys))
+    rows = await get_pool().fetch(_EXISTING_REPORTS, prompt_version, dates, modes, ais)
+    return {(r["date_str"], r["mode"], r["ai"]) for r in rows}
+
+
+async def outdated_reports(prompt_version: int, days: int, limit: int) -> List[asyncpg.Record]:
+    """(date_str, mode, ai, prompt_version, users) ключей без отчёта prompt_version."""
+    return await get_pool().fetch(_OUTDATED_REPORTS, prompt_version, days, limit)
+
+
+@asynccontextmanager
+async def advisory_lock(key: int) -> AsyncIterator[bool]:
+    """
+    Сессионная advisory-блокировка на время блока; False — её держит другой
+    процесс. Соединение занято, пока блок не завершится.
+    """
+    async with get_pool().acquire() as conn:
+        locked = await conn.fetchval("SELECT pg_try_advisory_lock($1);", key)
+        try:
+            yield locked
+        finally:
+            if locked:
+                await conn.execute("SELECT pg_advisory_unlock($1);", key)
+
+
+# ---------- Данные пользователей ----------
+async def load_user_data(user_id: int) -> dict | None:
+    raw = await get_pool().fetchval(_SELECT_USER_DATA, user_id)
+    return None if raw is None else json.loads(raw)
+
+
+async def save_user_data(batch: Dict[int, dict]) -> None:
+    """Upsert пачки user_data одним запросом."""
+    if not batch:
+        return
+    await get_pool().execute(
+        _UPSERT_USER_DATA,
+        list(batch),
+        [json.dumps(data, ensure_ascii=False) for data in batch.values()],
+    )
+
+
+async def delete_user_data(user_ids: List[int]) -> None:
+    if user_ids:
+        await get_pool().execute(_DELETE_USER_DATA, user_ids)
+
+
+# ---------- Очередь генерации ----------
+async def enqueue_job(
+    user_id: int,
+    chat_id: int,
+    date_str: str,
+    mode: str,
+    ai: str,
+    priority: int,
+    max_attempts: int,
+) -> int | None:
+    """id нового задания; None, если такое же уже ждёт или выполняется."""
+    return await get_pool().fetchval(
+        _ENQUEUE_JOB, user_id, chat_id, date_str, mode, ai, priority, max_attempts
+    )
+
+
+async def claim_job(visibility_timeout: float) -> asyncpg.Record | None:
+    """Самое приоритетное готовое задание, арендованное на visibility_timeout сек."""
+    return await get_pool().fetchrow(_CLAIM_JOB, visibility_timeout)
+
+
+async def extend_job(job_id: int, attempts: int, visibility_timeout: float) -> None:
+    await get_pool().execute(_EXTEND_JOB, job_id, attempts, visibility_timeout)
+
+
+async def finish_job(job_id: int, attempts: int, status: str, error: str | None = None) -> None:
+    """status — 'done' или 'failed'."""
+    await get_pool().execute(_FINISH_JOB, job_id, attempts, status, error)
+
+
+async def retry_job(job_id: int, attempts: int, delay: float, error: str) -> None:
+    await get_pool().execute(_RETRY_JOB, job_id, attempts, delay, error)
+
+
+async def release_job(job_id: int, attempts: int) -> None:
+    await get_pool().execute(_RELEASE_JOB, job_id, attempts)
+
+
+async def purge_jobs(older_than_days: int) -> None:
+    await get_pool().execute(_PURGE_JOBS, older_than_days)
@@ -0,0 +1,152 @@
+# /sdd/bots/num_bot_doubleAI_app/deepseek-v3/batching.py
+"""
+Динамический батчинг запросов к модели.
+Запросы, пришедшие в пределах max_wait от первого, собираются в пачку
+до max_batch_size и выполняются одним вызовом run_batch в отдельном
+потоке, чтобы не блокировать event loop. Пока пачка считается, новые
+запросы копятся в очереди и уходят следующей пачкой.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from prometheus_client import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = Gauge("deepseek_queue_depth", "Запросы, ожидающие пачку")
+BATCH_SIZE = Histogram(
+    "deepseek_batch_size",
+    "Число запросов в пачке generate",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32),
+)
+QUEUE_WAIT = Histogram(
+    "deepseek_queue_wait_seconds", "Ожидание запроса в очереди до начала пачки"
+)
+BATCH_SECONDS = Histogram(
+    "deepseek_batch_seconds",
+    "Время одного батчевого generate",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    max_tokens: int
+    temperature: float
+    future: asyncio.Future
+    key: Hashable = None  # запросы с разными key в одну пачку не попадают
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class Completion:
+    text: str  # у потокового запроса пуст: текст ушёл в поток
+    prompt_tokens: int
+    completion_tokens: int
+    finish_reason: str  # stop | length — упёрлись в max_tokens
+
+
+class BatchScheduler:
+    def __init__(
+        self,
+        run_batch: Callable[[List[GenerationRequest]], List[Completion]],
+        max_batch_size: int = 8,
+        max_wait: float = 0.02,
+    ) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # модель одна — пачки выполняются строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        QUEUE_DEPTH.set_function(self._queue.qsize)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def submit(
+        self, prompt: str, max_tokens: int, temperature: float, key: Hashable = None
+    ) -> Completion:
+        """Ставит запрос в очередь и ждёт его часть результата пачки."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(
+            GenerationRequest(prompt, max_tokens, temperature, future, key)
+        )
+        return await future
+
+    async def run_exclusive(self, fn: Callable, *args):
+        """
+        Выполняет fn в потоке планировщика между пачками — для потоковых
+        запросов, которые нельзя склеить в батч, но и нельзя пускать
+        на модель параллельно с ним.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    async def _collect(self) -> List[GenerationRequest]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # клиент мог отключиться, пока запрос ждал в очереди
+        return [r for r in batch if not r.future.done()]
+
+    @staticmethod
+    def _group(batch: List[GenerationRequest]) -> List[List[GenerationRequest]]:
+        """
+        generate принимает одну temperature на вызов, а общий KV-префикс
+        должен быть одинаковым у всей пачки — делим по (temperature, key).
+        """
+        groups: Dict[Tuple[float, Hashable], List[GenerationRequest]] = {}
+        for r in batch:
+            groups.setdefault((r.temperature, r.key), []).append(r)
+        return list(groups.values())
+
+    async def _loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            for group in self._group(batch):
+                started = time.monotonic()
+                for r in group:
+                    QUEUE_WAIT.observe(started - r.enqueued_at)
+                BATCH_SIZE.observe(len(group))
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor, self.run_batch, group
+                    )
+                except Exception as exc:
+                    logger.exception("Batch generate failed")
+                    for r in group:
+                        if not r.future.done():
+                            r.future.set_exception(exc)
+                    continue
+                finally:
+                    BATCH_SECONDS.observe(time.monotonic() - started)
+                for r, completion in zip(group, results):
+                    if not r.future.done():
+                        r.future.set_result(completion)
@@ -0,0 +1,139 @@
+# /sdd/bots/num_bot_doubleAI_app/deepseek-v3/bench_precision.py
+"""
+Бенчмарк режимов точности и KV-кеша префикса на CPU.
+Каждая конфигурация запускается в отдельном процессе (чтобы память
+одной модели не влияла на замер другой) и печатает строку JSON:
+prefill-латентность полного промпта и только хвоста при кешированном
+префиксе, скорость генерации (токенов/с) и резидентную память.
+
+    python bench_precision.py [--precisions fp32,bf16,int8] [--new-tokens 64]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODEL_PATH = os.getenv("MODEL_PATH", "/app")
+DEVICE = os.getenv("DEVICE", "cpu")
+
+# Типичный промпт бота: инструкция (общий префикс) + раздел «Данные».
+PREFIX = (
+    "Ты — эзотерический нумеролог. Напиши полный эзотерический портрет по методике "
+    "Хшановской на основе данных ниже. Говори мягко, вдохновляюще, наставнически. "
+    "Не задавай вопросов, не ссылайся на источники, не философствуй. "
+    "не удаляя эмодзи-иконки и не меняя заголовки. "
+    "Добавь по 1-3 предложения под каждым пунктом, сохрани формат «эмодзи + заголовок».\n\n"
+    "Заверши текст: «Если почувствуешь, что это о тебе — это не совпадение. "
+    "Всё записано в дате.» «Если ты узнал себя — поставь ⭐ или сохрани расклад.»\n\n"
+    "Данные:\n"
+)
+DATA = (
+    "🔮 Число Судьбы: 7\n🎯 Миссия: Реализация потенциала числа 7\n"
+    "🧩 Психоматрица: {'1': 5, '2': 6, '3': 5}\n☀️ Код дня: 6\n🌙 Код месяца: 6\n"
+    "🪐 Код года: 5\n🌟 Архетипический путь души: Путь 7: Проводник света"
+)
+
+
+def _rss_mb(field: str = "VmRSS") -> float:
+    """Текущая (VmRSS) или пиковая за жизнь процесса (VmHWM) резидентная память."""
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _median_sec(fn, repeats: int) -> float:
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def run_one(precision: str, new_tokens: int, repeats: int) -> dict:
+    import torch
+
+    from model_loader import load_model
+    from prefix_cache import PrefixCache
+
+    start = time.perf_counter()
+    tokenizer, model = load_model(MODEL_PATH, DEVICE, precision)
+    load_sec = time.perf_counter() - start
+    rss_loaded = _rss_mb()
+
+    prompt = PREFIX + DATA
+    full = tokenizer(prompt, return_tensors="pt").to(DEVICE)
+    cache = PrefixCache(tokenizer, model, DEVICE, [PREFIX])
+    entry = cache.entries[0]
+    suffix = torch.tensor([cache.suffix_ids(0, prompt)], device=DEVICE)
+
+    with torch.no_grad():
+        prefill_full = _median_sec(lambda: model(**full, use_cache=True), repeats)
+        prefill_suffix = _median_sec(
+            lambda: model(
+                input_ids=suffix,
+                past_key_values=entry.cache_for_batch(1),
+                use_cache=True,
+            ),
+            repeats,
+        )
+        start = time.perf_counter()
+        out = model.generate(
+            **full,
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        gen_sec = time.perf_counter() - start
+    produced = out.shape[1] - full.input_ids.shape[1]
+
+    return {
+        "precision": precision,
+        "load_sec": round(load_sec, 2),
+        "prompt_tokens": full.input_ids.shape[1],
+        "prefix_tokens": len(entry),
+        "prefill_full_ms": round(prefill_full * 1000, 1),
+        "prefill_cached_prefix_ms": round(prefill_suffix * 1000, 1),
+        "tokens_per_sec": round(produced / gen_sec, 2),
+        "rss_loaded_mb": round(rss_loaded, 1),
+        "rss_peak_mb": round(_rss_mb("VmHWM"), 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precisions", default="fp32,bf16,int8")
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--run", help=argparse.SUPPRESS)  # дочерний процесс
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_one(args.run, args.new_tokens, args.repeats)))
+        return
+
+    for precision in args.precisions.split(","):
+        proc = subprocess.run(
+            [
+                sys.executable, __file__,
+                "--run", precision,
+                "--new-tokens", str(args.new_tokens),
+                "--repeats", str(args.repeats),
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            print(json.dumps({"precision": precision, "error": proc.stderr[-500:]}))
+            continue
+        print(proc.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# /sdd/bots/num_bot_doubleAI_app/deepseek-v3/model_loader.py
+"""
+Загрузка токенизатора и модели с выбранной точностью.
+На CPU по умолчанию float32; CPU_PRECISION=bf16 грузит веса в bfloat16,
+CPU_PRECISION=int8 — float32 с динамической int8-квантизацией Linear-слоёв
+(веса int8, активации квантуются на лету). На cuda — float16, как раньше.
+"""
+from typing import Tuple
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def load_model(path: str, device: str, precision: str = "fp32") -> Tuple:
+    if precision not in PRECISIONS:
+        raise ValueError(f"CPU_PRECISION должна быть одной из {PRECISIONS}: {precision}")
+
+    tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+    # для батча промпты выравниваются слева, чтобы генерация шла с одной позиции
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    if "cuda" in device:
+        dtype = torch.float16
+    elif precision == "bf16":
+        dtype = torch.bfloat16
+    else:
+        dtype = torch.float32
+
+    model = AutoModelForCausalLM.from_pretrained(
+        path, torch_dtype=dtype, trust_remote_code=True
+    ).to(device)
+    model.eval()
+
+    if precision == "int8" and "cuda" not in device:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return tokenizer, model
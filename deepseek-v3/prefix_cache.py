@@ -0,0 +1,84 @@
+# /sdd/bots/num_bot_doubleAI_app/deepseek-v3/prefix_cache.py
+"""
+KV-кеш общих префиксов промпта.
+Все промпты бота начинаются с одной и той же инструкции (своей для
+каждого режима), и отличается только раздел «Данные». Ключи/значения
+внимания для такого префикса считаются один раз при старте, а запросы,
+начинающиеся с него, prefill'ят только свой хвост.
+
+Префиксы задаются PREFIX_CACHE_TEXT (одна строка) или PREFIX_CACHE_FILE
+(JSON-массив строк; в корне бота его печатает `python prompts.py`).
+"""
+import copy
+import json
+import logging
+import os
+from typing import List, Optional
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+def _as_cache(past_key_values):
+    """
+    Модели со старым API (и trust_remote_code) отдают кеш кортежем тензоров,
+    у которого нет batch_repeat_interleave, — приводим к DynamicCache.
+    """
+    if isinstance(past_key_values, tuple):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return past_key_values
+
+
+class CachedPrefix:
+    def __init__(self, text: str, input_ids: torch.LongTensor, past_key_values) -> None:
+        self.text = text
+        self.input_ids = input_ids  # [1, prefix_len]
+        self.past_key_values = past_key_values
+
+    def __len__(self) -> int:
+        return self.input_ids.shape[1]
+
+    def cache_for_batch(self, batch_size: int):
+        """Свежая копия кеша (generate его дописывает), размноженная на пачку."""
+        cache = copy.deepcopy(self.past_key_values)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+
+class PrefixCache:
+    def __init__(self, tokenizer, model, device: str, prefixes: List[str]) -> None:
+        self.tokenizer = tokenizer
+        self.entries: List[CachedPrefix] = []
+        for text in sorted(set(p for p in prefixes if p), key=len, reverse=True):
+            ids = tokenizer(text, return_tensors="pt").input_ids.to(device)
+            with torch.no_grad():
+                out = model(input_ids=ids, use_cache=True)
+            self.entries.append(CachedPrefix(text, ids, _as_cache(out.past_key_values)))
+            logger.info("Prefix cached: %s tokens", ids.shape[1])
+
+    def match(self, prompt: str) -> Optional[int]:
+        """Индекс самого длинного подходящего префикса или None."""
+        for i, entry in enumerate(self.entries):
+            if prompt.startswith(entry.text) and len(prompt) > len(entry.text):
+                return i
+        return None
+
+    def suffix_ids(self, index: int, prompt: str) -> List[int]:
+        """Токены хвоста промпта после префикса (без BOS и прочих спецтокенов)."""
+        suffix = prompt[len(self.entries[index].text):]
+        return self.tokenizer(suffix, add_special_tokens=False).input_ids
+
+
+def load_prefixes() -> List[str]:
+    prefixes: List[str] = []
+    text = os.getenv("PREFIX_CACHE_TEXT")
+    if text:
+        prefixes.append(text)
+    path = os.getenv("PREFIX_CACHE_FILE", "")
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as fh:
+            prefixes.extend(json.load(fh))
+    return prefixes
@@ -1,29 +1,215 @@
 # /sdd/bots/num_bot_doubleAI_app/deepseek-v3/run_deepseek.py
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Sequence, Set, Tuple
+
 from fastapi import FastAPI
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from fastapi.responses import StreamingResponse
+from prometheus_client import Counter, Gauge, Histogram, make_asgi_app
+from transformers import StoppingCriteriaList
 import torch
 
+from batching import BatchScheduler, Completion, GenerationRequest
+from model_loader import load_model
+from prefix_cache import PrefixCache, load_prefixes
+from streaming import AsyncTextStreamer, StopOnCancel, sse_events, usage
+
 MODEL_PATH = os.getenv("MODEL_PATH", "/app")   # папка с весами
 DEVICE = os.getenv("DEVICE", "cpu")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", 2000))
 TEMPERATURE = float(os.getenv("TEMPERATURE", 0.7))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", 20))
+CPU_PRECISION = os.getenv("CPU_PRECISION", "fp32")  # fp32 | bf16 | int8
+
+# те же корзины, что у bot_llm_request_seconds на стороне бота
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+REQUEST_SECONDS = Histogram(
+    "deepseek_request_seconds",
+    "Обработка запроса целиком, включая очередь",
+    ["stream", "outcome"],
+    buckets=BUCKETS,
+)
+FIRST_TOKEN_SECONDS = Histogram(
+    "deepseek_first_token_seconds", "Время до первого фрагмента потока", buckets=BUCKETS
+)
+IN_FLIGHT = Gauge("deepseek_in_flight_requests", "Запросы в обработке")
+PROMPT_TOKENS = Counter("deepseek_prompt_tokens_total", "Токены промптов (без кешированного префикса)")
+GENERATED_TOKENS = Counter("deepseek_generated_tokens_total", "Сгенерированные токены")
+PREFIX_LOOKUPS = Counter("deepseek_prefix_cache_total", "Поиск KV-префикса", ["result"])
+
+print(f"Loading model ({CPU_PRECISION})...")
+tokenizer, model = load_model(MODEL_PATH, DEVICE, CPU_PRECISION)
+print("Precomputing prefix KV cache...")
+prefix_cache = PrefixCache(tokenizer, model, DEVICE, load_prefixes())
+
+
+def _stop_ids() -> Set[int]:
+    ids = model.generation_config.eos_token_id
+    ids = set(ids if isinstance(ids, list) else [ids])
+    ids.add(tokenizer.eos_token_id)
+    ids.discard(None)
+    return ids
 
-app = FastAPI()
 
-print("Loading tokenizer...")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-print("Loading model...")
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_PATH,
-    torch_dtype=torch.float16 if "cuda" in DEVICE else torch.float32,
-    trust_remote_code=True
-).to(DEVICE)
-model.eval()
+STOP_IDS = _stop_ids()
+
+
+def finish(new_ids: Sequence[int], max_tokens: int) -> Tuple[int, str]:
+    """
+    (токенов ответа, finish_reason) по новым токенам одной строки: ответ —
+    до первого стоп-токена; нет его в пределах max_tokens — ответ обрезан.
+    """
+    new_ids = new_ids[:max_tokens]
+    for n, token in enumerate(new_ids):
+        if token in STOP_IDS:
+            return n, "stop"
+    return len(new_ids), "length" if len(new_ids) >= max_tokens else "stop"
+
+
+def build_inputs(prompts: List[str], prefix_index: Optional[int]) -> dict:
+    """
+    Входы generate. Без префикса — обычная токенизация с левым паддингом.
+    С префиксом — [префикс | паддинг | хвост] и готовый KV-кеш префикса:
+    модель prefill'ит только хвосты, а маска внимания скрывает паддинг.
+    """
+    if prefix_index is None:
+        return tokenizer(prompts, return_tensors="pt", padding=True).to(DEVICE)
+
+    entry = prefix_cache.entries[prefix_index]
+    prefix_ids = entry.input_ids[0].tolist()
+    suffixes = [prefix_cache.suffix_ids(prefix_index, p) for p in prompts]
+    width = max(len(x) for x in suffixes)
+    rows, masks = [], []
+    for suffix in suffixes:
+        gap = width - len(suffix)
+        rows.append(prefix_ids + [tokenizer.pad_token_id] * gap + suffix)
+        masks.append([1] * len(prefix_ids) + [0] * gap + [1] * len(suffix))
+    return {
+        "input_ids": torch.tensor(rows, device=DEVICE),
+        "attention_mask": torch.tensor(masks, device=DEVICE),
+        "past_key_values": entry.cache_for_batch(len(prompts)),
+    }
+
+
+def generate_batch(batch: List[GenerationRequest]) -> List[Completion]:
+    """Один generate на всю пачку; каждому запросу — только его новые токены."""
+    inputs = build_inputs([r.prompt for r in batch], batch[0].key)
+
+    with torch.no_grad():
+        out = model.generate(
+            **inputs,
+            max_new_tokens=max(r.max_tokens for r in batch),
+            temperature=batch[0].temperature,
+            do_sample=True,
+            pad_token_id=tokenizer.pad_token_id
+        )
+    prompt_len = inputs["input_ids"].shape[1]
+    prefix_len = 0 if batch[0].key is None else len(prefix_cache.entries[batch[0].key])
+    PROMPT_TOKENS.inc(int(inputs["attention_mask"][:, prefix_len:].sum()))
+    GENERATED_TOKENS.inc(int((out[:, prompt_len:] != tokenizer.pad_token_id).sum()))
+    completions = []
+    for i, r in enumerate(batch):
+        new_ids = out[i, prompt_len : prompt_len + r.max_tokens]
+        completion_tokens, finish_reason = finish(new_ids.tolist(), r.max_tokens)
+        completions.append(
+            Completion(
+                text=tokenizer.decode(new_ids, skip_special_tokens=True).strip(),
+                # весь промпт, включая кешированный префикс, без паддинга
+                prompt_tokens=int(inputs["attention_mask"][i].sum()),
+                completion_tokens=completion_tokens,
+                finish_reason=finish_reason,
+            )
+        )
+    return completions
+
+
+def generate_streaming(
+    prompt: str, max_tokens: int, temperature: float, streamer: AsyncTextStreamer
+) -> Optional[Completion]:
+    """
+    Одиночный generate, отдающий токены в streamer по мере генерации;
+    итог — расход токенов и finish_reason (None, если generate упал).
+    """
+    try:
+        prefix_index = prefix_cache.match(prompt)
+        inputs = build_inputs([prompt], prefix_index)
+        prefix_len = 0 if prefix_index is None else len(prefix_cache.entries[prefix_index])
+        prompt_tokens = int(inputs["input_ids"].shape[1])
+        PROMPT_TOKENS.inc(prompt_tokens - prefix_len)
+        with torch.no_grad():
+            model.generate(
+                **inputs,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([StopOnCancel(streamer)])
+            )
+    except Exception as exc:
+        streamer.fail(exc)
+        return None
+    finally:
+        GENERATED_TOKENS.inc(streamer.tokens)
+    stopped = streamer.last_token in STOP_IDS
+    return Completion(
+        text="",
+        prompt_tokens=prompt_tokens,
+        completion_tokens=streamer.tokens - stopped,
+        finish_reason="length" if not stopped and streamer.tokens >= max_tokens else "stop",
+    )
+
+
+async def stream_completion(
+    prompt: str, max_tokens: int, temperature: float, include_usage: bool
+):
+    """SSE-поток одной генерации; модель занимается в очереди с пачками."""
+    streamer = AsyncTextStreamer(tokenizer, asyncio.get_running_loop())
+    started = time.perf_counter()
+    outcome = "error"
+    IN_FLIGHT.inc()
+    try:
+        generation = asyncio.ensure_future(
+            scheduler.run_exclusive(
+                generate_streaming, prompt, max_tokens, temperature, streamer
+            )
+        )
+        first = True
+        async for event in sse_events(streamer, generation, include_usage):
+            if first and '"content"' in event:
+                FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                first = False
+            yield event
+        await generation
+        outcome = "ok"
+    finally:
+        IN_FLIGHT.dec()
+        REQUEST_SECONDS.labels("true", outcome).observe(time.perf_counter() - started)
+
+
+scheduler = BatchScheduler(
+    generate_batch,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait=MAX_BATCH_WAIT_MS / 1000,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await scheduler.start()
+    yield
+    await scheduler.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/metrics", make_asgi_app())
 
 
 @app.post("/v1/chat/completions")
-def chat_completions(req: dict):
+async def chat_completions(req: dict):
     """
     OpenAI-совместимый энд-поинт.
     Пример запроса:
@@ -31,29 +217,50 @@ def chat_completions(req: dict):
       "model": "deepseek-chat",
       "messages": [{"role": "user", "content": "Ты нумеролог. Расскажи о числе 5"}],
       "max_tokens": 2000,
-      "temperature": 0.7
+      "temperature": 0.7,
+      "stream": false
     }
+    Одновременные запросы объединяются в пачки (MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS).
+    При "stream": true ответ идёт server-sent events в формате
+    chat.completion.chunk по мере генерации токенов; с
+    "stream_options": {"include_usage": true} последним chunk'ом приходит usage.
+    finish_reason "length" — ответ обрезан по max_tokens.
     """
     messages = req.get("messages", [])
     max_tokens = req.get("max_tokens", MAX_TOKENS)
     temperature = req.get("temperature", TEMPERATURE)
 
     prompt = "\n".join([m["content"] for m in messages])
-    inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
+    prefix_index = prefix_cache.match(prompt)
+    PREFIX_LOOKUPS.labels("miss" if prefix_index is None else "hit").inc()
 
-    with torch.no_grad():
-        out = model.generate(
-            **inputs,
-            max_new_tokens=max_tokens,
-            temperature=temperature,
-            do_sample=True,
-            pad_token_id=tokenizer.eos_token_id
+    if req.get("stream"):
+        return StreamingResponse(
+            stream_completion(
+                prompt,
+                max_tokens,
+                temperature,
+                bool((req.get("stream_options") or {}).get("include_usage")),
+            ),
+            media_type="text/event-stream",
         )
-    full_text = tokenizer.decode(out[0], skip_special_tokens=True)
-    answer = full_text[len(tokenizer.decode(inputs.input_ids[0], skip_special_tokens=True)) :].strip()
+
+    started = time.perf_counter()
+    outcome = "error"
+    IN_FLIGHT.inc()
+    try:
+        completion = await scheduler.submit(prompt, max_tokens, temperature, key=prefix_index)
+        outcome = "ok"
+    finally:
+        IN_FLIGHT.dec()
+        REQUEST_SECONDS.labels("false", outcome).observe(time.perf_counter() - started)
 
     return {
-        "choices": [{"message": {"content": answer, "role": "assistant"}}],
+        "choices": [{
+            "index": 0,
+            "message": {"content": completion.text, "role": "assistant"},
+            "finish_reason": completion.finish_reason,
+        }],
         "model": "deepseek-chat",
-        "usage": {}
-    }
\ No newline at end of file
+        "usage": usage(completion),
+    }
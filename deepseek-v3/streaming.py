@@ -0,0 +1,129 @@
+# /sdd/bots/num_bot_doubleAI_app/deepseek-v3/streaming.py
+"""
+Потоковая отдача токенов в формате OpenAI chat.completion.chunk (SSE).
+generate работает в потоке планировщика, а AsyncTextStreamer
+перекладывает готовые куски текста в asyncio.Queue event loop.
+Декодируются только новые токены: промпт пропускается (skip_prompt),
+а TextStreamer держит кеш лишь с последней отданной границы слова.
+"""
+import asyncio
+import json
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Optional
+
+import torch
+from transformers import StoppingCriteria, TextStreamer
+
+from batching import Completion
+
+_END = object()
+
+
+class AsyncTextStreamer(TextStreamer):
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.cancelled = False  # клиент отключился — generate пора остановить
+        self.tokens = 0  # сгенерировано новых токенов
+        self.last_token: Optional[int] = None  # стоп-токен или обрыв по max_new_tokens
+
+    def put(self, value) -> None:
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.tokens += value.numel()
+            self.last_token = int(value.view(-1)[-1])
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, _END)
+
+    def fail(self, exc: BaseException) -> None:
+        """Ошибка generate: передаём её читающей стороне."""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, exc)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.cancelled = True
+
+
+class StopOnCancel(StoppingCriteria):
+    """Прерывает generate, если читатель потока ушёл."""
+
+    def __init__(self, streamer: AsyncTextStreamer) -> None:
+        self.streamer = streamer
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],),
+            self.streamer.cancelled,
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def _chunk(
+    completion_id: str,
+    created: int,
+    delta: dict,
+    finish_reason: Optional[str] = None,
+) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": "deepseek-chat",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def usage(completion: Completion) -> dict:
+    return {
+        "prompt_tokens": completion.prompt_tokens,
+        "completion_tokens": completion.completion_tokens,
+        "total_tokens": completion.prompt_tokens + completion.completion_tokens,
+    }
+
+
+def _usage_chunk(completion_id: str, created: int, completion: Completion) -> str:
+    """Итоговый расход токенов — для stream_options.include_usage, как у OpenAI."""
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": "deepseek-chat",
+        "choices": [],
+        "usage": usage(completion),
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def sse_events(
+    streamer: AsyncTextStreamer, result: Awaitable[Completion], include_usage: bool = False
+) -> AsyncIterator[str]:
+    """
+    SSE-события: роль, куски текста, финальный chunk с finish_reason,
+    usage (если просили) и [DONE]. result — итог generate этого потока.
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    yield _chunk(completion_id, created, {"role": "assistant"})
+    async for text in streamer:
+        yield _chunk(completion_id, created, {"content": text})
+    completion = await result
+    yield _chunk(completion_id, created, {}, finish_reason=completion.finish_reason)
+    if include_usage:
+        yield _usage_chunk(completion_id, created, completion)
+    yield "data: [DONE]\n\n"
@@ -1,46 +1,168 @@
 # /sdd/bots/num_bot_doubleAI_app/deepseek_client.py
+import asyncio
+import json
 import logging
-import requests
-from typing import List
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional, Tuple
 from config import settings
+from llm_client import DeadlineExceeded, LLMStreamError, post_json, stream_lines
+from metrics import LLM_FAILURES, observe_llm_request
+from prompts import build_report_prompt
+from token_usage import max_tokens_for, record
 
 logger = logging.getLogger(__name__)
 
+# Пометка «сырого» ответа, когда сервер не ответил
+FAILED_MARK = "(DeepSeek не ответил)"
+MODEL = "deepseek-chat"
 
-def generate_via_deepseek(structure: List[str], mode: str) -> str:
-    mode_desc = {
-        "default": "краткий эзотерический отчёт",
-        "deep": "глубокий нумерологический анализ",
-        "master": "полный эзотерический портрет по методике Хшановской",
-    }[mode]
-
-    prompt = (
-        f"Ты — эзотерический нумеролог. Напиши {mode_desc} на основе данных ниже. "
-        "Говори мягко, вдохновляюще, наставнически. Не задавай вопросов, "
-        "не ссылайся на источники, не философствуй. "
-        "не удаляя эмодзи-иконки и не меняя заголовки. "
-        "Добавь по 1-3 предложения под каждым пунктом, сохрани формат «эмодзи + заголовок».\n\n"
-        "Заверши текст: «Если почувствуешь, что это о тебе — это не совпадение. "
-        "Всё записано в дате.» "
-        "«Если ты узнал себя — поставь ⭐ или сохрани расклад.»\n\n"
-        "Данные:\n" + "\n".join(structure)
-    )
+
+def _payload(prompt: str, max_tokens: int, stream: bool = False) -> dict:
+    payload = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": 0.7,
+        "stream": stream,
+    }
+    if stream:
+        # usage придёт последним chunk'ом; сервер без поддержки поле игнорирует
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+def _usage(data: dict) -> Optional[Tuple[int, int]]:
+    try:
+        usage = data["usage"]
+        return int(usage["prompt_tokens"]), int(usage["completion_tokens"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+async def generate_via_deepseek(
+    structure: List[str],
+    mode: str,
+    *,
+    deadline: Optional[float] = None,
+    prompt: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+) -> str:
+    if max_tokens is None:
+        max_tokens = max_tokens_for("deepseek", mode)
+    if prompt is None:
+        prompt = build_report_prompt(structure, mode)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
 
     try:
-        resp = requests.post(
+        resp = await post_json(
             settings.deepseek_url,
-            json={
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "max_tokens": 2000,
-                "temperature": 0.7,
-            },
-            headers={"Content-Type": "application/json"},
-            timeout=settings.deepseek_timeout,
+            _payload(prompt, max_tokens),
+            {"Content-Type": "application/json"},
+            settings.deepseek_timeout,
+            deadline,
+            provider="deepseek",
         )
-        if resp.status_code == 200:
-            return resp.json()["choices"][0]["message"]["content"].strip()
-        logger.warning("DeepSeek HTTP %s: %s", resp.status_code, resp.text)
+        if resp is not None and resp.status_code == 200:
+            data = resp.json()
+            choice = data["choices"][0]
+            text = choice["message"]["content"].strip()
+            observe_llm_request("deepseek", MODEL, loop.time() - started)
+            cut = record(
+                "deepseek",
+                MODEL,
+                mode,
+                prompt,
+                text,
+                _usage(data),
+                truncated=choice.get("finish_reason") == "length",
+                max_tokens=max_tokens,
+            )
+            if cut:
+                # адаптивный лимит оказался мал: обрезанный отчёт не отдаём
+                logger.warning("DeepSeek answer cut at %s tokens, retrying with the ceiling", max_tokens)
+                return await generate_via_deepseek(
+                    structure,
+                    mode,
+                    deadline=deadline,
+                    prompt=prompt,
+                    max_tokens=settings.llm_max_tokens,
+                )
+            return text
+        if resp is not None:
+            logger.warning("DeepSeek HTTP %s: %s", resp.status_code, resp.text)
+            failure = f"http_{resp.status_code}"
+        else:
+            failure = "network"
+        observe_llm_request("deepseek", MODEL, loop.time() - started, failure)
+    except DeadlineExceeded:
+        logger.warning("DeepSeek deadline exceeded")
+        LLM_FAILURES.labels("deepseek", MODEL, "deadline").inc()
     except Exception as e:
         logger.exception("DeepSeek error")
-    return "\n".join(structure) + "\n\n(DeepSeek не ответил)"
\ No newline at end of file
+        observe_llm_request("deepseek", MODEL, loop.time() - started, "parse")
+    return "\n".join(structure) + "\n\n" + FAILED_MARK
+
+
+async def stream_via_deepseek(
+    structure: List[str], mode: str, *, deadline: Optional[float] = None
+) -> AsyncIterator[str]:
+    """
+    Потоковая генерация через OpenAI-совместимый SSE:
+    строки «data: {...}» с choices[0].delta.content, конец — «data: [DONE]».
+    Ошибки до первого фрагмента — LLMStreamError (вызывающий уходит
+    в обычный generate_via_deepseek).
+    """
+    max_tokens = max_tokens_for("deepseek", mode)
+    prompt = build_report_prompt(structure, mode)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    parts: List[str] = []
+    usage: Optional[Tuple[int, int]] = None
+    truncated = False
+    try:
+        lines = stream_lines(
+            settings.deepseek_url,
+            _payload(prompt, max_tokens, stream=True),
+            {"Content-Type": "application/json", "Accept": "text/event-stream"},
+            settings.deepseek_timeout,
+            deadline,
+            provider="deepseek",
+        )
+        # после [DONE] поток закрывается сразу, а не при сборке мусора
+        async with aclosing(lines):
+            async for line in lines:
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError as exc:
+                    logger.warning("Cannot parse DeepSeek chunk: %s", exc)
+                    continue
+                # служебные chunk'и (роль, finish_reason, usage) текста не несут
+                usage = _usage(chunk) or usage
+                for choice in chunk.get("choices") or []:
+                    truncated = truncated or choice.get("finish_reason") == "length"
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+    except (LLMStreamError, DeadlineExceeded):
+        observe_llm_request("deepseek", MODEL, loop.time() - started, "stream")
+        raise
+    observe_llm_request("deepseek", MODEL, loop.time() - started)
+    if parts and record(
+        "deepseek",
+        MODEL,
+        mode,
+        prompt,
+        "".join(parts),
+        usage,
+        truncated=truncated,
+        max_tokens=max_tokens,
+    ):
+        # показанный текст пометят несгенерированным и не закешируют
+        raise LLMStreamError(f"DeepSeek answer cut at {max_tokens} tokens")
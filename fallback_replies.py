@@ -0,0 +1,219 @@
+"""
+Ответы на сообщения без даты.
+Почти всё, что приходит без даты, — приветствия, вопросы «что ты умеешь»,
+бессмыслица и стикеры. На них отвечаем из пула готовых вариантов, без
+сетевого запроса. Пул засеян вариантами, написанными вручную, и в фоне
+пополняется свежими от YandexGPT Lite раз в fallback_pool_refresh секунд.
+Живой запрос к модели делаем только для прочего текста и только в пределах
+бюджета: token bucket на процесс, fallback_llm_rate запросов в секунду.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import re
+from typing import Dict, List, Optional
+
+from cache import TTLCache
+from config import settings
+from llm_scheduler import PRIORITY_BACKGROUND, PRIORITY_CHAT, request_context
+from metrics import register_stats
+from resilience import TokenBucket
+from yandex_gpt import generate_fallback_variants, generate_fallback_via_yandex
+
+logger = logging.getLogger(__name__)
+
+CONTACT = "@viv1313r"
+MIN_VARIANT_LEN = 20
+MAX_VARIANT_LEN = 400
+LAST_REPLY_TTL = 3600.0
+LAST_REPLY_SIZE = 100_000
+REFRESH_RETRY = 300.0
+
+# ---------- намерения ----------
+GREETING_RE = re.compile(
+    r"^\W*(привет\w*|здравству\w*|здоров\w*|добр\w+ (утро|день|вечер)|доброе утро|"
+    r"хай|хелло|салют|ку|йо|hi|hello|hey)\b",
+    re.IGNORECASE,
+)
+QUESTION_RE = re.compile(
+    r"^\W*(что|как|зачем|почему|кто|где|когда|сколько|можно|какой|какая|какие|"
+    r"ты кто|а ты|помоги\w*|помощь|help)\b",
+    re.IGNORECASE,
+)
+LETTER_RE = re.compile(r"[^\W\d_]")
+VOWEL_RE = re.compile(r"[аеёиоуыэюяaeiouy]", re.IGNORECASE)
+REPEAT_RE = re.compile(r"([^\W\d_])\1{3,}")
+
+# для чего генерировать варианты: подставляется в промпт после «Пользователь чат-бота нумеролога»
+SITUATIONS = {
+    "greeting": "поздоровался",
+    "question": "задал вопрос о том, что умеет бот или как им пользоваться,",
+    "nonsense": "прислал бессмысленный набор символов",
+    "non_text": "прислал стикер, фото или голосовое вместо текста",
+    "other": "написал что-то постороннее",
+}
+
+SEED_REPLIES: Dict[str, List[str]] = {
+    "greeting": [
+        "Привет! 🌟 Цифры уже ждут: напиши дату рождения в формате ДД.ММ.ГГГГ — и я расскажу, что в ней зашифровано. А если захочешь такого же бота — пиши @viv1313r",
+        "Здравствуй! Лучшее приветствие для нумеролога — дата рождения 😉 Пришли её как ДД.ММ.ГГГГ. Про создание своего бота — к @viv1313r",
+        "Привет-привет! ✨ Давай знакомиться по-нумерологически: дата рождения в формате ДД.ММ.ГГГГ. Хочешь похожего бота для себя — @viv1313r",
+        "Рад тебя видеть! Напиши дату рождения (ДД.ММ.ГГГГ), и я составлю твой портрет. Нужен свой бот — загляни к @viv1313r",
+    ],
+    "question": [
+        "Я читаю характер и путь по дате рождения 🔮 Напиши её в формате ДД.ММ.ГГГГ — и всё увидишь сам. А про таких ботов можно спросить @viv1313r",
+        "Всё просто: присылаешь дату рождения как ДД.ММ.ГГГГ — получаешь нумерологический расклад. Хочешь такого же бота — @viv1313r",
+        "Хороший вопрос! Лучший ответ спрятан в твоей дате рождения — напиши её в формате ДД.ММ.ГГГГ 😉 Про создание ботов — @viv1313r",
+        "Я считаю числа судьбы, характера и предназначения. Нужна только дата рождения: ДД.ММ.ГГГГ. А свой бот — через @viv1313r",
+    ],
+    "nonsense": [
+        "Хм, даже цифры не смогли это расшифровать 😄 Давай проще: дата рождения в формате ДД.ММ.ГГГГ. А если хочешь такого же бота — пиши @viv1313r",
+        "Похоже на тайный шифр! Но я понимаю только даты 🙂 Напиши свою как ДД.ММ.ГГГГ. Про ботов — к @viv1313r",
+        "Звёзды в замешательстве ✨ Пришли дату рождения в формате ДД.ММ.ГГГГ — и начнём. Свой бот — @viv1313r",
+    ],
+    "non_text": [
+        "Красиво, но цифры любят текст 😊 Напиши дату рождения в формате ДД.ММ.ГГГГ. А если хочешь такого же бота — пиши @viv1313r",
+        "Картинки я пока не читаю — только даты 🔢 Пришли свою как ДД.ММ.ГГГГ. Про создание ботов — @viv1313r",
+        "Это мило! А теперь дату рождения текстом, в формате ДД.ММ.ГГГГ 😉 Нужен свой бот — @viv1313r",
+    ],
+    "other": [
+        "Я пока не понял, давай просто дату рождения в формате ДД.ММ.ГГГГ — и я создам твой портрет. А если хочешь такого же бота — пиши @viv1313r",
+        "Интересно! Но самое интересное — в твоей дате рождения 😉 Напиши её как ДД.ММ.ГГГГ. Про таких ботов — @viv1313r",
+        "Обязательно поговорим, а начнём с цифр: дата рождения в формате ДД.ММ.ГГГГ ✨ Свой бот — через @viv1313r",
+    ],
+}
+
+_pool: Dict[str, List[str]] = {intent: list(replies) for intent, replies in SEED_REPLIES.items()}
+_last_reply = TTLCache(LAST_REPLY_SIZE, LAST_REPLY_TTL)
+_budget: Optional[TokenBucket] = None
+_refresher: Optional[asyncio.Task] = None
+
+FALLBACK_STATS: Dict[str, object] = {
+    "intents": {intent: 0 for intent in SEED_REPLIES},
+    "pooled": 0,
+    "live": 0,
+    "budget_exhausted": 0,
+    "refreshes": 0,
+}
+
+
+def classify(text: Optional[str]) -> str:
+    """greeting / question / nonsense / non_text / other — по дешёвым правилам."""
+    if not text or not text.strip():
+        return "non_text"
+    text = text.strip()
+    if GREETING_RE.match(text):
+        return "greeting"
+    if text.endswith("?") or QUESTION_RE.match(text):
+        return "question"
+    letters = LETTER_RE.findall(text)
+    if len(letters) < 2 or not VOWEL_RE.search(text):
+        return "nonsense"
+    if " " not in text:
+        # «аааааа» и «asdfgh», но не «оооочень круто»
+        vowels = len(VOWEL_RE.findall(text))
+        if REPEAT_RE.search(text) or (len(letters) >= 5 and vowels / len(letters) < 0.2):
+            return "nonsense"
+    return "other"
+
+
+def _pick(intent: str, user_id: Optional[int]) -> str:
+    replies = _pool[intent]
+    last = _last_reply.get(user_id) if user_id is not None else None
+    choices = [r for r in replies if r != last] or replies
+    reply = random.choice(choices)
+    if user_id is not None:
+        _last_reply.set(user_id, reply)
+    return reply
+
+
+def _live_allowed() -> bool:
+    global _budget
+    if settings.fallback_llm_rate <= 0:
+        return False
+    if _budget is None:
+        _budget = TokenBucket(settings.fallback_llm_rate, settings.fallback_llm_burst)
+    if _budget.delay() > 0:
+        return False
+    _budget.take()
+    return True
+
+
+async def fallback_reply(text: Optional[str], user_id: Optional[int]) -> str:
+    """Ответ на сообщение без даты: из пула или, в пределах бюджета, от модели."""
+    intent = classify(text)
+    FALLBACK_STATS["intents"][intent] += 1
+    if intent == "other":
+        if _live_allowed():
+            FALLBACK_STATS["live"] += 1
+            with request_context(PRIORITY_CHAT, user_id):
+                return await generate_fallback_via_yandex(text)
+        FALLBACK_STATS["budget_exhausted"] += 1
+    FALLBACK_STATS["pooled"] += 1
+    return _pick(intent, user_id)
+
+
+# ---------- обновление пула ----------
+def parse_variants(raw: str) -> List[str]:
+    """Строки «- ...» ответа модели, прошедшие фильтр длины и с контактом."""
+    variants = []
+    for line in raw.splitlines():
+        line = line.strip()
+        if not line.startswith(("-", "•", "*")):
+            continue
+        line = line.lstrip("-•* ").strip().strip("«»\"")
+        if MIN_VARIANT_LEN <= len(line) <= MAX_VARIANT_LEN and CONTACT in line:
+            variants.append(line)
+    return variants
+
+
+async def refresh_pool() -> int:
+    """Один проход: свежие варианты для каждого намерения; сколько намерений обновлено."""
+    updated = 0
+    with request_context(PRIORITY_BACKGROUND):
+        for intent, situation in SITUATIONS.items():
+            raw = await generate_fallback_variants(situation, settings.fallback_pool_size)
+            variants = parse_variants(raw) if raw else []
+            if not variants:
+                logger.warning("Не удалось обновить пул ответов «%s»", intent)
+                continue
+            # ручные варианты остаются: пул не пустеет и не дрейфует целиком
+            _pool[intent] = SEED_REPLIES[intent] + variants
+            updated += 1
+    FALLBACK_STATS["refreshes"] += 1
+    return updated
+
+
+async def _refresh_loop() -> None:
+    while True:
+        try:
+            updated = await refresh_pool()
+        except Exception:
+            logger.exception("Сбой обновления пула ответов")
+            updated = 0
+        await asyncio.sleep(settings.fallback_pool_refresh if updated else REFRESH_RETRY)
+
+
+def start_pool_refresh() -> None:
+    global _refresher
+    if settings.fallback_pool_refresh <= 0 or _refresher is not None:
+        return
+    _refresher = asyncio.create_task(_refresh_loop())
+
+
+async def stop_pool_refresh() -> None:
+    global _refresher
+    if _refresher is None:
+        return
+    task, _refresher = _refresher, None
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def fallback_stats() -> Dict[str, object]:
+    return {**FALLBACK_STATS, "pool": {intent: len(r) for intent, r in _pool.items()}}
+
+
+register_stats("fallback", fallback_stats)
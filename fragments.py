@@ -0,0 +1,223 @@
+"""
+Сборка отчётов из готовых фрагментов.
+Каждая строка build_report_structure — «эмодзи Раздел: значение», и у
+значения маленький домен: Число Судьбы — дюжина вариантов, коды дня,
+месяца и года — 1–9, часть строк вовсе постоянна. Поэтому пояснение к
+строке пишется моделью один раз на (раздел, значение, режим, ИИ, версия
+промпта), хранится в report_fragments и в памяти процесса, а отчёт для
+новой даты собирается из готовых пояснений — своего ИИ, а недостающие
+берутся у другого.
+
+Недостающие пояснения пишутся запросами по BATCH_LINES строк; параллельно —
+короткие личные вступление и заключение (report_fragments_intro). После
+прогрева отчёт стоит ноль-один небольшой запрос вместо генерации на
+2000 токенов. Если часть пояснений получить не удалось, отчёт помечается
+как несгенерированный: задание повторится и допишет только их.
+
+Собранный отчёт хранится под тем же ключом, что и цельный; способ
+генерации переключается настройкой report_fragments.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from cache import TTLCache
+from config import settings
+from db import get_fragments, save_fragments
+from llm_client import deadline_after
+from metrics import register_stats, track
+from prompts import (
+    PROMPT_VERSION,
+    REPORT_CLOSING,
+    SEPARATOR,
+    build_fragments_prompt,
+    build_intro_prompt,
+)
+from router import BACKENDS, is_failed, route_generation
+from token_usage import usage_purpose
+from yandex_gpt import FAILED_MARK
+
+logger = logging.getLogger(__name__)
+
+TOKENS_PER_FRAGMENT = 150
+# пояснений в одном запросе: длинный ответ модель обрезает или теряет формат
+BATCH_LINES = 8
+INTRO_MAX_TOKENS = 250
+INTRO_LINES = 3  # Число Судьбы, миссия, психоматрица — этого хватает для личного тона
+MIN_FRAGMENT_LEN = 10
+MAX_FRAGMENT_LEN = 1000
+# разметка, которой модель любит выделять заголовки
+_MARKUP = str.maketrans("", "", "*#")
+
+Key = Tuple[str, str]
+
+_cache = TTLCache(settings.fragment_cache_size, settings.fragment_cache_ttl)
+
+FRAGMENT_STATS: Dict[str, int] = {
+    "reports": 0,
+    "reused": 0,
+    "generated": 0,
+    "missing": 0,
+    "llm_calls": 0,
+}
+
+
+# ---------- разбор ----------
+def split_line(line: str) -> Key:
+    """(раздел, значение); у строк без значения оно пустое."""
+    section, sep, value = line.partition(": ")
+    return (section, value) if sep else (line, "")
+
+
+def parse_fragments(raw: str, lines: List[str]) -> Dict[str, str]:
+    """Пояснения из ответа модели: текст между повторённым пунктом и следующим."""
+    text = raw.translate(_MARKUP)
+    found: List[Tuple[int, str]] = []
+    cursor = 0
+    for line in lines:
+        head = split_line(line)[0].split("\n", 1)[0]
+        pos = text.find(head, cursor)
+        if pos < 0:
+            continue
+        found.append((pos, line))
+        cursor = pos + len(head)
+
+    result = {}
+    for i, (pos, line) in enumerate(found):
+        end = found[i + 1][0] if i + 1 < len(found) else len(text)
+        segment = text[pos:end]
+        if segment.startswith(line):
+            body = segment[len(line) :]
+        else:
+            # пункт повторён не дословно — пояснение начинается со следующей строки
+            body = segment.partition("\n")[2]
+        # многострочное значение (ASCII-пирамида) в пояснение не входит
+        value_rows = {row.strip() for row in line.split("\n")[1:]}
+        body = "\n".join(
+            row for row in body.strip().split("\n") if not row.strip() or row.strip() not in value_rows
+        ).strip()
+        if MIN_FRAGMENT_LEN <= len(body) <= MAX_FRAGMENT_LEN:
+            result[line] = body
+    return result
+
+
+def parse_intro(raw: str) -> Tuple[str, str]:
+    """(вступление, заключение); без разделителя всё считается вступлением."""
+    intro, _, outro = raw.translate(_MARKUP).partition(SEPARATOR)
+    return intro.strip(), outro.strip()
+
+
+# ---------- фрагменты ----------
+async def _lookup(keys: List[Key], mode: str, ai: str) -> Dict[Key, str]:
+    """
+    Готовые пояснения: сначала написанные предпочтённым ИИ, недостающие —
+    другими. Пока ИИ пользователя в отказе, router отдаёт генерацию другому,
+    и его пояснения должны переиспользоваться, а не писаться заново.
+    """
+    found: Dict[Key, str] = {}
+    for backend in [ai] + [name for name in BACKENDS if name != ai]:
+        missing = []
+        for key in keys:
+            if key in found:
+                continue
+            text = _cache.get((key, mode, backend, PROMPT_VERSION))
+            if text is None:
+                missing.append(key)
+            else:
+                found[key] = text
+        if missing:
+            with track("db_fragments"):
+                stored = await get_fragments(mode, backend, PROMPT_VERSION, missing)
+            for key, text in stored.items():
+                _cache.set((key, mode, backend, PROMPT_VERSION), text)
+            found.update(stored)
+        if len(found) == len(keys):
+            break
+    return found
+
+
+async def _generate(
+    lines: List[str], mode: str, ai: str, deadline: float
+) -> Tuple[Dict[Key, str], str]:
+    """Пачка недостающих пояснений одним запросом; (пояснения, бэкенд)."""
+    FRAGMENT_STATS["llm_calls"] += 1
+    with usage_purpose("fragments"):
+        raw, backend = await route_generation(
+            lines,
+            mode,
+            ai,
+            deadline,
+            prompt=build_fragments_prompt(lines, mode),
+            max_tokens=TOKENS_PER_FRAGMENT * len(lines),
+        )
+    if is_failed(raw):
+        return {}, backend
+    fragments = {split_line(line): text for line, text in parse_fragments(raw, lines).items()}
+    if fragments:
+        # пояснения хранятся под тем ИИ, который их написал
+        await save_fragments(mode, backend, PROMPT_VERSION, fragments)
+        for key, text in fragments.items():
+            _cache.set((key, mode, backend, PROMPT_VERSION), text)
+    return fragments, backend
+
+
+async def _personal(structure: List[str], mode: str, ai: str, deadline: float) -> Tuple[str, str]:
+    if not settings.report_fragments_intro:
+        return "", ""
+    FRAGMENT_STATS["llm_calls"] += 1
+    lines = structure[:INTRO_LINES]
+    with usage_purpose("intro"):
+        raw, _ = await route_generation(
+            lines,
+            mode,
+            ai,
+            deadline,
+            prompt=build_intro_prompt(lines, mode),
+            max_tokens=INTRO_MAX_TOKENS,
+        )
+    # без вступления отчёт всё равно полный
+    return ("", "") if is_failed(raw) else parse_intro(raw)
+
+
+# ---------- сборка ----------
+async def compose_report(
+    structure: List[str], mode: str, ai: str, deadline: Optional[float] = None
+) -> Tuple[str, str]:
+    """(текст, бэкенд) — как у generate_text; бэкенд — автор новых пояснений."""
+    if deadline is None:
+        deadline = deadline_after(settings.llm_deadline)
+    FRAGMENT_STATS["reports"] += 1
+    keys = [split_line(line) for line in structure]
+    known = await _lookup(list(dict.fromkeys(keys)), mode, ai)
+    FRAGMENT_STATS["reused"] += len(known)
+
+    missing = list(dict.fromkeys(line for line, key in zip(structure, keys) if key not in known))
+    batches = [missing[i : i + BATCH_LINES] for i in range(0, len(missing), BATCH_LINES)]
+    *generated, (intro, outro) = await asyncio.gather(
+        *(_generate(batch, mode, ai, deadline) for batch in batches),
+        _personal(structure, mode, ai, deadline),
+    )
+    backend = ai
+    for fresh, written_by in generated:
+        known.update(fresh)
+        FRAGMENT_STATS["generated"] += len(fresh)
+        if written_by != ai:
+            backend = written_by
+
+    body = [f"{line}\n{known[key]}" if key in known else line for line, key in zip(structure, keys)]
+    text = "\n\n".join(part for part in [intro, *body, outro, REPORT_CLOSING] if part)
+    lost = sum(key not in known for key in keys)
+    if lost:
+        FRAGMENT_STATS["missing"] += lost
+        logger.warning("Нет пояснений к %s строкам отчёта (%s, %s)", lost, mode, backend)
+        return text + "\n\n" + FAILED_MARK, backend
+    return text, backend
+
+
+def fragment_stats() -> Dict[str, object]:
+    return {**FRAGMENT_STATS, "cache": _cache.stats()}
+
+
+register_stats("fragments", fragment_stats)
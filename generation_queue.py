@@ -0,0 +1,216 @@
+"""
+Очередь генерации отчётов в Postgres.
+Хендлер только кладёт задание в generation_jobs и отвечает пользователю,
+а задания разбирает пул асинхронных воркеров (свой в каждом процессе
+бота). Захват идёт через FOR UPDATE SKIP LOCKED, поэтому воркеры разных
+процессов не мешают друг другу.
+
+Пока воркер жив, он продлевает аренду задания; если он умер, задание
+снова становится видимым по истечении visibility timeout. Ошибки
+повторяются с экспоненциальной паузой, после jobs_max_attempts попыток
+пользователю уходит сообщение об ошибке. Доставка — at-least-once:
+падение между отправкой и отметкой done приведёт к повторной отправке.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import asyncpg
+from telegram import Bot
+from telegram.error import Forbidden
+
+from config import settings
+from db import claim_job, enqueue_job, extend_job, finish_job, purge_jobs, release_job, retry_job
+from llm_scheduler import PRIORITY_BACKGROUND as LLM_BACKGROUND, PRIORITY_REPORT, request_context
+from metrics import in_flight, register_stats, track
+from reports import get_report
+from router import is_failed
+from telegram_sender import send_text
+from telegram_stream import StreamingMessage
+
+logger = logging.getLogger(__name__)
+
+# запросы пользователей идут раньше фоновых заданий
+PRIORITY_INTERACTIVE = 10
+PRIORITY_BACKGROUND = 0
+
+ERROR_TEXT = "Произошла ошибка. Попробуй позже."
+PURGE_INTERVAL = 3600.0
+
+_workers: List[asyncio.Task] = []
+_wakeup: Optional[asyncio.Event] = None
+_stopping = False
+
+QUEUE_STATS: Dict[str, int] = {
+    "enqueued": 0,
+    "duplicates": 0,
+    "completed": 0,
+    "retried": 0,
+    "failed": 0,
+    "released": 0,
+}
+
+
+class GenerationFailed(Exception):
+    """ИИ не ответил, а попытки ещё есть — лучше повторить, чем отдать «сырой» текст."""
+
+
+# ---------- постановка ----------
+async def enqueue_report(
+    user_id: int,
+    chat_id: int,
+    date_str: str,
+    mode: str,
+    ai: str,
+    priority: int = PRIORITY_INTERACTIVE,
+) -> Optional[int]:
+    """id задания; None, если такой же расчёт для пользователя уже в очереди."""
+    job_id = await enqueue_job(
+        user_id, chat_id, date_str, mode, ai, priority, settings.jobs_max_attempts
+    )
+    if job_id is None:
+        QUEUE_STATS["duplicates"] += 1
+        return None
+    QUEUE_STATS["enqueued"] += 1
+    if _wakeup is not None:
+        _wakeup.set()
+    return job_id
+
+
+# ---------- выполнение ----------
+async def _keep_lease(job: asyncpg.Record) -> None:
+    while True:
+        await asyncio.sleep(settings.jobs_visibility_timeout / 3)
+        try:
+            await extend_job(job["id"], job["attempts"], settings.jobs_visibility_timeout)
+        except Exception as exc:
+            logger.warning("Не удалось продлить задание %s: %r", job["id"], exc)
+
+
+async def _deliver_report(bot: Bot, job: asyncpg.Record) -> None:
+    stream = None
+    if settings.stream_reports:
+        stream = StreamingMessage(bot, job["chat_id"], interval=settings.stream_edit_interval)
+    llm_priority = PRIORITY_REPORT if job["priority"] >= PRIORITY_INTERACTIVE else LLM_BACKGROUND
+    with request_context(llm_priority, job["user_id"]):
+        text = await get_report(job["user_id"], job["date_str"], job["mode"], job["ai"], stream)
+    if stream is not None and stream.started:
+        # начатый поток уже виден пользователю — дописываем как есть
+        await stream.finish()
+    elif is_failed(text) and job["attempts"] < job["max_attempts"]:
+        raise GenerationFailed(job["id"])
+    else:
+        with track("telegram_send"):
+            await send_text(bot, job["chat_id"], text)
+    await finish_job(job["id"], job["attempts"], "done")
+
+
+async def _retry_or_fail(bot: Bot, job: asyncpg.Record, error: str) -> None:
+    if job["attempts"] < job["max_attempts"]:
+        delay = settings.jobs_retry_backoff * 2 ** (job["attempts"] - 1)
+        await retry_job(job["id"], job["attempts"], delay, error)
+        QUEUE_STATS["retried"] += 1
+        logger.warning("Задание %s: %s, повтор через %.0f с", job["id"], error, delay)
+        return
+    await finish_job(job["id"], job["attempts"], "failed", error)
+    QUEUE_STATS["failed"] += 1
+    logger.error("Задание %s провалено после %s попыток: %s", job["id"], job["attempts"], error)
+    try:
+        await send_text(bot, job["chat_id"], ERROR_TEXT)
+    except Exception as exc:
+        logger.warning("Не удалось сообщить об ошибке в чат %s: %r", job["chat_id"], exc)
+
+
+async def _run_job(bot: Bot, job: asyncpg.Record) -> None:
+    if job["attempts"] > job["max_attempts"]:
+        # воркеры, бравшие задание, умирали, не успев его завершить
+        await _retry_or_fail(bot, job, "visibility timeout")
+        return
+    lease = asyncio.create_task(_keep_lease(job))
+    try:
+        with in_flight("jobs"), track("job"):
+            await _deliver_report(bot, job)
+        QUEUE_STATS["completed"] += 1
+    except asyncio.CancelledError:
+        await release_job(job["id"], job["attempts"])
+        QUEUE_STATS["released"] += 1
+        raise
+    except Forbidden as exc:
+        # пользователь заблокировал бота — повторять бессмысленно
+        await finish_job(job["id"], job["attempts"], "failed", repr(exc))
+        QUEUE_STATS["failed"] += 1
+    except GenerationFailed:
+        await _retry_or_fail(bot, job, "generation failed")
+    except Exception as exc:
+        logger.exception("Ошибка задания %s", job["id"])
+        await _retry_or_fail(bot, job, repr(exc))
+    finally:
+        lease.cancel()
+
+
+async def _worker(bot: Bot) -> None:
+    while not _stopping:
+        try:
+            job = await claim_job(settings.jobs_visibility_timeout)
+            if job is not None:
+                await _run_job(bot, job)
+                continue
+        except Exception:
+            # задание, если было взято, вернётся по visibility timeout
+            logger.exception("Сбой воркера очереди генерации")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), settings.jobs_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+
+async def _janitor() -> None:
+    while True:
+        try:
+            await purge_jobs(settings.jobs_retention_days)
+        except Exception as exc:
+            logger.warning("Не удалось почистить очередь генерации: %r", exc)
+        await asyncio.sleep(PURGE_INTERVAL)
+
+
+# ---------- жизненный цикл ----------
+def start_workers(bot: Bot) -> None:
+    global _wakeup, _stopping
+    if _workers:
+        return
+    _wakeup = asyncio.Event()
+    _stopping = False
+    _workers.extend(asyncio.create_task(_worker(bot)) for _ in range(settings.jobs_workers))
+    _workers.append(asyncio.create_task(_janitor()))
+    logger.info("Запущено воркеров генерации: %s", settings.jobs_workers)
+
+
+async def stop_workers(timeout: float) -> None:
+    """
+    Воркеры перестают брать задания и дорабатывают текущие; что не успело
+    за timeout, отменяется и возвращается в очередь без траты попытки.
+    """
+    global _stopping
+    if not _workers:
+        return
+    _stopping = True
+    _wakeup.set()
+    janitor = _workers.pop()
+    janitor.cancel()
+    _, pending = await asyncio.wait(_workers, timeout=timeout)
+    if pending:
+        logger.warning("Прерываем незавершённых заданий: %s", len(pending))
+        for task in pending:
+            task.cancel()
+    await asyncio.gather(janitor, *_workers, return_exceptions=True)
+    _workers.clear()
+
+
+def queue_stats() -> Dict[str, int]:
+    return dict(QUEUE_STATS)
+
+
+register_stats("queue", queue_stats)
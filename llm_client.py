@@ -0,0 +1,157 @@
+"""
+Асинхронный HTTP-слой для обращений к LLM-провайдерам.
+Один общий httpx.AsyncClient с пулом keep-alive соединений,
+неблокирующая выдержка между ретраями и дедлайн на уровне вызова.
+Каждый запрос сначала получает слот в планировщике (llm_scheduler).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from config import settings
+from llm_scheduler import QueueTimeout, slot, throttled
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+class DeadlineExceeded(Exception):
+    """Бюджет времени на вызов исчерпан."""
+
+
+class LLMStreamError(Exception):
+    """Потоковый ответ не удалось открыть или он оборвался."""
+
+
+# ---------- Пул соединений ----------
+def get_client() -> httpx.AsyncClient:
+    """Ленивая инициализация общего клиента (один пул на процесс)."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.llm_pool_max_connections,
+                max_keepalive_connections=settings.llm_pool_max_keepalive,
+                keepalive_expiry=settings.llm_pool_keepalive_expiry,
+            ),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Закрывает пул; вызывается из post_shutdown приложения."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+# ---------- Дедлайны ----------
+def deadline_after(seconds: float) -> float:
+    """Абсолютный дедлайн по часам event loop."""
+    return asyncio.get_running_loop().time() + seconds
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Сколько секунд осталось до дедлайна (None — без ограничения)."""
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_running_loop().time()
+
+
+def _budget(timeout: float, deadline: Optional[float]) -> float:
+    left = time_left(deadline)
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded
+    return min(timeout, left)
+
+
+async def sleep_backoff(delay: float, deadline: Optional[float] = None) -> None:
+    """asyncio-выдержка, не выходящая за дедлайн."""
+    left = time_left(deadline)
+    if left is not None and left <= delay:
+        raise DeadlineExceeded
+    await asyncio.sleep(delay)
+
+
+# ---------- Запросы ----------
+async def post_json(
+    url: str,
+    payload: dict,
+    headers: dict,
+    timeout: float,
+    deadline: Optional[float] = None,
+    *,
+    provider: str,
+) -> Optional[httpx.Response]:
+    """
+    POST с JSON-телом через общий пул.
+    Сетевые ошибки и таймауты логируются и превращаются в None,
+    исчерпанный дедлайн (в том числе в очереди планировщика) —
+    в DeadlineExceeded, отмена задачи пробрасывается.
+    """
+    try:
+        async with slot(provider, time_left(deadline)):
+            budget = _budget(timeout, deadline)
+            try:
+                async with asyncio.timeout(budget):
+                    resp = await get_client().post(
+                        url, json=payload, headers=headers, timeout=budget
+                    )
+            except (httpx.HTTPError, TimeoutError) as exc:
+                logger.warning("Request to %s failed: %r", url, exc)
+                left = time_left(deadline)
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded from exc
+                return None
+    except QueueTimeout as exc:
+        logger.warning("No %s slot for %s: %s", provider, url, exc)
+        raise DeadlineExceeded from exc
+    if resp.status_code == 429:
+        throttled(provider, resp.headers.get("Retry-After"))
+    return resp
+
+
+async def stream_lines(
+    url: str,
+    payload: dict,
+    headers: dict,
+    timeout: float,
+    deadline: Optional[float] = None,
+    *,
+    provider: str,
+) -> AsyncIterator[str]:
+    """
+    POST с потоковым ответом: отдаёт непустые строки тела по мере прихода.
+    Слот планировщика занят, пока поток не дочитан или не закрыт.
+    timeout ограничивает паузу между порциями, deadline — весь поток.
+    Не-200 и сетевые ошибки превращаются в LLMStreamError.
+    """
+    try:
+        async with slot(provider, time_left(deadline)):
+            budget = _budget(timeout, deadline)
+            async with get_client().stream(
+                "POST", url, json=payload, headers=headers, timeout=budget
+            ) as resp:
+                if resp.status_code != 200:
+                    if resp.status_code == 429:
+                        throttled(provider, resp.headers.get("Retry-After"))
+                    body = (await resp.aread()).decode(errors="replace")
+                    raise LLMStreamError(f"HTTP {resp.status_code}: {body[:500]}")
+                async for line in resp.aiter_lines():
+                    left = time_left(deadline)
+                    if left is not None and left <= 0:
+                        raise DeadlineExceeded
+                    if line:
+                        yield line
+    except QueueTimeout as exc:
+        raise DeadlineExceeded from exc
+    except httpx.HTTPError as exc:
+        raise LLMStreamError(repr(exc)) from exc
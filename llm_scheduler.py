@@ -0,0 +1,225 @@
+"""
+Планировщик запросов к LLM: через него проходит каждый HTTP-запрос
+к провайдерам (см. llm_client).
+
+- token bucket на провайдера — общая для процесса квота запросов в секунду;
+- token bucket на пользователя — один пользователь не выбирает квоту за всех;
+- ограничение одновременных запросов к провайдеру;
+- очередь с приоритетами: отчёты идут раньше болтовни в fallback,
+  фоновые задания — после всех.
+
+Приоритет и пользователь задаются на входе в обработку (хендлер, воркер
+очереди) через request_context и доходят до HTTP-слоя через contextvars,
+в том числе в задачи hedging. Пользователь ждёт свой токен сам, не занимая
+место в общей очереди. Ответ 429 приостанавливает выдачу слотов провайдеру.
+Лимиты — на процесс: при нескольких процессах квоту делят между ними.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from cache import TTLCache
+from config import settings
+from metrics import LLM_QUEUE_WAIT, register_stats
+from resilience import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# меньше — раньше
+PRIORITY_REPORT = 0
+PRIORITY_CHAT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_REPORT: "report", PRIORITY_CHAT: "chat", PRIORITY_BACKGROUND: "background"}
+
+USER_BUCKETS_SIZE = 100_000
+
+_priority: ContextVar[int] = ContextVar("llm_priority", default=PRIORITY_REPORT)
+_user_id: ContextVar[Optional[int]] = ContextVar("llm_user_id", default=None)
+
+SCHEDULER_STATS: Dict[str, int] = {"granted": 0, "user_throttled": 0, "rejected": 0, "paused": 0}
+
+
+class QueueTimeout(Exception):
+    """Слот не освободился за отведённое время."""
+
+
+@contextmanager
+def request_context(priority: int, user_id: Optional[int] = None) -> Iterator[None]:
+    """Приоритет и пользователь для всех запросов к LLM внутри блока."""
+    priority_token = _priority.set(priority)
+    user_token = _user_id.set(user_id)
+    try:
+        yield
+    finally:
+        _priority.reset(priority_token)
+        _user_id.reset(user_token)
+
+
+# ---------- провайдер ----------
+class ProviderGate:
+    """Очередь с приоритетами к одному провайдеру: слот — это токен и место в concurrency."""
+
+    def __init__(self, name: str, concurrency: int, rate: float, burst: int) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.active = 0
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _has_room(self) -> bool:
+        return not self.concurrency or self.active < self.concurrency
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        while self._heap:
+            if self._heap[0][2].done():
+                # ожидающий ушёл по таймауту или отмене
+                heapq.heappop(self._heap)
+                continue
+            if not self._has_room():
+                return
+            wait = self._paused_until - time.monotonic()
+            if self.bucket is not None:
+                wait = max(wait, self.bucket.delay())
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            _, _, future = heapq.heappop(self._heap)
+            if self.bucket is not None:
+                self.bucket.take()
+            self.active += 1
+            future.set_result(None)
+
+    async def acquire(self, priority: int, max_wait: Optional[float]) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await asyncio.wait_for(future, max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if future.done() and not future.cancelled():
+                # слот выдан в тот же момент — вернуть
+                self.release()
+            if isinstance(exc, asyncio.TimeoutError):
+                raise QueueTimeout(self.name) from exc
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        if self._timer is None:
+            self._dispatch()
+
+    def pause(self, seconds: float) -> None:
+        """Провайдер ответил 429: новых слотов не выдаём seconds секунд."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._dispatch()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "active": self.active,
+            "queued": sum(1 for _, _, f in self._heap if not f.done()),
+            "paused": self._paused_until > time.monotonic(),
+        }
+
+
+def _limits(provider: str) -> Tuple[int, float, int]:
+    if provider == "yandex":
+        return settings.llm_yandex_concurrency, settings.llm_yandex_rps, settings.llm_yandex_burst
+    if provider == "deepseek":
+        return settings.llm_deepseek_concurrency, settings.llm_deepseek_rps, settings.llm_deepseek_burst
+    return 0, 0.0, 1
+
+
+_gates: Dict[str, ProviderGate] = {}
+_user_buckets = TTLCache(USER_BUCKETS_SIZE, 3600.0)
+
+
+def _gate(provider: str) -> ProviderGate:
+    gate = _gates.get(provider)
+    if gate is None:
+        gate = _gates[provider] = ProviderGate(provider, *_limits(provider))
+    return gate
+
+
+def _user_bucket(user_id: int) -> TokenBucket:
+    bucket = _user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(settings.llm_user_rate, settings.llm_user_burst)
+    # за час простоя bucket заполняется: протухший ничем не отличается от нового
+    _user_buckets.set(user_id, bucket)
+    return bucket
+
+
+# ---------- публичное ----------
+@asynccontextmanager
+async def slot(provider: str, max_wait: Optional[float] = None) -> AsyncIterator[None]:
+    """
+    Держит слот провайдера на время запроса. max_wait — сколько можно ждать
+    квоту и очередь (None — settings.llm_max_queue_wait); не дождались —
+    QueueTimeout.
+    """
+    if max_wait is None:
+        max_wait = settings.llm_max_queue_wait
+    priority = _priority.get()
+    user_id = _user_id.get()
+    started = time.monotonic()
+
+    if user_id is not None and settings.llm_user_rate > 0:
+        wait = _user_bucket(user_id).reserve(max_wait)
+        if wait is None:
+            SCHEDULER_STATS["rejected"] += 1
+            raise QueueTimeout(f"user {user_id}")
+        if wait > 0:
+            SCHEDULER_STATS["user_throttled"] += 1
+            await asyncio.sleep(wait)
+
+    gate = _gate(provider)
+    try:
+        await gate.acquire(priority, max(0.0, max_wait - (time.monotonic() - started)))
+    except QueueTimeout:
+        SCHEDULER_STATS["rejected"] += 1
+        raise
+    SCHEDULER_STATS["granted"] += 1
+    LLM_QUEUE_WAIT.labels(provider, PRIORITY_NAMES.get(priority, str(priority))).observe(
+        time.monotonic() - started
+    )
+    try:
+        yield
+    finally:
+        gate.release()
+
+
+def throttled(provider: str, retry_after: Optional[str]) -> None:
+    """Ответ 429: пауза по Retry-After (или секунда, если заголовка нет)."""
+    try:
+        seconds = float(retry_after) if retry_after else 1.0
+    except ValueError:
+        seconds = 1.0
+    SCHEDULER_STATS["paused"] += 1
+    logger.warning("%s: 429, пауза %.1f с", provider, seconds)
+    _gate(provider).pause(min(seconds, settings.llm_max_queue_wait))
+
+
+def scheduler_stats() -> Dict[str, object]:
+    return {
+        **SCHEDULER_STATS,
+        "users": len(_user_buckets),
+        "providers": {name: gate.stats() for name, gate in _gates.items()},
+    }
+
+
+register_stats("llm_scheduler", scheduler_stats)
@@ -0,0 +1,201 @@
+"""
+Метрики бота в формате Prometheus.
+Гистограммы латентности этапов обработки, HTTP-запросов к LLM и вызовов
+Bot API, счётчики попаданий в кеш, сбоев LLM, токенов, «сырых» ответов и
+flood-wait, gauge'и работы в процессе. Внутренняя статистика модулей (кеш,
+hedging, роутер, очередь, планировщик LLM, отправка, токены) снимается в
+момент scrape: модули отдают её функциями register_stats.
+
+/metrics отдаёт маленький HTTP-сервер на asyncio в том же event loop,
+что и бот, — сборка статистики не конкурирует с кодом бота из другого
+потока.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# от миллисекунд (разбор даты, кеш) до минут (генерация с ретраями)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Латентность этапов обработки", ["stage"], buckets=BUCKETS
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "bot_llm_request_seconds",
+    "Один HTTP-запрос к модели (каждый ретрай отдельно)",
+    ["provider", "model", "outcome"],
+    buckets=BUCKETS,
+)
+LLM_GENERATION_SECONDS = Histogram(
+    "bot_llm_generation_seconds",
+    "Генерация отчёта бэкендом целиком, с ретраями и hedging",
+    ["provider", "outcome"],
+    buckets=BUCKETS,
+)
+LLM_FAILURES = Counter(
+    "bot_llm_failures_total", "Неудачные запросы к моделям", ["provider", "model", "reason"]
+)
+LLM_TOKENS = Counter(
+    "bot_llm_tokens_total",
+    "Токены запросов к моделям (по usage или оценке)",
+    ["provider", "mode", "purpose", "kind"],
+)
+RAW_FALLBACKS = Counter(
+    "bot_raw_fallbacks_total", "Отчёты, отданные «сырым» текстом без ИИ", ["provider"]
+)
+CACHE_LOOKUPS = Counter(
+    "bot_report_cache_lookups_total", "Поиск готового отчёта", ["layer", "result"]
+)
+LLM_QUEUE_WAIT = Histogram(
+    "bot_llm_queue_wait_seconds",
+    "Ожидание квоты и слота провайдера в планировщике LLM",
+    ["provider", "priority"],
+    buckets=BUCKETS,
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    "bot_telegram_send_seconds",
+    "Один вызов Bot API на отправку или правку сообщения",
+    ["method", "outcome"],
+    buckets=BUCKETS,
+)
+TELEGRAM_QUEUE_WAIT = Histogram(
+    "bot_telegram_queue_wait_seconds",
+    "Ожидание лимитов Telegram перед отправкой",
+    ["scope"],
+    buckets=BUCKETS,
+)
+TELEGRAM_RETRY_AFTER = Counter(
+    "bot_telegram_retry_after_total", "Ответы RetryAfter (flood-wait) от Telegram", ["method"]
+)
+IN_FLIGHT = Gauge("bot_in_flight", "Работа в процессе", ["kind"])
+
+_server: Optional[asyncio.AbstractServer] = None
+
+
+@contextmanager
+def track(stage: str) -> Iterator[None]:
+    """Время блока — в bot_stage_seconds{stage=...}, в том числе при исключении."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+@contextmanager
+def in_flight(kind: str) -> Iterator[None]:
+    gauge = IN_FLIGHT.labels(kind)
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
+
+
+def observe_llm_request(
+    provider: str, model: str, seconds: float, failure: Optional[str] = None
+) -> None:
+    """failure — причина неудачи (http_503, network, empty, ...) или None."""
+    outcome = "ok" if failure is None else "error"
+    LLM_REQUEST_SECONDS.labels(provider, model, outcome).observe(seconds)
+    if failure is not None:
+        LLM_FAILURES.labels(provider, model, failure).inc()
+
+
+# ---------- статистика модулей ----------
+_stats_sources: Dict[str, Callable[[], Dict[str, object]]] = {}
+
+
+def register_stats(name: str, fn: Callable[[], Dict[str, object]]) -> None:
+    """fn() -> dict; числа станут gauge'ами bot_<name>_<ключ>."""
+    _stats_sources[name] = fn
+
+
+def _flatten(
+    prefix: str, stats: Dict[str, object], labels: Dict[str, str]
+) -> Iterator[Tuple[str, Dict[str, str], float]]:
+    """
+    Числа — значения, вложенный {имя: ...} — метка name, строки (состояние
+    breaker'а) — метка со значением 1. None (ещё нет замеров) пропускается.
+    """
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, (bool, int, float)):
+            yield name, labels, float(value)
+        elif isinstance(value, str):
+            yield name, {**labels, key: value}, 1.0
+        elif isinstance(value, dict):
+            for sub, item in value.items():
+                if isinstance(item, dict):
+                    yield from _flatten(name, item, {**labels, "name": sub})
+                elif isinstance(item, (bool, int, float)):
+                    yield name, {**labels, "name": sub}, float(item)
+
+
+class _StatsCollector:
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        families: Dict[Tuple[str, Tuple[str, ...]], GaugeMetricFamily] = {}
+        for source, fn in _stats_sources.items():
+            try:
+                stats = fn()
+            except Exception:
+                logger.exception("Не удалось снять статистику %s", source)
+                continue
+            for name, labels, value in _flatten(f"bot_{source}", stats, {}):
+                keys = tuple(sorted(labels))
+                family = families.get((name, keys))
+                if family is None:
+                    family = GaugeMetricFamily(name, f"{source} stats", labels=list(keys))
+                    families[(name, keys)] = family
+                family.add_metric([labels[k] for k in keys], value)
+        yield from families.values()
+
+
+REGISTRY.register(_StatsCollector())
+
+
+# ---------- HTTP ----------
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] == b"/metrics":
+            status, body, ctype = b"200 OK", generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+        else:
+            status, body, ctype = b"404 Not Found", b"not found\n", "text/plain"
+        writer.write(
+            b"HTTP/1.0 " + status + b"\r\n"
+            + f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> None:
+    global _server
+    if _server is not None:
+        return
+    _server = await asyncio.start_server(_handle, host, port)
+    logger.info("Метрики: http://%s:%s/metrics", host, port)
+
+
+async def stop_metrics_server() -> None:
+    global _server
+    if _server is None:
+        return
+    server, _server = _server, None
+    server.close()
+    await server.wait_closed()
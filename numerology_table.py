@@ -0,0 +1,173 @@
+"""
+Предрасчитанная нумерологическая таблица на весь поддерживаемый диапазон дат.
+Все числовые поля calculate() считаются разом для каждого дня диапазона
+векторными суммами цифр NumPy и хранятся компактным структурированным
+массивом (.npy), который открывается через mmap и читается по индексу дня.
+
+    python numerology_table.py build   — пересобрать файл таблицы
+    python numerology_table.py verify  — сверить таблицу со скалярным расчётом
+"""
+from __future__ import annotations
+
+import os
+import sys
+from datetime import date
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+START = date(1900, 1, 1)
+END = date(2100, 12, 31)
+TABLE_PATH = Path(
+    os.getenv("NUMEROLOGY_TABLE_PATH", Path(__file__).with_name("numerology_table.npy"))
+)
+
+MASTER_NUMBERS = (11, 22, 33)
+
+# Порядок числовых полей совпадает с аргументами numerology._report_data
+FIELDS = (
+    "life_path",
+    "day_code",
+    "month_code",
+    "year_code",
+    "karma",
+    "cycle_2",
+    "cycle_3",
+)
+DTYPE = np.dtype([(name, np.uint8) for name in FIELDS])
+
+
+# ---------- векторные редукции ----------
+def digit_sum(n: np.ndarray) -> np.ndarray:
+    """Поразрядная сумма цифр для массива неотрицательных целых."""
+    n = n.copy()
+    total = np.zeros_like(n)
+    while n.any():
+        total += n % 10
+        n //= 10
+    return total
+
+
+def reduce_to_single(n: np.ndarray) -> np.ndarray:
+    """Векторный аналог numerology.reduce_to_single (мастер-числа сохраняются)."""
+    n = np.asarray(n, dtype=np.int64).copy()
+    pending = (n > 9) & ~np.isin(n, MASTER_NUMBERS)
+    while pending.any():
+        n[pending] = digit_sum(n[pending])
+        pending = (n > 9) & ~np.isin(n, MASTER_NUMBERS)
+    return n
+
+
+def _split_days(start: date, end: date) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    days = np.arange(
+        np.datetime64(start, "D"), np.datetime64(end, "D") + 1, dtype="datetime64[D]"
+    )
+    months = days.astype("datetime64[M]")
+    y = months.astype("datetime64[Y]").astype(np.int64) + 1970
+    m = months.astype(np.int64) % 12 + 1
+    d = (days - months).astype(np.int64) + 1
+    return d, m, y
+
+
+def build_table(start: date = START, end: date = END) -> np.ndarray:
+    """Считает все поля для каждого дня [start, end] одним проходом."""
+    d, m, y = _split_days(start, end)
+
+    life_path_a = reduce_to_single(d + m + y)
+    life_path_b = reduce_to_single(d + reduce_to_single(m) + reduce_to_single(y))
+    life_path = np.where(
+        life_path_a == life_path_b,
+        life_path_a,
+        reduce_to_single((life_path_a + life_path_b) // 2),
+    )
+
+    table = np.empty(len(d), dtype=DTYPE)
+    table["life_path"] = life_path
+    table["day_code"] = reduce_to_single(d)
+    table["month_code"] = reduce_to_single(m)
+    table["year_code"] = reduce_to_single(y)
+    table["karma"] = reduce_to_single(life_path * 2)
+    table["cycle_2"] = reduce_to_single(life_path + 3)
+    table["cycle_3"] = reduce_to_single(life_path * 2)
+    return table
+
+
+def save_table(table: np.ndarray, path: Path = TABLE_PATH) -> None:
+    """Атомарная запись: другие процессы не увидят недописанный файл."""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as fh:
+        np.save(fh, table)
+    os.replace(tmp, path)
+
+
+@lru_cache(maxsize=1)
+def load_table() -> np.ndarray:
+    """Открывает таблицу через mmap; если файла нет — строит её в памяти."""
+    try:
+        table = np.load(TABLE_PATH, mmap_mode="r")
+        if table.dtype == DTYPE and len(table) == (END - START).days + 1:
+            return table
+    except (OSError, ValueError):
+        pass
+    table = build_table()
+    try:
+        save_table(table)
+    except OSError:
+        pass  # каталог только для чтения — работаем из памяти
+    return table
+
+
+# ---------- выборка ----------
+def lookup(d: int, m: int, y: int) -> Optional[tuple]:
+    """Числовые поля для даты или None, если дата невалидна/вне диапазона."""
+    try:
+        index = date(y, m, d).toordinal() - START.toordinal()
+    except ValueError:
+        return None
+    if not 0 <= index <= (END - START).days:
+        return None
+    return tuple(int(v) for v in load_table()[index])
+
+
+def lookup_range(start: date, end: date) -> np.ndarray:
+    """Пакетная выборка: строки таблицы за [start, end] включительно."""
+    if start < START or end > END:
+        return build_table(start, end)
+    offset = start.toordinal() - START.toordinal()
+    return load_table()[offset : offset + (end - start).days + 1]
+
+
+# ---------- проверка ----------
+def verify(table: Optional[np.ndarray] = None) -> int:
+    """
+    Сравнивает табличный расчёт со скалярным для каждого дня диапазона.
+    Возвращает число расхождений (0 — таблица эквивалентна).
+    """
+    from numerology import _report_data, calculate_scalar
+
+    table = build_table() if table is None else table
+    d, m, y = _split_days(START, END)
+    mismatches = 0
+    for i, row in enumerate(table):
+        date_str = f"{d[i]:02d}.{m[i]:02d}.{y[i]}"
+        expected = calculate_scalar(date_str)
+        got = _report_data(int(d[i]), int(m[i]), int(y[i]), *(int(v) for v in row))
+        if got != expected:
+            mismatches += 1
+            print(f"{date_str}: {got} != {expected}", file=sys.stderr)
+    return mismatches
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        save_table(build_table())
+        print(f"Таблица сохранена: {TABLE_PATH}")
+    elif command == "verify":
+        bad = verify(load_table())
+        print(f"Расхождений: {bad}")
+        sys.exit(1 if bad else 0)
+    else:
+        sys.exit(f"Неизвестная команда: {command}")
@@ -0,0 +1,164 @@
+"""
+Хранение context.user_data в Postgres (BasePersistence для telegram.ext).
+Переживает перезапуски и позволяет запускать несколько процессов бота
+за балансировщиком вебхуков.
+
+Запись: Application раз в update_interval отдаёт изменённые user_data,
+они копятся в буфере и уходят в БД одним upsert'ом.
+Чтение: данные пользователя подгружаются лениво, перед его апдейтом, и
+после этого считаются свежими cache_ttl секунд: изменения, сделанные в
+это время другим процессом, не видны — это цена экономии чтений. Из БД
+не читаются и данные с несохранёнными изменениями: отданные хендлеру и
+ещё не вернувшиеся в update_user_data или лежащие в буфере. Строка из БД
+накладывается на user_data, а не заменяет их.
+Application отдаёт user_data после каждого апдейта пользователя, даже
+если они не менялись, — такие не пишутся: в кеше лежит снимок последней
+известной БД версии.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Dict, Optional, Set
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from cache import TTLCache
+from db import delete_user_data, load_user_data, save_user_data
+
+logger = logging.getLogger(__name__)
+
+# окно склейки вызовов update_user_data одного цикла Application в одну пачку
+FLUSH_BATCH_DELAY = 0.05
+
+
+def _snapshot(data: Optional[dict]) -> str:
+    return json.dumps(data or {}, sort_keys=True, ensure_ascii=False)
+
+
+class PostgresPersistence(BasePersistence):
+    def __init__(self, update_interval: float, cache_ttl: float, cache_size: int) -> None:
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self._fresh = TTLCache(cache_size, cache_ttl)
+        # user_data отданы хендлеру и ещё не вернулись в update_user_data:
+        # хендлер мог работать дольше cache_ttl, а запись из кеша — вытесниться
+        self._in_use: Set[int] = set()
+        self._pending: Dict[int, Optional[dict]] = {}  # None — удалить
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.flushes = 0
+        self.skipped = 0
+
+    # ---------- user_data ----------
+    async def get_user_data(self) -> Dict[int, dict]:
+        # всё разом не грузим: данные подтягиваются в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        unsaved = user_id in self._in_use or user_id in self._pending
+        self._in_use.add(user_id)
+        if unsaved or self._fresh.get(user_id) is not None:
+            return
+        data = await load_user_data(user_id)
+        self.loads += 1
+        if data:
+            user_data.update(data)
+        self._fresh.set(user_id, _snapshot(user_data))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._in_use.discard(user_id)
+        snapshot = _snapshot(data)
+        if user_id not in self._pending and self._fresh.get(user_id) == snapshot:
+            self.skipped += 1
+            return
+        self._pending[user_id] = data
+        self._fresh.set(user_id, snapshot)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._in_use.discard(user_id)
+        self._pending[user_id] = None
+        self._fresh.pop(user_id)
+        self._schedule_flush()
+
+    # ---------- запись ----------
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self) -> None:
+        await asyncio.sleep(FLUSH_BATCH_DELAY)
+        while self._pending:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(
+                    "Не удалось сохранить user_data, повтор через %s с", self.update_interval
+                )
+                await asyncio.sleep(self.update_interval)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await save_user_data({k: v for k, v in batch.items() if v is not None})
+                await delete_user_data([k for k, v in batch.items() if v is None])
+            except Exception:
+                # вернуть в буфер, не затирая то, что пришло за время записи
+                for user_id, data in batch.items():
+                    self._pending.setdefault(user_id, data)
+                raise
+            self.flushes += 1
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "pending": len(self._pending),
+            "in_use": len(self._in_use),
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "skipped": self.skipped,
+            "cache": self._fresh.stats(),
+        }
+
+    # ---------- остальное не храним ----------
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,255 @@
+"""
+Прогрев кеша отчётов в часы низкой нагрузки.
+Промах кеша стоит 5–30 с работы LLM, а спрос на даты сильно перекошен,
+поэтому самые востребованные отчёты выгодно сгенерировать заранее.
+
+Спрос оценивается по истории user_reports за prewarm_history_days: число
+разных пользователей даты × доля пары (режим, ИИ) среди всех запросов.
+Так прогреваются и сочетания, которые для популярной даты ещё никто не
+спрашивал, и отчёты, устаревшие после смены PROMPT_VERSION. Даты, у которых
+день рождения в пределах prewarm_around_today дней от сегодня, весят больше:
+их ждут поздравляющие. Такие даты прогреваются и без истории — для каждого
+года рождения из выборки со спросом «пользователи этого года / 365».
+
+В окно prewarm_window_start–prewarm_window_end проходы повторяются раз в
+prewarm_check_interval, пока не кончится бюджет окна. Запросы к LLM идут с
+фоновым приоритетом планировщика и пропускают вперёд пользователей. Проход
+выполняет один процесс за раз (advisory-блокировка); бюджет — на процесс.
+
+`python prewarm.py` печатает, что было бы прогрето сейчас.
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import json
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from config import settings
+from db import advisory_lock, close_db, combo_demand, date_demand, existing_reports, init_db
+from llm_scheduler import PRIORITY_BACKGROUND, request_context
+from metrics import register_stats
+from prompts import PROMPT_VERSION
+from reports import prewarm_report
+
+logger = logging.getLogger(__name__)
+
+# произвольная константа для pg_try_advisory_lock
+PREWARM_LOCK = 7_301_002
+BIRTHDAY_BOOST = 2.0
+MIN_COMBO_SHARE = 0.05  # редкие пары (режим, ИИ) не прогреваем
+DATES_PER_SLOT = 4  # дат из истории на одно место в проходе
+MAX_FAILURES = 3  # подряд — LLM недоступна, проход прерывается
+# пока истории нет — значения по умолчанию из бота
+DEFAULT_COMBO = ("master", "yandex")
+
+Key = Tuple[str, str, str]
+
+_task: Optional[asyncio.Task] = None
+_window: Optional[dt.date] = None
+_spent = 0
+# отчёт за эти ключи написал другой ИИ (failover): до конца окна не повторяем
+_diverted: Set[Key] = set()
+
+PREWARM_STATS: Dict[str, int] = {
+    "passes": 0,
+    "generated": 0,
+    "failover": 0,
+    "failed": 0,
+    "missing": 0,
+}
+
+
+# ---------- окно ----------
+def window_start(now: dt.datetime) -> Optional[dt.date]:
+    """День, в который началось текущее окно прогрева; None — сейчас не окно."""
+    start, end = settings.prewarm_window_start, settings.prewarm_window_end
+    hour = now.hour
+    if start <= end:
+        return now.date() if start <= hour < end else None
+    if hour >= start:
+        return now.date()
+    if hour < end:
+        return now.date() - dt.timedelta(days=1)
+    return None
+
+
+# ---------- спрос ----------
+def _near_birthday(date_str: str, today: dt.date, days: int) -> bool:
+    try:
+        day, month, _ = (int(x) for x in date_str.split("."))
+        birthday = dt.date(today.year, month, day)
+    except ValueError:
+        # 29.02 в невисокосный год и нестандартные строки
+        return False
+    delta = abs((birthday - today).days)
+    return min(delta, 365 - delta) <= days
+
+
+def birthday_candidates(
+    dates: List[Tuple[str, int]], today: dt.date, days: int
+) -> List[Tuple[str, float]]:
+    """
+    Даты без истории, у которых день рождения в пределах ±days от today:
+    годы берутся из dates, ожидаемый спрос — пользователи года на один день.
+    """
+    per_year: Dict[int, int] = {}
+    for date_str, users in dates:
+        try:
+            year = int(date_str.rsplit(".", 1)[1])
+        except (IndexError, ValueError):
+            continue
+        per_year[year] = per_year.get(year, 0) + users
+    known = {date_str for date_str, _ in dates}
+
+    candidates = []
+    for offset in range(-days, days + 1):
+        day = today + dt.timedelta(days=offset)
+        for year, users in per_year.items():
+            try:
+                date_str = dt.date(year, day.month, day.day).strftime("%d.%m.%Y")
+            except ValueError:
+                continue  # 29.02 в невисокосный год
+            if date_str not in known:
+                candidates.append((date_str, users / 365))
+    return candidates
+
+
+def rank(
+    dates: Iterable[Tuple[str, float]],
+    combos: Iterable[Tuple[str, str, int]],
+    today: dt.date,
+) -> List[Tuple[float, Key]]:
+    """Ожидаемый спрос на каждый ключ (date_str, mode, ai), по убыванию."""
+    counts = {(mode, ai): n for mode, ai, n in combos}
+    total = sum(counts.values())
+    shares = {combo: n / total for combo, n in counts.items()} if total else {DEFAULT_COMBO: 1.0}
+    shares = {combo: share for combo, share in shares.items() if share >= MIN_COMBO_SHARE}
+
+    ranked = []
+    for date_str, users in dates:
+        weight = float(users)
+        if _near_birthday(date_str, today, settings.prewarm_around_today):
+            weight *= BIRTHDAY_BOOST
+        for (mode, ai), share in shares.items():
+            ranked.append((weight * share, (date_str, mode, ai)))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
+
+
+async def missing_reports(limit: int, today: dt.date) -> List[Tuple[float, Key]]:
+    """Самые востребованные ключи, которых нет в БД для текущей версии промпта."""
+    days = settings.prewarm_history_days
+    dates = [(r["date_str"], r["users"]) for r in await date_demand(days, limit * DATES_PER_SLOT)]
+    dates += birthday_candidates(dates, today, settings.prewarm_around_today)
+    combos = await combo_demand(days)
+    ranked = rank(
+        dates,
+        ((r["mode"], r["ai"], r["requests"]) for r in combos),
+        today,
+    )[: limit * DATES_PER_SLOT]
+    existing = await existing_reports([key for _, key in ranked], PROMPT_VERSION)
+    return [
+        (score, key) for score, key in ranked if key not in existing and key not in _diverted
+    ][:limit]
+
+
+# ---------- прогрев ----------
+async def run_pass(limit: int) -> int:
+    """Один проход: генерирует до limit отчётов; возвращает, сколько потрачено попыток."""
+    candidates = await missing_reports(limit, dt.date.today())
+    PREWARM_STATS["missing"] = len(candidates)
+    PREWARM_STATS["passes"] += 1
+    if not candidates:
+        return 0
+
+    slots = asyncio.Semaphore(settings.prewarm_concurrency)
+    failures = 0
+    spent = 0
+
+    async def warm(key: Key) -> None:
+        nonlocal failures, spent
+        async with slots:
+            if failures >= MAX_FAILURES or window_start(dt.datetime.now()) is None:
+                return
+            spent += 1
+            try:
+                stored_ai = await prewarm_report(*key)
+            except Exception:
+                logger.exception("Не удалось прогреть отчёт %s", key)
+                stored_ai = None
+            if stored_ai is None:
+                failures += 1
+                PREWARM_STATS["failed"] += 1
+                return
+            failures = 0
+            PREWARM_STATS["generated"] += 1
+            if stored_ai != key[2]:
+                PREWARM_STATS["failover"] += 1
+                _diverted.add(key)
+
+    with request_context(PRIORITY_BACKGROUND):
+        await asyncio.gather(*(warm(key) for _, key in candidates))
+    if failures >= MAX_FAILURES:
+        logger.warning("Прогрев прерван: %s неудач подряд", failures)
+    logger.info("Прогрев: %s из %s отчётов", spent, len(candidates))
+    return spent
+
+
+async def _loop() -> None:
+    global _window, _spent
+    while True:
+        await asyncio.sleep(settings.prewarm_check_interval)
+        window = window_start(dt.datetime.now())
+        if window is None:
+            continue
+        if window != _window:
+            _window, _spent = window, 0
+            _diverted.clear()
+        left = settings.prewarm_budget - _spent
+        if left <= 0:
+            continue
+        try:
+            async with advisory_lock(PREWARM_LOCK) as locked:
+                if locked:
+                    _spent += await run_pass(min(settings.prewarm_batch, left))
+        except Exception:
+            logger.exception("Сбой прогрева кеша")
+
+
+# ---------- жизненный цикл ----------
+def start_prewarm() -> None:
+    global _task
+    if settings.prewarm_budget <= 0 or _task is not None:
+        return
+    _task = asyncio.create_task(_loop())
+
+
+async def stop_prewarm() -> None:
+    global _task
+    if _task is None:
+        return
+    task, _task = _task, None
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def prewarm_stats() -> Dict[str, int]:
+    return {**PREWARM_STATS, "spent": _spent}
+
+
+register_stats("prewarm", prewarm_stats)
+
+
+async def _preview() -> None:
+    await init_db()
+    try:
+        for score, (date_str, mode, ai) in await missing_reports(settings.prewarm_batch, dt.date.today()):
+            print(json.dumps({"date": date_str, "mode": mode, "ai": ai, "score": round(score, 2)}))
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_preview())
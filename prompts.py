@@ -0,0 +1,140 @@
+"""
+Промпты для генерации отчётов.
+Общие для YandexGPT и DeepSeek. Промпт отчёта версионируется: каждая
+версия — своя функция в REPORT_PROMPTS, PROMPT_VERSION — последняя из них,
+и она входит в ключ хранения отчётов и фрагментов. Текст промпта не
+правится на месте: изменение — новая функция _report_vN и запись в
+REPORT_PROMPTS (промпты фрагментов и вступления тоже относятся к текущей
+версии — их изменение тоже новая версия).
+
+Чтобы версия не разошлась с текстом незаметно, у каждой версии записан
+отпечаток её промптов (PROMPT_FINGERPRINTS): если текущие промпты с ним не
+совпадают, модуль не импортируется — бот не стартует с отчётами под чужой
+версией. Новая версия — новая запись с отпечатком из текста ошибки.
+
+После смены версии отчёты старых версий не теряются: их выдают, пока
+regenerate.py или прогрев не напишут замену. Если старая версия писала
+недопустимое, OLDEST_SERVED_VERSION поднимается до первой приемлемой —
+более старые отчёты генерируются заново при запросе.
+"""
+import hashlib
+import json
+from typing import Callable, Dict, List
+
+MODE_DESC = {
+    "default": "краткий эзотерический отчёт",
+    "deep": "глубокий нумерологический анализ",
+    "master": "полный эзотерический портрет по методике Хшановской",
+}
+
+
+def _report_v1(structure: List[str], mode: str) -> str:
+    return (
+        f"Ты — эзотерический нумеролог. Напиши {MODE_DESC[mode]} на основе данных ниже. "
+        "Говори мягко, вдохновляюще, наставнически. Не задавай вопросов, "
+        "не ссылайся на источники, не философствуй. "
+        "не удаляя эмодзи-иконки и не меняя заголовки. "
+        "Добавь по 1-3 предложения под каждым пунктом, сохрани формат «эмодзи + заголовок».\n\n"
+        "Заверши текст: «Если почувствуешь, что это о тебе — это не совпадение. "
+        "Всё записано в дате.» "
+        "«Если ты узнал себя — поставь ⭐ или сохрани расклад.»\n\n"
+        "Данные:\n" + "\n".join(structure)
+    )
+
+
+# версия → промпт; старые версии остаются — по ним написаны отчёты в БД
+REPORT_PROMPTS: Dict[int, Callable[[List[str], str], str]] = {
+    1: _report_v1,
+}
+PROMPT_VERSION = max(REPORT_PROMPTS)
+OLDEST_SERVED_VERSION = 1  # отчёты более старых версий пользователям не выдаются
+
+
+def build_report_prompt(structure: List[str], mode: str, version: int = PROMPT_VERSION) -> str:
+    """Промпт для отчёта по списку строк-фрагментов build_report_structure."""
+    return REPORT_PROMPTS[version](structure, mode)
+
+
+# ---------- отчёт из фрагментов (fragments.py) ----------
+SEPARATOR = "---"
+# концовка, которую в цельном отчёте дописывает модель
+REPORT_CLOSING = (
+    "Если почувствуешь, что это о тебе — это не совпадение. Всё записано в дате.\n"
+    "Если ты узнал себя — поставь ⭐ или сохрани расклад."
+)
+
+
+def build_fragments_prompt(lines: List[str], mode: str) -> str:
+    """Пояснения к отдельным пунктам, общие для всех, у кого такое же значение."""
+    return (
+        f"Ты — эзотерический нумеролог. Пункты ниже войдут в {MODE_DESC[mode]}. "
+        "Говори мягко, вдохновляюще, наставнически. Не задавай вопросов, "
+        "не ссылайся на источники, не философствуй. "
+        "Повтори каждый пункт отдельной строкой без изменений, не удаляя эмодзи-иконки "
+        "и не меняя заголовки, и добавь под ним 1-3 предложения пояснения. "
+        "Без вступления и заключения.\n\n"
+        "Данные:\n" + "\n".join(lines)
+    )
+
+
+def build_intro_prompt(structure: List[str], mode: str) -> str:
+    """Короткие личные вступление и заключение к отчёту из фрагментов."""
+    return (
+        f"Ты — эзотерический нумеролог. Человек получает {MODE_DESC[mode]} по данным ниже. "
+        "Напиши к нему личное вступление в 1-2 предложения и такое же короткое заключение. "
+        "Говори мягко, вдохновляюще, не задавай вопросов. "
+        f"Раздели вступление и заключение строкой «{SEPARATOR}», больше ничего не пиши.\n\n"
+        "Данные:\n" + "\n".join(structure)
+    )
+
+
+def report_prompt_prefixes() -> List[str]:
+    """
+    Общие для всех дат начала промптов (всё до раздела «Данные»), по режимам.
+    Локальный DeepSeek кеширует для них KV-префикс: `python prompts.py`
+    печатает JSON для PREFIX_CACHE_FILE.
+    """
+    return [
+        build([], mode)
+        for build in (
+            build_report_prompt,
+            build_fragments_prompt,
+            build_intro_prompt,
+        )
+        for mode in MODE_DESC
+    ]
+
+
+# ---------- контроль версий ----------
+# отпечаток промптов версии: отчёт, фрагменты и вступление по всем режимам
+PROMPT_FINGERPRINTS: Dict[int, str] = {
+    1: "bef29a2ad6240ec4",
+}
+# на чём проверять: разделитель строк данных — тоже часть промпта
+_PROBE = ["🔢 Раздел: 1", "🔢 Раздел: 2"]
+
+
+def prompt_fingerprint() -> str:
+    """Отпечаток промптов текущей версии."""
+    texts = [
+        build(_PROBE, mode)
+        for build in (build_report_prompt, build_fragments_prompt, build_intro_prompt)
+        for mode in MODE_DESC
+    ]
+    return hashlib.sha256("\0".join(texts).encode()).hexdigest()[:16]
+
+
+def _check_version() -> None:
+    actual = prompt_fingerprint()
+    if PROMPT_FINGERPRINTS.get(PROMPT_VERSION) != actual:
+        raise RuntimeError(
+            f"Промпты не совпадают с версией {PROMPT_VERSION}: текст промпта правится "
+            f"только новой версией в REPORT_PROMPTS, её отпечаток — {actual}"
+        )
+
+
+_check_version()
+
+
+if __name__ == "__main__":
+    print(json.dumps(report_prompt_prefixes(), ensure_ascii=False, indent=2))
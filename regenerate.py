@@ -0,0 +1,127 @@
+"""
+Перегенерация отчётов, устаревших после смены PROMPT_VERSION.
+Пока замены нет, пользователям выдаётся отчёт старой версии (см. reports),
+поэтому спешить незачем: ключи (дата, режим, ИИ) идут по убыванию числа
+пользователей за regenerate_history_days, не больше regenerate_concurrency
+одновременно и с фоновым приоритетом планировщика — запросы пользователей
+проходят вперёд.
+
+Прогресс хранится в самой БД — это отчёты новой версии: прерванный запуск
+следующий продолжит с того же места. Запуск держит блокировку прогрева,
+чтобы не генерировать одно и то же вдвоём, и останавливается после
+MAX_FAILURES неудач генерации подряд (LLM недоступна). Отчёт, который
+router отдал другому ИИ, записан под другим ключом — это не неудача, но
+ключ остаётся устаревшим и до конца запуска пропускается. Старые версии
+не удаляются — их, как и прочие отчёты без запросов, уберёт обслуживание
+хранилища.
+
+    python regenerate.py [--limit N] [--concurrency K] [--dry-run]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import settings
+from db import advisory_lock, close_db, init_db, outdated_reports
+from llm_client import close_client
+from llm_scheduler import PRIORITY_BACKGROUND, request_context
+from prewarm import MAX_FAILURES, PREWARM_LOCK
+from prompts import PROMPT_VERSION
+from reports import prewarm_report
+from token_usage import start_usage_accounting, stop_usage_accounting
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, str, str]
+
+
+async def next_batch(size: int, skip: Set[Key]) -> List[Key]:
+    """Самые востребованные устаревшие ключи, кроме уже пройденных в этом запуске."""
+    rows = await outdated_reports(
+        PROMPT_VERSION, settings.regenerate_history_days, size + len(skip)
+    )
+    keys = [(r["date_str"], r["mode"], r["ai"]) for r in rows]
+    return [key for key in keys if key not in skip][:size]
+
+
+async def regenerate(limit: Optional[int], concurrency: int) -> Dict[str, int]:
+    """Перегенерирует до limit отчётов (None — все); итоговые счётчики."""
+    stats = {"generated": 0, "failover": 0, "failed": 0}
+    skip: Set[Key] = set()
+    slots = asyncio.Semaphore(concurrency)
+    failures = 0
+    attempted = 0
+
+    async def one(key: Key) -> None:
+        nonlocal failures
+        async with slots:
+            if failures >= MAX_FAILURES:
+                return
+            try:
+                stored_ai = await prewarm_report(*key)
+            except Exception:
+                logger.exception("Не удалось перегенерировать отчёт %s", key)
+                stored_ai = None
+            if stored_ai is None:
+                failures += 1
+                skip.add(key)
+                stats["failed"] += 1
+                return
+            failures = 0
+            stats["generated"] += 1
+            if stored_ai != key[2]:
+                stats["failover"] += 1
+                skip.add(key)
+
+    with request_context(PRIORITY_BACKGROUND):
+        while failures < MAX_FAILURES:
+            size = settings.regenerate_batch
+            if limit is not None:
+                size = min(size, limit - attempted)
+            keys = await next_batch(size, skip) if size > 0 else []
+            if not keys:
+                break
+            attempted += len(keys)
+            await asyncio.gather(*(one(key) for key in keys))
+            logger.info(
+                "Перегенерировано %s (другим ИИ %s), не удалось %s",
+                stats["generated"],
+                stats["failover"],
+                stats["failed"],
+            )
+    if failures >= MAX_FAILURES:
+        logger.warning("Перегенерация прервана: %s неудач подряд", failures)
+    return stats
+
+
+async def _main(args: argparse.Namespace) -> None:
+    await init_db()
+    await start_usage_accounting()
+    try:
+        if args.dry_run:
+            size = args.limit or settings.regenerate_batch
+            for r in await outdated_reports(PROMPT_VERSION, settings.regenerate_history_days, size):
+                print(json.dumps(dict(r), ensure_ascii=False))
+            return
+        async with advisory_lock(PREWARM_LOCK) as locked:
+            if not locked:
+                print("Прогрев или перегенерация уже идут в другом процессе")
+                return
+            print(json.dumps(await regenerate(args.limit, args.concurrency)))
+    finally:
+        await stop_usage_accounting()
+        await close_client()
+        await close_db()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=f"Перегенерация отчётов до версии {PROMPT_VERSION}")
+    parser.add_argument("--limit", type=int, default=None, help="не больше N отчётов")
+    parser.add_argument("--concurrency", type=int, default=settings.regenerate_concurrency)
+    parser.add_argument("--dry-run", action="store_true", help="только показать очередь")
+    asyncio.run(_main(parser.parse_args()))
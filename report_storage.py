@@ -0,0 +1,161 @@
+"""
+Обслуживание хранилища отчётов (схема — в db.py, сжатие — в compression).
+Раз в reports_maintenance_interval один из процессов (advisory-блокировка):
+- заводит секции report_bodies на reports_partitions_ahead месяцев вперёд;
+- обучает словарь zstd на последних отчётах, если его нет или он старше
+  reports_dict_retrain_days; остальные процессы подхватывают его на
+  следующем круге;
+- переносит тексты, записанные до сжатия, в report_bodies и пережимает
+  словарём тела, сжатые без него;
+- удаляет отчёты, которые не запрашивали reports_retention_days дней,
+  а с ними — секции тел, целиком вышедшие за этот срок, осиротевшие тела
+  и ненужные словари.
+
+`python report_storage.py` выполняет один круг и печатает итог.
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import json
+import logging
+from typing import Dict, Optional
+
+from compression import train
+from config import settings
+from db import (
+    add_dictionary,
+    advisory_lock,
+    close_db,
+    compact_legacy_reports,
+    delete_orphan_bodies,
+    delete_unused_dictionaries,
+    dictionary_samples,
+    drop_expired_partitions,
+    ensure_body_partitions,
+    expire_reports,
+    init_db,
+    load_current_dictionary,
+    recompress_bodies,
+)
+from metrics import register_stats
+
+logger = logging.getLogger(__name__)
+
+# произвольная константа для pg_try_advisory_lock
+MAINTENANCE_LOCK = 7_301_003
+# компактация идёт пачками, чтобы не держать долгих транзакций
+MAX_BATCHES = 100
+
+_task: Optional[asyncio.Task] = None
+
+STORAGE_STATS: Dict[str, int] = {
+    "runs": 0,
+    "dictionaries": 0,
+    "compacted": 0,
+    "recompressed": 0,
+    "expired": 0,
+    "orphans": 0,
+    "dropped_partitions": 0,
+}
+
+
+async def _maybe_train(trained_at: Optional[dt.datetime]) -> bool:
+    if trained_at is not None and dt.datetime.now() - trained_at < dt.timedelta(
+        days=settings.reports_dict_retrain_days
+    ):
+        return False
+    samples = await dictionary_samples(settings.reports_dict_samples)
+    if len(samples) < settings.reports_dict_min_samples:
+        return False
+    # обучение — секунды CPU, не держим event loop
+    data = await asyncio.to_thread(train, samples, settings.reports_dict_size)
+    dict_id = await add_dictionary(data, len(samples))
+    logger.info("Обучен словарь отчётов %s на %s образцах", dict_id, len(samples))
+    return True
+
+
+async def _batches(fn) -> int:
+    total = 0
+    for _ in range(MAX_BATCHES):
+        done = await fn(settings.reports_compaction_batch)
+        total += done
+        if done < settings.reports_compaction_batch:
+            break
+    return total
+
+
+async def run_maintenance() -> Dict[str, int]:
+    """Один круг обслуживания; что сделано."""
+    result: Dict[str, int] = {}
+    await ensure_body_partitions(settings.reports_partitions_ahead)
+    trained_at = await load_current_dictionary()
+    result["dictionaries"] = int(await _maybe_train(trained_at))
+    result["compacted"] = await _batches(compact_legacy_reports)
+    result["recompressed"] = await _batches(recompress_bodies)
+    if settings.reports_retention_days > 0:
+        result["expired"] = await expire_reports(settings.reports_retention_days)
+        dropped = await drop_expired_partitions(settings.reports_retention_days)
+        result["dropped_partitions"] = len(dropped)
+        if dropped:
+            logger.info("Удалены секции тел отчётов: %s", ", ".join(dropped))
+    result["orphans"] = await delete_orphan_bodies()
+    await delete_unused_dictionaries()
+    for key, value in result.items():
+        STORAGE_STATS[key] += value
+    STORAGE_STATS["runs"] += 1
+    return result
+
+
+async def _loop() -> None:
+    while True:
+        try:
+            async with advisory_lock(MAINTENANCE_LOCK) as locked:
+                if locked:
+                    await run_maintenance()
+                else:
+                    # обслуживает другой процесс — только подхватить его словарь
+                    await load_current_dictionary()
+        except Exception:
+            logger.exception("Сбой обслуживания хранилища отчётов")
+        await asyncio.sleep(settings.reports_maintenance_interval)
+
+
+# ---------- жизненный цикл ----------
+def start_maintenance() -> None:
+    global _task
+    if settings.reports_maintenance_interval <= 0 or _task is not None:
+        return
+    _task = asyncio.create_task(_loop())
+
+
+async def stop_maintenance() -> None:
+    global _task
+    if _task is None:
+        return
+    task, _task = _task, None
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def storage_stats() -> Dict[str, int]:
+    return dict(STORAGE_STATS)
+
+
+register_stats("report_storage", storage_stats)
+
+
+async def _main() -> None:
+    await init_db()
+    try:
+        async with advisory_lock(MAINTENANCE_LOCK) as locked:
+            if not locked:
+                print("Обслуживание уже выполняет другой процесс")
+                return
+            print(json.dumps(await run_maintenance()))
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,196 @@
+"""
+Получение отчёта по дате: память процесса → Postgres → генерация ИИ
+(целиком или, с report_fragments, сборкой из фрагментов — см. fragments).
+Одновременные промахи по одному ключу склеиваются в одну генерацию.
+Пока отчёт текущей версии промпта не написан, из БД выдаётся самый
+новый из старых (не старше OLDEST_SERVED_VERSION) — его заменят
+regenerate.py или прогрев; в память процесса такой отчёт не попадает,
+чтобы замена была видна сразу.
+Если вызывающий передал приёмник stream, генерация идёт потоком и
+текст показывается пользователю по мере прихода.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from build_report import build_report_structure
+from cache import SingleFlight, TTLCache
+from config import settings
+from db import get_cached_report, record_report_request, save_report
+from deepseek_client import FAILED_MARK as DEEPSEEK_FAILED_MARK, stream_via_deepseek
+from fragments import compose_report
+from llm_client import DeadlineExceeded, LLMStreamError, deadline_after, time_left
+from metrics import CACHE_LOOKUPS, RAW_FALLBACKS, in_flight, register_stats, track
+from numerology import calculate
+from prompts import OLDEST_SERVED_VERSION, PROMPT_VERSION
+from router import is_failed, plan, record_outcome, route_generation
+from telegram_stream import StreamingMessage
+from yandex_gpt import FAILED_MARK as YANDEX_FAILED_MARK, stream_via_yandex
+
+logger = logging.getLogger(__name__)
+
+memory_cache = TTLCache(settings.report_cache_size, settings.report_cache_ttl)
+flights = SingleFlight()
+
+# ссылки на фоновые записи истории, чтобы задачи не собрал GC
+_background: Set[asyncio.Task] = set()
+
+register_stats("report_cache", memory_cache.stats)
+register_stats("singleflight", lambda: {"shared": flights.shared, "in_flight": len(flights)})
+
+
+@lru_cache(maxsize=4096)
+def report_structure(date_str: str, mode: str) -> Tuple[str, ...]:
+    """Структура отчёта — чистая функция даты и режима, считаем один раз."""
+    with track("calculate"):
+        data = calculate(date_str)
+    with track("build_report_structure"):
+        return tuple(build_report_structure(data, mode))
+
+
+async def generate_text(
+    structure: List[str], mode: str, ai: str, deadline: Optional[float] = None
+) -> Tuple[str, str]:
+    """(текст, фактический бэкенд): ai — предпочтение, решает router."""
+    return await route_generation(structure, mode, ai, deadline)
+
+
+async def _record(user_id: int, key: tuple) -> None:
+    try:
+        await record_report_request(user_id, *key)
+    except Exception:
+        logger.exception("Не удалось записать историю запроса")
+
+
+_STREAMERS: Dict[str, Callable[..., AsyncIterator[str]]] = {
+    "yandex": stream_via_yandex,
+    "deepseek": stream_via_deepseek,
+}
+
+
+async def stream_text(
+    structure: List[str], mode: str, ai: str, stream: StreamingMessage
+) -> Tuple[str, str]:
+    """
+    Потоковая генерация в stream через бэкенд, который выбрал router.
+    Если поток не открылся — обычная генерация с ретраями и failover;
+    если оборвался на середине — показанный текст помечается как
+    несгенерированный и в кеш не попадает.
+    """
+    deadline = deadline_after(settings.llm_deadline)
+    backend = plan(ai, time_left(deadline))[0]
+    streamer = _STREAMERS[backend]
+    failed_mark = DEEPSEEK_FAILED_MARK if backend == "deepseek" else YANDEX_FAILED_MARK
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    parts: List[str] = []
+    try:
+        with in_flight(f"llm_{backend}"):
+            async for delta in streamer(structure, mode, deadline=deadline):
+                parts.append(delta)
+                await stream.feed(delta)
+    except (LLMStreamError, DeadlineExceeded) as exc:
+        if not parts:
+            logger.warning("Поток не открылся (%s), генерируем целиком", exc)
+            record_outcome(backend, False, loop.time() - started)
+            return await generate_text(structure, mode, ai, deadline)
+        logger.warning("Поток оборвался: %s", exc)
+        record_outcome(backend, False, loop.time() - started)
+        tail = "\n\n" + failed_mark
+        await stream.feed(tail)
+        parts.append(tail)
+        return "".join(parts).strip(), backend
+    if not parts:
+        return await generate_text(structure, mode, ai, deadline)
+    record_outcome(backend, True, loop.time() - started)
+    return "".join(parts).strip(), backend
+
+
+def _record_in_background(user_id: int, key: tuple) -> None:
+    task = asyncio.create_task(_record(user_id, key))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def _load_or_generate(
+    user_id: Optional[int],
+    key: tuple,
+    stream: Optional[StreamingMessage],
+    oldest_version: int = OLDEST_SERVED_VERSION,
+) -> Tuple[str, tuple]:
+    """(текст, ключ, под которым он хранится); oldest_version — старейшая годная версия."""
+    date_str, mode, ai, prompt_version = key
+    with track("db_lookup"):
+        cached = await get_cached_report(
+            user_id, date_str, mode, ai, prompt_version, oldest_version
+        )
+    if cached:
+        text, version = cached
+        CACHE_LOOKUPS.labels("db", "hit" if version == prompt_version else "stale").inc()
+        return text, (date_str, mode, ai, version)
+    CACHE_LOOKUPS.labels("db", "miss").inc()
+
+    structure = list(report_structure(date_str, mode))
+    if settings.report_fragments:
+        # сборка из готовых пояснений быстрая — поток не нужен
+        text, backend = await compose_report(structure, mode, ai)
+    elif stream is not None:
+        text, backend = await stream_text(structure, mode, ai, stream)
+    else:
+        text, backend = await generate_text(structure, mode, ai)
+    if is_failed(text):
+        RAW_FALLBACKS.labels(backend).inc()
+    else:
+        # отчёт хранится под тем ИИ, который его написал на самом деле
+        with track("db_save"):
+            await save_report(user_id, date_str, mode, backend, prompt_version, text)
+    return text, (date_str, mode, backend, prompt_version)
+
+
+async def get_report(
+    user_id: int,
+    date_str: str,
+    mode: str,
+    ai: str,
+    stream: Optional[StreamingMessage] = None,
+) -> str:
+    """
+    Возвращает полный текст отчёта. Если stream.started после вызова,
+    текст уже показан пользователю потоком и остаётся вызвать stream.finish().
+    """
+    key = (date_str, mode, ai, PROMPT_VERSION)
+
+    text = memory_cache.get(key)
+    CACHE_LOOKUPS.labels("memory", "miss" if text is None else "hit").inc()
+    if text is not None:
+        _record_in_background(user_id, key)
+        return text
+
+    (text, stored_key), shared = await flights.do(
+        key, lambda: _load_or_generate(user_id, key, stream)
+    )
+    if shared:
+        # историю за нас записал только ведущий вызов
+        CACHE_LOOKUPS.labels("singleflight", "hit").inc()
+        _record_in_background(user_id, stored_key)
+    if not is_failed(text) and stored_key[3] == PROMPT_VERSION:
+        memory_cache.set(stored_key, text)
+    return text
+
+
+async def prewarm_report(date_str: str, mode: str, ai: str) -> Optional[str]:
+    """
+    Генерирует и сохраняет отчёт текущей версии впрок, без пользователя и
+    без записи в память процесса (её занимают отчёты, которые спрашивают
+    сейчас). Возвращает ИИ, под которым отчёт лежит в БД: router мог отдать
+    генерацию другому бэкенду; None — сгенерировать не удалось.
+    """
+    key = (date_str, mode, ai, PROMPT_VERSION)
+    # отдельная склейка: пользовательская может закончиться отчётом старой версии
+    (text, stored_key), _ = await flights.do(
+        ("prewarm", *key), lambda: _load_or_generate(None, key, None, PROMPT_VERSION)
+    )
+    return None if is_failed(text) else stored_key[2]
@@ -0,0 +1,144 @@
+"""
+Примитивы отказоустойчивости для вызовов внешних моделей:
+CircuitBreaker — пропуск заведомо нерабочей модели до успешной пробы,
+LatencyTracker — скользящее окно латентностей с перцентилями,
+TokenBucket — ограничение частоты запросов.
+"""
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    closed → (failure_threshold ошибок подряд) → open → (reset_timeout) →
+    half_open: пропускается одна проба; успех закрывает, ошибка снова открывает.
+    Проба без исхода (отменена, не дождалась квоты) возвращается через
+    release_probe; забытая проба истекает через reset_timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self.opened_total = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN:
+            now = time.monotonic()
+            if self._probe_in_flight and now - self._probe_started < self.reset_timeout:
+                return False
+            self._probe_in_flight = True
+            self._probe_started = now
+            return True
+        return False
+
+    def release_probe(self) -> None:
+        """Проба завершилась ни успехом, ни ошибкой модели: пустить следующую."""
+        if self._state == HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self._state = CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != OPEN:
+                self.opened_total += 1
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "opened_total": self.opened_total,
+        }
+
+
+class LatencyTracker:
+    """
+    Последние window латентностей (секунды). Для отменённых вызовов
+    наблюдается прошедшее время — нижняя оценка настоящей латентности.
+    """
+
+    def __init__(self, window: int = 200) -> None:
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """q в [0, 1]; None, пока нет ни одного замера."""
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst про запас."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def reserve(self, max_wait: Optional[float]) -> Optional[float]:
+        """
+        Бронирует токен в долг и возвращает, сколько ждать его прихода;
+        None (без брони), если ждать дольше max_wait.
+        """
+        wait = self.delay()
+        if max_wait is not None and wait > max_wait:
+            return None
+        self._tokens -= 1
+        return wait
+
+    def hold(self, seconds: float) -> None:
+        """Следующий токен появится не раньше чем через seconds (flood-wait)."""
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
@@ -0,0 +1,172 @@
+"""
+Маршрутизация генерации между YandexGPT и локальным DeepSeek.
+Каждый запрос получает сквозной дедлайн. По каждому бэкенду ведётся
+скользящая статистика латентностей и ошибок; выбранный пользователем
+бэкенд используется, пока он здоров и укладывается в бюджет, иначе
+запрос переливается на другой (spill-over), а при сбое — переходит
+на него (failover) в пределах того же дедлайна.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from config import settings
+from deepseek_client import FAILED_MARK as DEEPSEEK_FAILED_MARK, generate_via_deepseek
+from llm_client import deadline_after, time_left
+from metrics import LLM_GENERATION_SECONDS, in_flight, register_stats
+from resilience import LatencyTracker
+from yandex_gpt import FAILED_MARK as YANDEX_FAILED_MARK, generate_via_yandex
+
+logger = logging.getLogger(__name__)
+
+# бюджет по умолчанию, пока у бэкенда нет замеров латентности
+DEFAULT_EXPECTED_LATENCY = 20.0
+
+
+def is_failed(text: str) -> bool:
+    """«Сырой» текст после сбоя ИИ — не кешируем ни в памяти, ни в БД."""
+    return text.endswith((YANDEX_FAILED_MARK, DEEPSEEK_FAILED_MARK))
+
+
+class BackendHealth:
+    def __init__(self, window: int) -> None:
+        self.latency = LatencyTracker(window)
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self._last_attempt = 0.0
+
+    def record(self, ok: bool, seconds: float) -> None:
+        self._last_attempt = time.monotonic()
+        self.requests += 1
+        self._outcomes.append(ok)
+        if ok:
+            self.latency.observe(seconds)
+        else:
+            self.errors += 1
+
+    @property
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def expected_latency(self) -> float:
+        p90 = self.latency.percentile(0.9)
+        return DEFAULT_EXPECTED_LATENCY if p90 is None else p90
+
+    def is_healthy(self, budget: Optional[float]) -> bool:
+        """
+        Ошибок не больше порога и обычная латентность влезает в бюджет.
+        Больной бэкенд раз в router_probe_interval получает пробный запрос,
+        иначе без трафика он никогда не вернулся бы в строй.
+        """
+        if (
+            len(self._outcomes) >= settings.router_min_samples
+            and self.error_rate > settings.router_max_error_rate
+        ):
+            if time.monotonic() - self._last_attempt < settings.router_probe_interval:
+                return False
+            self._last_attempt = time.monotonic()
+        return budget is None or self.expected_latency() <= budget
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.error_rate,
+            "latency_p50": self.latency.percentile(0.5),
+            "latency_p90": self.latency.percentile(0.9),
+        }
+
+
+BACKENDS: Dict[str, Callable[..., Awaitable[str]]] = {
+    "yandex": generate_via_yandex,
+    "deepseek": generate_via_deepseek,
+}
+HEALTH = {name: BackendHealth(settings.router_window) for name in BACKENDS}
+ROUTER_STATS = {"preferred": 0, "spillover": 0, "failover": 0}
+
+
+def record_outcome(name: str, ok: bool, seconds: float) -> None:
+    """Итог генерации бэкендом — в статистику роутера и в метрики."""
+    HEALTH[name].record(ok, seconds)
+    LLM_GENERATION_SECONDS.labels(name, "ok" if ok else "failed").observe(seconds)
+
+
+def plan(preferred: str, budget: Optional[float]) -> List[str]:
+    """Порядок бэкендов для запроса: предпочтение пользователя, если он здоров."""
+    if preferred not in BACKENDS:
+        preferred = "yandex"
+    others = [name for name in BACKENDS if name != preferred]
+    if HEALTH[preferred].is_healthy(budget):
+        return [preferred] + others
+    healthy = [name for name in others if HEALTH[name].is_healthy(budget)]
+    if healthy:
+        logger.info("Backend %s unhealthy, spilling over to %s", preferred, healthy[0])
+        return healthy + [preferred] + [n for n in others if n not in healthy]
+    return [preferred] + others
+
+
+async def route_generation(
+    structure: List[str],
+    mode: str,
+    preferred: str,
+    deadline: Optional[float] = None,
+    *,
+    prompt: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+) -> Tuple[str, str]:
+    """
+    Генерирует отчёт, укладываясь в deadline. Возвращает (текст, бэкенд,
+    который его написал); при сбое всех бэкендов — «сырой» текст.
+    prompt и max_tokens заменяют отчётные (см. fragments).
+    """
+    options: Dict[str, object] = {}
+    if prompt is not None:
+        options["prompt"] = prompt
+    if max_tokens is not None:
+        options["max_tokens"] = max_tokens
+    if deadline is None:
+        deadline = deadline_after(settings.llm_deadline)
+    loop = asyncio.get_running_loop()
+    order = plan(preferred, time_left(deadline))
+    ROUTER_STATS["spillover" if order[0] != preferred else "preferred"] += 1
+
+    text, name = "", order[0]
+    for i, name in enumerate(order):
+        left = time_left(deadline)
+        if left is None or left <= 0:
+            break
+        # оставляем запасному бэкенду время на его обычную латентность,
+        # но не больше половины бюджета
+        call_deadline = deadline
+        if i + 1 < len(order):
+            reserve = min(HEALTH[order[i + 1]].expected_latency(), left / 2)
+            call_deadline = deadline - reserve
+        if i > 0:
+            ROUTER_STATS["failover"] += 1
+            logger.warning("Failing over from %s to %s", order[i - 1], name)
+
+        started = loop.time()
+        with in_flight(f"llm_{name}"):
+            text = await BACKENDS[name](structure, mode, deadline=call_deadline, **options)
+        ok = not is_failed(text)
+        record_outcome(name, ok, loop.time() - started)
+        if ok:
+            return text, name
+    return text or "\n".join(structure) + "\n\n" + YANDEX_FAILED_MARK, name
+
+
+def router_stats() -> Dict[str, object]:
+    return {
+        "backends": {name: h.stats() for name, h in HEALTH.items()},
+        **ROUTER_STATS,
+    }
+
+
+register_stats("router", router_stats)
@@ -0,0 +1,215 @@
+"""
+Исходящие сообщения в Telegram: нарезка длинных текстов и соблюдение
+лимитов Bot API.
+
+Длинный текст режется на сообщения не длиннее MESSAGE_LIMIT единиц UTF-16
+(так считает Telegram: эмодзи вне BMP — две единицы) — по абзацам, строкам,
+предложениям или пробелам; в крайнем случае по символам, но не внутри
+эмодзи-последовательности.
+
+Перед каждым вызовом ждём токен чата (1 сообщение в секунду в личке,
+20 в минуту в группе) и общий токен бота (30 в секунду). Части одного
+текста уходят подряд: чат занят, пока не отправлена последняя. RetryAfter
+придерживает чат на указанное время и повторяет вызов, необязательные
+вызовы (промежуточные правки потока) в этом случае просто пропускаются.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import unicodedata
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+from cache import TTLCache
+from config import settings
+from metrics import TELEGRAM_QUEUE_WAIT, TELEGRAM_RETRY_AFTER, TELEGRAM_SEND_SECONDS, register_stats
+from resilience import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MESSAGE_LIMIT = 4096  # единиц UTF-16 в тексте сообщения
+CHAT_BUCKETS_SIZE = 100_000
+CHAT_BUCKETS_TTL = 600.0
+
+ZWJ = "\u200d"
+# не отрываются от предыдущего символа: селекторы вариантов, keycap
+_EXTENDERS = {"\ufe0e", "\ufe0f", "\u20e3"}
+
+_global: Optional[TokenBucket] = None
+_buckets = TTLCache(CHAT_BUCKETS_SIZE, CHAT_BUCKETS_TTL)
+_locks: Dict[int, asyncio.Lock] = {}
+_waiters: Dict[int, int] = {}
+
+SENDER_STATS: Dict[str, int] = {"calls": 0, "chunks": 0, "skipped": 0, "retry_after": 0}
+
+
+# ---------- нарезка ----------
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fit(text: str, limit: int) -> int:
+    """Длина (в символах) самого длинного префикса не длиннее limit единиц UTF-16."""
+    units = 0
+    for i, ch in enumerate(text):
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > limit:
+            return i
+    return len(text)
+
+
+def _joined(prev: str, ch: str) -> bool:
+    """Нельзя резать между prev и ch: разорвётся эмодзи или буква с диакритикой."""
+    if prev == ZWJ or ch == ZWJ or ch in _EXTENDERS or unicodedata.combining(ch):
+        return True
+    if 0x1F3FB <= ord(ch) <= 0x1F3FF or 0xE0020 <= ord(ch) <= 0xE007F:
+        return True
+    # флаг — пара regional indicator
+    return 0x1F1E6 <= ord(prev) <= 0x1F1FF and 0x1F1E6 <= ord(ch) <= 0x1F1FF
+
+
+def split_point(text: str, limit: int) -> int:
+    """Позиция разреза в пределах limit единиц UTF-16: по абзацу, строке, предложению, пробелу."""
+    hard = _fit(text, limit)
+    if hard >= len(text):
+        return len(text)
+    for sep in ("\n\n", "\n", ". ", " "):
+        pos = text.rfind(sep, 0, hard)
+        if pos > hard // 2:
+            return pos + len(sep)
+    cut = hard
+    while cut > 1 and _joined(text[cut - 1], text[cut]):
+        cut -= 1
+    return cut if cut > 1 else hard
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Части текста для отдельных сообщений; пустых частей нет."""
+    chunks = []
+    while utf16_len(text) > limit:
+        cut = split_point(text, limit)
+        head, text = text[:cut].rstrip(), text[cut:].lstrip("\n")
+        if head.strip():
+            chunks.append(head)
+    if text.strip():
+        chunks.append(text)
+    return chunks
+
+
+# ---------- лимиты ----------
+def _global_bucket() -> TokenBucket:
+    global _global
+    if _global is None:
+        _global = TokenBucket(settings.telegram_global_rate, settings.telegram_global_burst)
+    return _global
+
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = _buckets.get(chat_id)
+    if bucket is None:
+        # отрицательный id — группа или канал, там лимит строже
+        rate = settings.telegram_chat_rate if chat_id > 0 else settings.telegram_group_rate
+        bucket = TokenBucket(rate, settings.telegram_chat_burst)
+    _buckets.set(chat_id, bucket)
+    return bucket
+
+
+async def _wait_turn(chat_id: int, optional: bool) -> bool:
+    """Дожидается токенов чата и бота; False — необязательный вызов пропущен."""
+    chat, shared = _chat_bucket(chat_id), _global_bucket()
+    if optional:
+        if chat.delay() > 0 or shared.delay() > 0:
+            return False
+        chat.take()
+        shared.take()
+        return True
+    started = time.monotonic()
+    await asyncio.sleep(chat.reserve(None))
+    TELEGRAM_QUEUE_WAIT.labels("chat").observe(time.monotonic() - started)
+    started = time.monotonic()
+    await asyncio.sleep(shared.reserve(None))
+    TELEGRAM_QUEUE_WAIT.labels("global").observe(time.monotonic() - started)
+    return True
+
+
+async def call(
+    chat_id: int,
+    fn: Callable[[], Awaitable[T]],
+    *,
+    method: str,
+    optional: bool = False,
+) -> Optional[T]:
+    """
+    Вызов Bot API с учётом лимитов и RetryAfter. None — необязательный
+    вызов пропущен (нет токена сразу или flood-wait).
+    """
+    attempt = 0
+    while True:
+        if not await _wait_turn(chat_id, optional):
+            SENDER_STATS["skipped"] += 1
+            return None
+        SENDER_STATS["calls"] += 1
+        started = time.perf_counter()
+        try:
+            result = await fn()
+        except RetryAfter as exc:
+            TELEGRAM_SEND_SECONDS.labels(method, "retry_after").observe(time.perf_counter() - started)
+            TELEGRAM_RETRY_AFTER.labels(method).inc()
+            SENDER_STATS["retry_after"] += 1
+            wait = float(exc.retry_after)
+            _chat_bucket(chat_id).hold(wait)
+            logger.warning("Flood-wait %s с в чате %s (%s)", wait, chat_id, method)
+            if optional:
+                SENDER_STATS["skipped"] += 1
+                return None
+            attempt += 1
+            if wait > settings.telegram_max_retry_after or attempt > settings.telegram_send_retries:
+                raise
+            continue
+        except Exception:
+            TELEGRAM_SEND_SECONDS.labels(method, "error").observe(time.perf_counter() - started)
+            raise
+        TELEGRAM_SEND_SECONDS.labels(method, "ok").observe(time.perf_counter() - started)
+        return result
+
+
+# ---------- отправка ----------
+async def send_text(bot: Bot, chat_id: int, text: str, **kwargs) -> List[Message]:
+    """
+    Текст любой длины, по частям и по порядку; kwargs (reply_markup и т.п.)
+    достаются последней части.
+    """
+    chunks = split_message(text)
+    lock = _locks.setdefault(chat_id, asyncio.Lock())
+    _waiters[chat_id] = _waiters.get(chat_id, 0) + 1
+    try:
+        async with lock:
+            sent = []
+            for i, chunk in enumerate(chunks):
+                extra = kwargs if i == len(chunks) - 1 else {}
+                message = await call(
+                    chat_id,
+                    lambda: bot.send_message(chat_id, chunk, **extra),
+                    method="send_message",
+                )
+                sent.append(message)
+                SENDER_STATS["chunks"] += 1
+            return sent
+    finally:
+        _waiters[chat_id] -= 1
+        if not _waiters[chat_id]:
+            del _waiters[chat_id]
+            del _locks[chat_id]
+
+
+def sender_stats() -> Dict[str, int]:
+    return {**SENDER_STATS, "busy_chats": len(_locks), "chats": len(_buckets)}
+
+
+register_stats("telegram", sender_stats)
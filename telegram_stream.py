@@ -0,0 +1,99 @@
+"""
+Потоковая доставка текста в Telegram.
+Первый фрагмент уходит новым сообщением сразу, дальше сообщение
+редактируется не чаще раза в interval секунд; при приближении к лимиту
+длины текущее сообщение фиксируется и продолжение идёт в новое.
+Вызовы идут через telegram_sender: промежуточные правки, на которые нет
+токена чата, пропускаются, итоговые ждут своей очереди.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+from metrics import track
+from telegram_sender import MESSAGE_LIMIT, call, split_point, utf16_len
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingMessage:
+    """Приёмник приращений текста, который показывает их в чате по мере прихода."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: int,
+        *,
+        interval: float = 1.0,
+        limit: int = MESSAGE_LIMIT,
+    ) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.limit = limit
+        self._message: Optional[Message] = None
+        self._current = ""  # текст текущего (последнего) сообщения
+        self._shown = ""  # что из него уже видно пользователю
+        self._next_edit_at = 0.0
+        self.started = False
+
+    async def feed(self, delta: str) -> None:
+        """Добавляет фрагмент; в чат уходит с учётом троттлинга."""
+        if not delta:
+            return
+        self.started = True
+        self._current += delta
+        while utf16_len(self._current) > self.limit:
+            cut = split_point(self._current, self.limit)
+            head, self._current = self._current[:cut], self._current[cut:]
+            await self._show(head, force=True)
+            # следующий фрагмент начнёт новое сообщение
+            self._message, self._shown = None, ""
+        await self._show(self._current)
+
+    async def finish(self, tail: str = "") -> None:
+        """Досылает остаток и показывает итоговый текст без троттлинга."""
+        if tail:
+            await self.feed(tail)
+        await self._show(self._current, force=True)
+
+    async def _show(self, text: str, force: bool = False) -> None:
+        if not text.strip() or text == self._shown:
+            return
+        now = time.monotonic()
+        if not force and now < self._next_edit_at:
+            return
+        try:
+            if self._message is None:
+                with track("telegram_send"):
+                    result = await call(
+                        self.chat_id,
+                        lambda: self.bot.send_message(self.chat_id, text),
+                        method="send_message",
+                        optional=not force,
+                    )
+                if result is not None:
+                    self._message = result
+            else:
+                message = self._message
+                with track("telegram_edit"):
+                    result = await call(
+                        self.chat_id,
+                        lambda: message.edit_text(text),
+                        method="edit_message_text",
+                        optional=not force,
+                    )
+            if result is None:
+                # нет токена или flood-wait — покажем со следующим фрагментом
+                return
+            self._shown = text
+            self._next_edit_at = now + self.interval
+        except BadRequest as exc:
+            if "not modified" not in str(exc).lower():
+                raise
+            self._shown = text
@@ -0,0 +1,72 @@
+"""Табличный расчёт (numerology_table) совпадает со скалярным (numerology)."""
+from datetime import date, timedelta
+
+import pytest
+
+from numerology import _report_data, calculate, calculate_scalar
+from numerology_table import END, FIELDS, START, build_table, lookup, lookup_range, verify
+
+EDGE_DATES = [
+    date(1900, 1, 1),
+    date(1900, 2, 28),
+    date(1900, 3, 1),  # 1900 не високосный
+    date(1999, 12, 31),
+    date(2000, 2, 29),
+    date(2024, 2, 29),
+    date(2099, 12, 31),
+    date(2100, 1, 1),
+    date(2100, 12, 31),
+]
+
+
+def _scalar_row(day: date) -> tuple:
+    data = calculate_scalar(day.strftime("%d.%m.%Y"))
+    cycles = data["inner_cycles"]
+    return (
+        data["life_path"],
+        data["day_code"],
+        data["month_code"],
+        data["year_code"],
+        data["karma"],
+        cycles[1],
+        cycles[2],
+    )
+
+
+def test_table_matches_scalar_for_whole_range():
+    assert verify(build_table()) == 0
+
+
+@pytest.mark.parametrize("day", EDGE_DATES, ids=str)
+def test_lookup_range_edges(day):
+    start = max(START, day - timedelta(days=1))
+    end = min(END, day + timedelta(days=1))
+    rows = lookup_range(start, end)
+    assert len(rows) == (end - start).days + 1
+    for offset, row in enumerate(rows):
+        assert tuple(int(row[name]) for name in FIELDS) == _scalar_row(start + timedelta(days=offset))
+
+
+@pytest.mark.parametrize("day", EDGE_DATES, ids=str)
+def test_lookup_matches_scalar(day):
+    row = lookup(day.day, day.month, day.year)
+    assert row == _scalar_row(day)
+    date_str = day.strftime("%d.%m.%Y")
+    assert calculate(date_str) == _report_data(day.day, day.month, day.year, *row)
+
+
+def test_lookup_range_outside_table():
+    start, end = START - timedelta(days=3), START + timedelta(days=2)
+    rows = lookup_range(start, end)
+    assert len(rows) == (end - start).days + 1
+    for offset, row in enumerate(rows):
+        day = start + timedelta(days=offset)
+        assert tuple(int(row[name]) for name in FIELDS) == _scalar_row(day)
+
+
+def test_lookup_rejects_invalid_and_out_of_range():
+    assert lookup(29, 2, 1900) is None
+    assert lookup(31, 4, 2000) is None
+    assert lookup(31, 12, START.year - 1) is None
+    assert lookup(1, 1, END.year + 1) is None
+    assert calculate("15.06.1850") == calculate_scalar("15.06.1850")
@@ -0,0 +1,226 @@
+"""
+Учёт токенов запросов к LLM и адаптивный max_tokens отчётов.
+Расход каждого ответа берётся из поля usage провайдера (Yandex —
+inputTextTokens/completionTokens, DeepSeek — prompt_tokens/completion_tokens),
+а если его нет, оценивается по длине текста: символов на токен — по уже
+виденным ответам этого провайдера. Записи копятся в памяти и раз в
+token_usage_flush_interval уходят в llm_usage одной пачкой;
+`python token_usage.py [дней]` печатает сводку по режимам и провайдерам.
+
+max_tokens отчёта — перцентиль token_usage_percentile длины ответа по
+скользящему окну на (провайдер, режим) с запасом token_usage_headroom, не
+выше llm_max_tokens. Ответ, обрезанный по лимиту, идёт в окно как потолок —
+лимит тут же растёт обратно. Пока замеров меньше token_usage_min_samples,
+действует llm_max_tokens. При старте окна заполняются из llm_usage.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from config import settings
+from db import close_db, init_db, purge_usage, recent_usage, save_usage, usage_summary
+from metrics import LLM_TOKENS, register_stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHARS_PER_TOKEN = 3.0  # русский текст у токенизаторов обеих моделей
+CALIBRATION_MIN_TOKENS = 10_000  # до этого — DEFAULT_CHARS_PER_TOKEN
+MIN_MAX_TOKENS = 200
+HISTORY_DAYS = 7  # откуда заполнять окна при старте
+MAX_PENDING = 10_000  # записей в памяти, если БД недоступна
+PURGE_INTERVAL = 3600.0
+
+Key = Tuple[str, str]
+
+_purpose: ContextVar[str] = ContextVar("llm_purpose", default="report")
+_windows: Dict[Key, Deque[int]] = {}
+_calibration: Dict[str, List[int]] = defaultdict(lambda: [0, 0])  # символов, токенов
+_pending: Deque[tuple] = deque(maxlen=MAX_PENDING)
+_task: Optional[asyncio.Task] = None
+
+USAGE_STATS: Dict[str, int] = {
+    "requests": 0,
+    "estimated": 0,
+    "truncated": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+}
+
+
+@contextmanager
+def usage_purpose(purpose: str) -> Iterator[None]:
+    """Назначение запросов внутри блока (fragments, intro, ...); по умолчанию report."""
+    token = _purpose.set(purpose)
+    try:
+        yield
+    finally:
+        _purpose.reset(token)
+
+
+# ---------- учёт ----------
+def estimate_tokens(text: str, provider: str) -> int:
+    if not text:
+        return 0
+    chars, tokens = _calibration[provider]
+    ratio = chars / tokens if tokens >= CALIBRATION_MIN_TOKENS else DEFAULT_CHARS_PER_TOKEN
+    return max(1, round(len(text) / ratio))
+
+
+def _window(key: Key) -> Deque[int]:
+    window = _windows.get(key)
+    if window is None:
+        window = _windows[key] = deque(maxlen=settings.token_usage_window)
+    return window
+
+
+def record(
+    provider: str,
+    model: str,
+    mode: str,
+    prompt: str,
+    text: str,
+    usage: Optional[Tuple[int, int]] = None,
+    *,
+    truncated: bool = False,
+    max_tokens: Optional[int] = None,
+    purpose: Optional[str] = None,
+) -> bool:
+    """
+    Учитывает один успешный ответ; usage — (входные, выходные) токены от
+    провайдера. True — ответ обрезан ниже llm_max_tokens: его стоит
+    запросить заново с потолком, а не отдавать и кешировать обрезанным.
+    """
+    purpose = purpose or _purpose.get()
+    estimated = usage is None
+    if usage is None:
+        prompt_tokens, completion_tokens = estimate_tokens(prompt, provider), estimate_tokens(text, provider)
+        truncated = truncated or (max_tokens is not None and completion_tokens >= max_tokens)
+    else:
+        prompt_tokens, completion_tokens = usage
+        calibration = _calibration[provider]
+        calibration[0] += len(prompt) + len(text)
+        calibration[1] += prompt_tokens + completion_tokens
+
+    LLM_TOKENS.labels(provider, mode, purpose, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(provider, mode, purpose, "completion").inc(completion_tokens)
+    USAGE_STATS["requests"] += 1
+    USAGE_STATS["estimated"] += estimated
+    USAGE_STATS["truncated"] += truncated
+    USAGE_STATS["prompt_tokens"] += prompt_tokens
+    USAGE_STATS["completion_tokens"] += completion_tokens
+    if truncated:
+        logger.warning("Ответ %s (%s, %s) обрезан по max_tokens", provider, mode, purpose)
+    if purpose == "report":
+        _window((provider, mode)).append(settings.llm_max_tokens if truncated else completion_tokens)
+    if settings.token_usage_flush_interval > 0:
+        _pending.append(
+            (provider, model, mode, purpose, prompt_tokens, completion_tokens, estimated, truncated)
+        )
+    return truncated and max_tokens is not None and max_tokens < settings.llm_max_tokens
+
+
+# ---------- политика ----------
+def _percentile(key: Key, q: float) -> Optional[int]:
+    window = _windows.get(key)
+    if window is None or len(window) < settings.token_usage_min_samples:
+        return None
+    ordered = sorted(window)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def max_tokens_for(provider: str, mode: str) -> int:
+    """Лимит ответа отчёта: с запасом над обычной длиной ответа режима."""
+    observed = _percentile((provider, mode), settings.token_usage_percentile)
+    if observed is None:
+        return settings.llm_max_tokens
+    limit = int(observed * settings.token_usage_headroom)
+    return max(MIN_MAX_TOKENS, min(settings.llm_max_tokens, limit))
+
+
+# ---------- хранение ----------
+async def _load_windows() -> None:
+    rows = await recent_usage("report", settings.token_usage_window, HISTORY_DAYS)
+    for r in rows:
+        sample = settings.llm_max_tokens if r["truncated"] else r["completion_tokens"]
+        _window((r["provider"], r["mode"])).append(sample)
+    logger.info("Окна токенов заполнены: %s ответов", len(rows))
+
+
+async def flush() -> None:
+    if not _pending:
+        return
+    rows = list(_pending)
+    _pending.clear()
+    try:
+        await save_usage(rows)
+    except Exception:
+        logger.exception("Не удалось записать расход токенов")
+        # вернём в начало очереди; самые старые вытеснит maxlen
+        _pending.extendleft(reversed(rows))
+
+
+async def _loop() -> None:
+    purged_at = 0.0
+    while True:
+        await asyncio.sleep(settings.token_usage_flush_interval)
+        await flush()
+        if time.monotonic() - purged_at >= PURGE_INTERVAL:
+            purged_at = time.monotonic()
+            try:
+                await purge_usage(settings.token_usage_retention_days)
+            except Exception:
+                logger.exception("Не удалось очистить llm_usage")
+
+
+# ---------- жизненный цикл ----------
+async def start_usage_accounting() -> None:
+    global _task
+    if settings.token_usage_flush_interval <= 0 or _task is not None:
+        return
+    try:
+        await _load_windows()
+    except Exception:
+        logger.exception("Не удалось загрузить историю токенов")
+    _task = asyncio.create_task(_loop())
+
+
+async def stop_usage_accounting() -> None:
+    global _task
+    if _task is None:
+        return
+    task, _task = _task, None
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await flush()
+
+
+def usage_stats() -> Dict[str, object]:
+    return {
+        **USAGE_STATS,
+        "pending": len(_pending),
+        "max_tokens": {f"{p}_{m}": max_tokens_for(p, m) for p, m in _windows},
+    }
+
+
+register_stats("token_usage", usage_stats)
+
+
+async def _main(days: int) -> None:
+    await init_db()
+    try:
+        for r in await usage_summary(days):
+            print(json.dumps({k: float(v) if k.endswith("_share") else v for k, v in dict(r).items()}))
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(int(sys.argv[1]) if len(sys.argv) > 1 else 7))
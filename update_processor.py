@@ -0,0 +1,106 @@
+"""
+Параллельная обработка апдейтов Telegram.
+Апдейты разных чатов обрабатываются одновременно (не больше limit),
+апдейты одного чата — строго по очереди, в порядке поступления: иначе
+«сделай расчёт по дате» мог бы обогнать сообщение с самой датой.
+Пока апдейт ждёт предыдущий из своего чата, он не занимает слот
+выполнения, так что один болтливый чат не тормозит остальных.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Hashable, Optional, Set
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import in_flight, register_stats, track
+
+logger = logging.getLogger(__name__)
+
+
+def _chat_key(update: object) -> Optional[Hashable]:
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    limit — апдейтов в обработке одновременно; backlog — всего принятых
+    в работу, включая ждущих свою очередь в чате (остальные ждут в
+    update_queue приложения).
+    """
+
+    def __init__(self, limit: int, backlog: int) -> None:
+        super().__init__(max(backlog, limit))
+        self._slots = asyncio.BoundedSemaphore(limit)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_waiters: Dict[Hashable, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._closing = False
+        self.active = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self._closing:
+            # время на дренаж вышло — в работу больше ничего не берём
+            coroutine.close()
+            return
+
+        key = _chat_key(update)
+        lock = None
+        if key is not None:
+            lock = self._chat_locks.setdefault(key, asyncio.Lock())
+            self._chat_waiters[key] = self._chat_waiters.get(key, 0) + 1
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._slots:
+                    self.active += 1
+                    try:
+                        with in_flight("updates"), track("update"):
+                            await coroutine
+                    finally:
+                        self.active -= 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            # если отменили до запуска — корутина так и не была awaited
+            coroutine.close()
+            self._tasks.discard(task)
+            if key is not None:
+                self._chat_waiters[key] -= 1
+                if not self._chat_waiters[key]:
+                    del self._chat_waiters[key]
+                    del self._chat_locks[key]
+
+    async def drain(self, update_queue: asyncio.Queue, timeout: float) -> None:
+        """
+        Дожидается обработки всех принятых апдейтов (приём новых уже
+        остановлен); по истечении timeout отменяет оставшиеся.
+        """
+        if update_queue.empty() and not self._tasks:
+            return
+        logger.info("Дожидаемся %s апдейтов в работе", len(self._tasks))
+        try:
+            await asyncio.wait_for(update_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self._closing = True
+            logger.warning("Дренаж не уложился в %s с, отменяем %s апдейтов", timeout, len(self._tasks))
+            for task in list(self._tasks):
+                task.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return {"accepted": len(self._tasks), "chats": len(self._chat_locks)}
+
+    async def initialize(self) -> None:
+        self._closing = False
+        register_stats("updates", self.stats)
+
+    async def shutdown(self) -> None:
+        pass
@@ -2,28 +2,49 @@
 Модуль генерации текста через Yandex GPT API.
 Автоматически переключается между yandexgpt и YandexGPT Lite,
 добавляет ретраи с экспоненциальной выдержкой и логирует все
-неуспешные попытки.
+неуспешные попытки. Все запросы асинхронные и идут через общий
+пул соединений llm_client.
+
+Если полная модель не ответила за перцентиль своей обычной латентности,
+параллельно запускается Lite (hedging) и берётся первый успешный ответ.
+У каждой модели свой circuit breaker: после серии ошибок модель
+пропускается, пока пробный запрос в half-open не пройдёт.
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
-import os
-import time
-from typing import List, Optional
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-import requests
+import httpx
 
 from config import settings
+from llm_client import (
+    DeadlineExceeded,
+    LLMStreamError,
+    post_json,
+    sleep_backoff,
+    stream_lines,
+)
+from metrics import LLM_FAILURES, observe_llm_request, register_stats
+from prompts import build_report_prompt
+from resilience import HALF_OPEN, CircuitBreaker, LatencyTracker
+from token_usage import max_tokens_for, record
 
 logger = logging.getLogger(__name__)
 
 # ---------- Константы ----------
 DEFAULT_TEMPERATURE = 0.6
-DEFAULT_MAX_TOKENS = 2_000
 MAX_RETRIES = 4  # 1 основной + 3 ретрая
 BACKOFF_FACTOR = 1.5  # множитель экспоненциальной выдержки
 TIMEOUT = 30  # секунды на один запрос
+STREAM_TIMEOUT = 15  # максимальная пауза между порциями потока, сек
+
+# Пометка «сырого» ответа, когда ни одна модель не справилась
+FAILED_MARK = "(Текст не сгенерирован)"
+TRUNCATED_STATUS = "ALTERNATIVE_STATUS_TRUNCATED_FINAL"
 
 # Два варианта uri (приоритет – полный, если Lite не указан)
 MODELS = {
@@ -31,22 +52,42 @@ MODELS = {
     "lite": f"gpt://{settings.yandex_folder_id}/yandexgpt-lite/latest",
 }
 
+# Hedging: Lite стартует, если full молчит дольше HEDGE_PERCENTILE его латентности
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_SAMPLES = 20  # пока замеров меньше — HEDGE_DEFAULT_DELAY
+HEDGE_DEFAULT_DELAY = 8.0
+HEDGE_MIN_DELAY = 1.0
+BREAKER_FAILURES = 5  # ошибок подряд до размыкания
+BREAKER_RESET = 30.0  # секунд до пробного запроса
+
+# метка model в метриках: uri без каталога, например yandexgpt/latest
+MODEL_LABELS = {key: uri.split("/", 3)[-1] for key, uri in MODELS.items()}
+
+BREAKERS = {key: CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET) for key in MODELS}
+LATENCY = {key: LatencyTracker() for key in MODELS}
+HEDGE_STATS = {"primary_only": 0, "hedged": 0, "hedge_won": 0, "primary_won": 0}
+
+
 # ---------- Служебные функции ----------
-def _sleep_attempt(attempt: int) -> None:
-    """Экспоненциальная выдержка между ретраями."""
+async def _sleep_attempt(attempt: int, deadline: Optional[float] = None) -> None:
+    """Экспоненциальная выдержка между ретраями (не блокирует event loop)."""
     delay = BACKOFF_FACTOR**attempt
     logger.info("Retry %s/%s after %.1f sec", attempt + 1, MAX_RETRIES, delay)
-    time.sleep(delay)
+    await sleep_backoff(delay, deadline)
 
 
 def _make_payload(
-    prompt: str, model_uri: str, temperature: float, max_tokens: int
+    prompt: str,
+    model_uri: str,
+    temperature: float,
+    max_tokens: int,
+    stream: bool = False,
 ) -> dict:
     """Формирует тело запроса к Yandex GPT."""
     return {
         "modelUri": model_uri,
         "completionOptions": {
-            "stream": False,
+            "stream": stream,
             "temperature": temperature,
             "maxTokens": max_tokens,
         },
@@ -54,20 +95,21 @@ def _make_payload(
     }
 
 
-def _post(
-    url: str, headers: dict, payload: dict, timeout: int
-) -> Optional[requests.Response]:
+async def _post(
+    url: str,
+    headers: dict,
+    payload: dict,
+    timeout: float,
+    deadline: Optional[float] = None,
+) -> Optional[httpx.Response]:
     """Выполняет POST-запрос с базовой обработкой исключений."""
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=timeout)
+    resp = await post_json(url, payload, headers, timeout, deadline, provider="yandex")
+    if resp is not None:
         logger.debug("Yandex GPT HTTP %s", resp.status_code)
-        return resp
-    except requests.RequestException as exc:
-        logger.warning("Request failed: %s", exc)
-        return None
+    return resp
 
 
-def _extract_text(resp: requests.Response) -> Optional[str]:
+def _extract_text(resp: httpx.Response) -> Optional[str]:
     """Достаёт текст из успешного ответа."""
     try:
         data = resp.json()
@@ -77,87 +119,309 @@ def _extract_text(resp: requests.Response) -> Optional[str]:
         return None
 
 
-# ---------- Публичная функция ----------
-def generate_via_yandex(
-    structure: List[str],
-    mode: str,
-    *,
-    temperature: float = DEFAULT_TEMPERATURE,
-    max_tokens: int = DEFAULT_MAX_TOKENS,
-) -> str:
-    """
-    Генерирует эзотерический отчёт на основе списка строк-фрагментов.
-    При неуспехе пробует yandexgpt-lite, затем отдаёт «сырой» текст.
-    """
-    mode_desc = {
-        "default": "краткий эзотерический отчёт",
-        "deep": "глубокий нумерологический анализ",
-        "master": "полный эзотерический портрет по методике Хшановской",
-    }[mode]
-
-    #prompt = (
-    #    f"Ты — эзотерический нумеролог. Напиши {mode_desc} на основе данных ниже. "
-    #    "Говори мягко, вдохновляюще, наставнически. Не задавай вопросов, "
-    #    "не ссылайся на источники, не философствуй. "
-    #    "Заверши текст: «Если почувствуешь, что это о тебе — это не совпадение. "
-    #    "Всё записано в дате.» "
-    #    "«Если ты узнал себя — поставь ⭐ или сохрани расклад.»\n\n"
-    #    "Данные:\n" + "\n".join(structure)
-    #)
-
-    #prompt = (
-    #"Ты — эзотерический нумеролог. Пользователь уже получил структурированный список (см. ниже). "
-    #"Напиши **развернутый, вдохновляющий текст-расширение** к каждому пункту, "
-    #"не удаляя эмодзи-иконки и не меняя заголовки. "
-    #"Добавь по 1-3 предложения под каждым пунктом, сохрани формат «эмодзи + заголовок».\n\n"
-    #"Данные:\n" + "\n".join(structure)
-    #)
+def _extract_usage(result: dict) -> Tuple[Optional[Tuple[int, int]], bool]:
+    """((входные, выходные) токены или None, обрезан ли ответ по maxTokens) из result."""
+    try:
+        truncated = result["alternatives"][0].get("status") == TRUNCATED_STATUS
+    except (KeyError, IndexError, AttributeError):
+        truncated = False
+    try:
+        usage = result["usage"]
+        return (int(usage["inputTextTokens"]), int(usage["completionTokens"])), truncated
+    except (KeyError, TypeError, ValueError):
+        return None, truncated
 
-    prompt = (
-        f"Ты — эзотерический нумеролог. Напиши {mode_desc} на основе данных ниже. "
-        "Говори мягко, вдохновляюще, наставнически. Не задавай вопросов, "
-        "не ссылайся на источники, не философствуй. "
-        "не удаляя эмодзи-иконки и не меняя заголовки. "
-        "Добавь по 1-3 предложения под каждым пунктом, сохрани формат «эмодзи + заголовок».\n\n"
-        "Заверши текст: «Если почувствуешь, что это о тебе — это не совпадение. "
-        "Всё записано в дате.» "
-        "«Если ты узнал себя — поставь ⭐ или сохрани расклад.»\n\n"
-        "Данные:\n" + "\n".join(structure)
+
+def _account(
+    resp: httpx.Response,
+    model_label: str,
+    mode: str,
+    prompt: str,
+    text: str,
+    max_tokens: int,
+    purpose: Optional[str] = None,
+) -> bool:
+    """Расход токенов успешного ответа — в token_usage; True — обрезан ниже потолка."""
+    try:
+        result = resp.json()["result"]
+    except (json.JSONDecodeError, KeyError):
+        result = {}
+    usage, truncated = _extract_usage(result)
+    return record(
+        "yandex",
+        model_label,
+        mode,
+        prompt,
+        text,
+        usage,
+        truncated=truncated,
+        max_tokens=max_tokens,
+        purpose=purpose,
     )
 
+
+async def _try_model(
+    model_key: str,
+    prompt: str,
+    temperature: float,
+    max_tokens: int,
+    deadline: Optional[float],
+    mode: str,
+) -> Optional[str]:
+    """Ретраи одной модели с учётом её circuit breaker; None — не вышло."""
     url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
     headers = {"Authorization": f"Api-Key {settings.yandex_api_key}"}
+    model_uri = MODELS[model_key]
+    breaker = BREAKERS[model_key]
+    loop = asyncio.get_running_loop()
+    logger.info("Trying model %s (%s)", model_key, model_uri)
 
-    # Пробуем модели по порядку
-    for model_key, model_uri in MODELS.items():
-        logger.info("Trying model %s (%s)", model_key, model_uri)
-
+    probe = False  # держим ли half-open пробу breaker'а
+    try:
         for attempt in range(MAX_RETRIES):
+            if not breaker.allow():
+                logger.warning("Circuit for %s is %s, skipping", model_key, breaker.state)
+                LLM_FAILURES.labels("yandex", MODEL_LABELS[model_key], "circuit_open").inc()
+                return None
+            probe = breaker.state == HALF_OPEN
             payload = _make_payload(prompt, model_uri, temperature, max_tokens)
-            resp = _post(url, headers, payload, TIMEOUT)
-
-            if resp is None:
-                _sleep_attempt(attempt)
-                continue
+            started = loop.time()
+            try:
+                resp = await _post(url, headers, payload, TIMEOUT, deadline)
+            except asyncio.CancelledError:
+                # проиграл гонку hedging: без этого замера медленные вызовы
+                # выпадают из перцентиля и задержка hedging ползёт вниз
+                LATENCY[model_key].observe(loop.time() - started)
+                raise
+            elapsed = loop.time() - started
 
-            if resp.status_code == 200:
+            if resp is not None and resp.status_code == 200:
                 text = _extract_text(resp)
                 if text:
+                    breaker.record_success()
+                    probe = False
+                    LATENCY[model_key].observe(elapsed)
+                    observe_llm_request("yandex", MODEL_LABELS[model_key], elapsed)
+                    if _account(resp, MODEL_LABELS[model_key], mode, prompt, text, max_tokens):
+                        # адаптивный лимит оказался мал: обрезанный отчёт не отдаём
+                        logger.warning("Answer truncated at %s tokens, retrying with the ceiling", max_tokens)
+                        max_tokens = settings.llm_max_tokens
+                        continue
                     logger.info("Successfully generated with %s", model_key)
                     return text
                 logger.warning("Empty text in response")
-            else:
+                failure = "empty"
+            elif resp is not None:
                 logger.warning(
                     "Yandex API error (%s): %s", resp.status_code, resp.text
                 )
-                _sleep_attempt(attempt)
+                failure = f"http_{resp.status_code}"
+            else:
+                failure = "network"
+            observe_llm_request("yandex", MODEL_LABELS[model_key], elapsed, failure)
+            breaker.record_failure()
+            probe = False
+            if attempt + 1 < MAX_RETRIES:
+                await _sleep_attempt(attempt, deadline)
+    except DeadlineExceeded:
+        logger.warning("Yandex GPT deadline exceeded (%s)", model_key)
+        LLM_FAILURES.labels("yandex", MODEL_LABELS[model_key], "deadline").inc()
+    finally:
+        if probe:
+            # отмена или дедлайн ничего не говорят о здоровье модели
+            breaker.release_probe()
+    return None
+
+
+def _hedge_delay() -> float:
+    """Сколько ждать full, прежде чем параллельно запускать Lite."""
+    tracker = LATENCY["full"]
+    if len(tracker) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, tracker.percentile(HEDGE_PERCENTILE))
+
+
+async def _hedged(
+    prompt: str, temperature: float, max_tokens: int, deadline: Optional[float], mode: str
+) -> Optional[str]:
+    """full с подстраховкой Lite; возвращает первый успешный текст."""
+    def start(model_key: str) -> asyncio.Task:
+        task = asyncio.create_task(
+            _try_model(model_key, prompt, temperature, max_tokens, deadline, mode)
+        )
+        tasks[task] = model_key
+        return task
+
+    tasks: Dict[asyncio.Task, str] = {}
+    racing = False  # full ещё думает, когда стартовала Lite
+    try:
+        if BREAKERS["full"].state != "open":
+            primary = start("full")
+            await asyncio.wait({primary}, timeout=_hedge_delay())
+            if primary.done() and primary.result():
+                HEDGE_STATS["primary_only"] += 1
+                return primary.result()
+            racing = not primary.done()
+        start("lite")
+        if racing:
+            HEDGE_STATS["hedged"] += 1
+
+        pending = {t for t in tasks if not t.done()}
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                text = task.result()
+                if text:
+                    if racing:
+                        won = "hedge_won" if tasks[task] == "lite" else "primary_won"
+                        HEDGE_STATS[won] += 1
+                    return text
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def yandex_stats() -> Dict[str, object]:
+    """Состояние breaker'ов, латентности и счётчики hedging для мониторинга."""
+    hedged = HEDGE_STATS["hedged"]
+    return {
+        "breakers": {key: b.stats() for key, b in BREAKERS.items()},
+        "latency_p50": {key: t.percentile(0.5) for key, t in LATENCY.items()},
+        "latency_p90": {key: t.percentile(0.9) for key, t in LATENCY.items()},
+        "hedge_delay": _hedge_delay(),
+        **HEDGE_STATS,
+        "hedge_win_rate": HEDGE_STATS["hedge_won"] / hedged if hedged else 0.0,
+    }
+
+
+register_stats("yandex", yandex_stats)
+
+
+# ---------- Публичные функции ----------
+async def generate_via_yandex(
+    structure: List[str],
+    mode: str,
+    *,
+    temperature: float = DEFAULT_TEMPERATURE,
+    max_tokens: Optional[int] = None,
+    deadline: Optional[float] = None,
+    prompt: Optional[str] = None,
+) -> str:
+    """
+    Генерирует эзотерический отчёт на основе списка строк-фрагментов.
+    Если полная модель медлит или сбоит, подключает yandexgpt-lite,
+    а если не справились обе — отдаёт «сырой» текст.
+    deadline — абсолютное время loop.time(), после которого ретраи прекращаются.
+    prompt — готовый промпт вместо отчётного (фрагменты, вступление).
+    max_tokens по умолчанию подбирает token_usage.
+    """
+    if max_tokens is None:
+        max_tokens = max_tokens_for("yandex", mode)
+    if prompt is None:
+        prompt = build_report_prompt(structure, mode)
+
+    text = await _hedged(prompt, temperature, max_tokens, deadline, mode)
+    if text:
+        return text
 
     # Всё равно не удалось — возвращаем «сырой» текст
     raw = "\n".join(structure)
     logger.error("All Yandex GPT attempts failed, returning raw text")
-    return raw + "\n\n(Текст не сгенерирован)"
+    return raw + "\n\n" + FAILED_MARK
+
+async def stream_via_yandex(
+    structure: List[str],
+    mode: str,
+    *,
+    temperature: float = DEFAULT_TEMPERATURE,
+    max_tokens: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """
+    Потоковая генерация отчёта: отдаёт приращения текста по мере прихода.
+    Yandex присылает построчно JSON с накопленным текстом альтернативы,
+    поэтому наружу отдаём только новый хвост. До первого фрагмента
+    пробуем модели по порядку (по одной попытке, без выдержек);
+    если не ответила ни одна — LLMStreamError, и вызывающий уходит
+    в обычный generate_via_yandex с ретраями.
+    """
+    if max_tokens is None:
+        max_tokens = max_tokens_for("yandex", mode)
+    prompt = build_report_prompt(structure, mode)
+    url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+    headers = {"Authorization": f"Api-Key {settings.yandex_api_key}"}
 
-def generate_fallback_via_yandex(user_text: str) -> str:
+    loop = asyncio.get_running_loop()
+    last_error: Optional[Exception] = None
+    for model_key, model_uri in MODELS.items():
+        breaker = BREAKERS[model_key]
+        label = MODEL_LABELS[model_key]
+        if not breaker.allow():
+            logger.warning("Circuit for %s is %s, skipping stream", model_key, breaker.state)
+            LLM_FAILURES.labels("yandex", label, "circuit_open").inc()
+            continue
+        probe = breaker.state == HALF_OPEN
+        try:
+            payload = _make_payload(prompt, model_uri, temperature, max_tokens, stream=True)
+            sent = 0
+            result: dict = {}
+            started = loop.time()
+            try:
+                lines = stream_lines(
+                    url, payload, headers, STREAM_TIMEOUT, deadline, provider="yandex"
+                )
+                async with aclosing(lines):
+                    async for line in lines:
+                        try:
+                            result = json.loads(line)["result"]
+                            text = result["alternatives"][0]["message"]["text"]
+                        except (json.JSONDecodeError, KeyError, IndexError) as exc:
+                            logger.warning("Cannot parse stream chunk: %s", exc)
+                            continue
+                        if len(text) > sent:
+                            yield text[sent:]
+                            sent = len(text)
+            except LLMStreamError as exc:
+                breaker.record_failure()
+                observe_llm_request("yandex", label, loop.time() - started, "stream")
+                if sent:
+                    raise
+                logger.warning("Yandex stream via %s failed: %s", model_key, exc)
+                last_error = exc
+                continue
+            if sent:
+                breaker.record_success()
+                observe_llm_request("yandex", label, loop.time() - started)
+                # последняя порция несёт итоговые usage и статус
+                usage, truncated = _extract_usage(result)
+                if record(
+                    "yandex",
+                    label,
+                    mode,
+                    prompt,
+                    text,
+                    usage,
+                    truncated=truncated,
+                    max_tokens=max_tokens,
+                ):
+                    # показанный текст пометят несгенерированным и не закешируют
+                    raise LLMStreamError(f"Yandex answer truncated at {max_tokens} tokens")
+                logger.info("Successfully streamed with %s", model_key)
+                return
+            breaker.record_failure()
+            observe_llm_request("yandex", label, loop.time() - started, "empty")
+            logger.warning("Empty stream from %s", model_key)
+        finally:
+            if probe:
+                # дедлайн или закрытие потока снаружи — не исход пробы
+                breaker.release_probe()
+    raise LLMStreamError(f"All Yandex GPT streams failed: {last_error}")
+
+
+async def generate_fallback_via_yandex(user_text: str) -> str:
     prompt = (
         f"Пользователь написал: '{user_text}'. "
         "Он не ввёл дату рождения в формате ДД.ММ.ГГГГ. "
@@ -171,11 +435,49 @@ def generate_fallback_via_yandex(user_text: str) -> str:
     model_uri = f"gpt://{settings.yandex_folder_id}/yandexgpt-lite/latest"
 
     payload = _make_payload(prompt, model_uri, temperature=0.7, max_tokens=300)
-    resp = _post(url, headers, payload, timeout=10)
+    try:
+        resp = await _post(url, headers, payload, timeout=10)
+    except DeadlineExceeded:
+        # не дождались квоты: болтовня уступает отчётам
+        resp = None
 
     if resp and resp.status_code == 200:
         text = _extract_text(resp)
         if text:
+            _account(resp, MODEL_LABELS["lite"], "", prompt, text, 300, purpose="chat")
             return text
 
-    return "Я пока не понял, давай просто дату рождения в формате ДД.ММ.ГГГГ — и я создам твой портрет. А если хочешь такого же бота — пиши @viv1313r"
\ No newline at end of file
+    return "Я пока не понял, давай просто дату рождения в формате ДД.ММ.ГГГГ — и я создам твой портрет. А если хочешь такого же бота — пиши @viv1313r"
+
+
+async def generate_fallback_variants(situation: str, count: int) -> Optional[str]:
+    """
+    Пачка заготовок для пула ответов без даты (см. fallback_replies):
+    по варианту на строку. None — модель не ответила.
+    """
+    prompt = (
+        f"Пользователь чат-бота нумеролога {situation} и не ввёл дату рождения "
+        "в формате ДД.ММ.ГГГГ. "
+        f"Напиши {count} разных коротких ответов (1–3 предложения) в стиле дружелюбного "
+        "собеседника: слегка пошути и мягко подтолкни ввести дату рождения. "
+        "В каждом ненавязчиво предложи личную консультацию по созданию таких ботов — "
+        "контакт @viv1313r. Не говори, что ты бот. "
+        "Каждый ответ — одной строкой, начиная с «- », без нумерации и пояснений."
+    )
+
+    url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+    headers = {"Authorization": f"Api-Key {settings.yandex_api_key}"}
+    model_uri = f"gpt://{settings.yandex_folder_id}/yandexgpt-lite/latest"
+
+    max_tokens = 150 * count
+    payload = _make_payload(prompt, model_uri, temperature=0.9, max_tokens=max_tokens)
+    try:
+        resp = await _post(url, headers, payload, timeout=TIMEOUT)
+    except DeadlineExceeded:
+        return None
+    if resp and resp.status_code == 200:
+        text = _extract_text(resp)
+        if text:
+            _account(resp, MODEL_LABELS["lite"], "", prompt, text, max_tokens, purpose="fallback_pool")
+        return text
+    return None